@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the rendering of feeds and pages by 'recorder feed update'.
+
+Creates a configuration with many stations and shows and an episodes
+database with episodes for every show, then renders all feeds and pages
+with different numbers of processes.
+
+Usage:
+    bench_render.py [--stations=<n>] [--shows=<n>] [--episodes=<n>] [--jobs=<list>]
+
+Options:
+    --stations=<n>  Number of stations [default: 10]
+    --shows=<n>     Number of shows per station [default: 30]
+    --episodes=<n>  Number of episodes per show [default: 20]
+    --jobs=<list>   Comma separated numbers of processes [default: 1,2,4,8]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capturadio import Configuration, Station, Episode
+from capturadio.database import EpisodeStore
+from capturadio.generator import render_tasks, run_render_tasks
+
+
+def create_episodes(config, db, stations, shows, episodes):
+    now = time.time()
+    for station_number in range(stations):
+        station = config.add_station(
+            'station{:d}'.format(station_number),
+            'http://example.org/{:d}'.format(station_number),
+            'Station {:d}'.format(station_number))
+        for show_number in range(shows):
+            show = config.add_show(
+                station, '{}_show{:d}'.format(station.id, show_number),
+                'Show {:d}'.format(show_number), 3600)
+            os.makedirs(show.filename)
+            with db.transaction():
+                for number in range(episodes):
+                    episode = Episode(config, show, time.localtime(now - number * 86400))
+                    with open(episode.filename, 'wb') as file:
+                        file.write(b'\0' * 1024)
+                    episode.filesize = '1024'
+                    episode.mimetype = 'audio/mpeg'
+                    db[episode.slug] = episode
+
+
+def main():
+    args = docopt(__doc__)
+    folder = tempfile.mkdtemp(prefix='capturadio-bench-')
+    config = Configuration(reset=True, folder=folder,
+                           destination=os.path.join(folder, 'podcasts'))
+    root = Station(config, 'root', None, 'All recordings')
+    root.filename = config.destination
+    root.slug = ''
+    root.shows = config.stations.values()
+
+    with EpisodeStore(os.path.join(folder, 'episodes.sqlite')) as db:
+        create_episodes(config, db, int(args['--stations']),
+                        int(args['--shows']), int(args['--episodes']))
+        start = time.perf_counter()
+        tasks = render_tasks(config, db, root)
+        print('collect      {:8.2f}s  {:d} tasks'.format(
+            time.perf_counter() - start, len(tasks)))
+
+    for jobs in map(int, args['--jobs'].split(',')):
+        start = time.perf_counter()
+        run_render_tasks(tasks, jobs)
+        print('render -j{:<3d} {:8.2f}s'.format(jobs, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
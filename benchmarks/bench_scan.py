@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the media scan of 'recorder config update'.
+
+Creates a destination folder with many small mp3 files, migrates them
+into an empty episodes database and scans the folder a second time, when
+all files are known.
+
+Usage:
+    bench_scan.py [--files=<n>] [--shows=<n>] [--jobs=<n>]
+
+Options:
+    --files=<n>   Number of media files [default: 50000]
+    --shows=<n>   Number of show folders [default: 100]
+    --jobs=<n>    Number of worker processes [default: 4]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capturadio import Configuration
+from capturadio.database import EpisodeStore
+from capturadio.scanner import update_episodes
+
+# One MPEG-1 layer 3 frame, 128 kbit/s, 44.1 kHz
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\0' * 413
+
+
+def create_files(config, files, shows):
+    station = config.add_station('bench', 'http://example.org/bench', 'Bench')
+    for number in range(shows):
+        show = config.add_show(station, 'show{:d}'.format(number),
+                               'Show {:d}'.format(number), 3600)
+        os.makedirs(show.filename)
+    for number in range(files):
+        show = station.shows[number % shows]
+        filename = os.path.join(
+            show.filename, '{}_{:06d}.mp3'.format(show.id, number))
+        with open(filename, 'wb') as file:
+            file.write(MP3_FRAME * 10)
+
+
+def main():
+    args = docopt(__doc__)
+    folder = tempfile.mkdtemp(prefix='capturadio-bench-')
+    config = Configuration(reset=True, folder=folder,
+                           destination=os.path.join(folder, 'podcasts'))
+    create_files(config, int(args['--files']), int(args['--shows']))
+    mappings = {show.slug: show for show in config.shows.values()}
+
+    with EpisodeStore(os.path.join(folder, 'episodes.sqlite')) as db:
+        for label in ('initial scan', 'rescan'):
+            start = time.perf_counter()
+            migrated = update_episodes(config, db, mappings, int(args['--jobs']))
+            print('{:<14} {:8.2f}s  {:d} files migrated'.format(
+                label, time.perf_counter() - start, migrated))
+
+
+if __name__ == '__main__':
+    main()
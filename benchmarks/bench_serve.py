@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark 'recorder serve' with a small load generator.
+
+Starts the server in a background thread on a temporary destination with
+a feed and a media file and sends requests over keep-alive connections.
+
+Usage:
+    bench_serve.py [--connections=<n>] [--requests=<n>] [--size=<bytes>]
+
+Options:
+    --connections=<n>  Concurrent connections [default: 50]
+    --requests=<n>     Requests per connection and kind [default: 200]
+    --size=<bytes>     Size of the media file [default: 10485760]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capturadio import Configuration
+from capturadio.server import FeedServer
+
+KINDS = {
+    'feed': 'GET /show/rss.xml HTTP/1.1\r\n\r\n',
+    'conditional': 'GET /show/rss.xml HTTP/1.1\r\nIf-None-Match: {etag}\r\n\r\n',
+    'range': 'GET /show/episode.mp3 HTTP/1.1\r\nRange: bytes=1000000-1065535\r\n\r\n',
+    'media': 'GET /show/episode.mp3 HTTP/1.1\r\n\r\n',
+}
+
+
+def start_server(config):
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(FeedServer(config).start('127.0.0.1', 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return listener.sockets[0].getsockname()[1]
+
+
+async def client(port, request, count):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    etag = None
+    for number in range(count):
+        writer.write(request.format(etag=etag).encode('latin-1'))
+        await reader.readline()
+        length = 0
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if line == '':
+                break
+            key, _, value = line.partition(':')
+            if key.lower() == 'content-length':
+                length = int(value)
+            elif key.lower() == 'etag':
+                etag = value.strip()
+        await reader.readexactly(length)
+    writer.close()
+
+
+async def load(port, request, connections, count):
+    await asyncio.gather(*[client(port, request, count)
+                           for _ in range(connections)])
+
+
+def main():
+    args = docopt(__doc__)
+    connections, count = int(args['--connections']), int(args['--requests'])
+    folder = tempfile.mkdtemp(prefix='capturadio-bench-')
+    config = Configuration(reset=True, folder=folder,
+                           destination=os.path.join(folder, 'podcasts'))
+    os.makedirs(os.path.join(config.destination, 'show'))
+    with open(os.path.join(config.destination, 'show', 'rss.xml'), 'w') as file:
+        file.write('<rss>{}</rss>'.format('<item/>' * 2000))
+    with open(os.path.join(config.destination, 'show', 'episode.mp3'), 'wb') as file:
+        file.write(os.urandom(int(args['--size'])))
+    port = start_server(config)
+
+    for kind, request in KINDS.items():
+        requests = connections * (count if kind != 'media' else max(1, count // 20))
+        start = time.perf_counter()
+        asyncio.run(load(port, request, connections, requests // connections))
+        duration = time.perf_counter() - start
+        print('{:<12} {:8d} requests {:8.2f}s {:10.0f} req/s'.format(
+            kind, requests, duration, requests / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the silence detection of the post-capture pipeline.
+
+Generates the 8 kHz mono PCM samples ffmpeg would decode from a recording
+with some silent gaps and runs the SilenceDetector over them in chunks.
+Decoding with ffmpeg is not included.
+
+Usage:
+    bench_silence.py [--minutes=<n>] [--python]
+
+Options:
+    --minutes=<n>  Length of the recording [default: 60]
+    --python       Use the pure Python fallback instead of NumPy
+"""
+import array
+import os
+import random
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import capturadio.silence as silence
+from capturadio.silence import SilenceDetector, SAMPLE_RATE, CHUNK_SIZE
+
+
+def create_samples(minutes):
+    """One minute of noise, every tenth minute is silent."""
+    noise = array.array('h', (random.randint(-8000, 8000)
+                              for _ in range(SAMPLE_RATE * 60))).tobytes()
+    quiet = bytes(len(noise))
+    return b''.join(quiet if minute % 10 == 9 else noise
+                    for minute in range(minutes))
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--python']:
+        silence.numpy = None
+    elif silence.numpy is None:
+        sys.exit('NumPy is not installed, use --python')
+    minutes = int(args['--minutes'])
+    data = create_samples(minutes)
+
+    start = time.perf_counter()
+    detector = SilenceDetector()
+    view = memoryview(data)
+    for offset in range(0, len(data), CHUNK_SIZE):
+        detector.feed(bytes(view[offset:offset + CHUNK_SIZE]))
+    result = detector.finish()
+    duration = time.perf_counter() - start
+    print('{:d} minutes of audio in {:.2f}s ({:.0f}x realtime), {:d} gaps'
+          .format(minutes, duration, minutes * 60 / duration, len(result['gaps'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the hot paths of capturadio at growing scales.
+
+For every scale the suite creates a configuration with scale * <stations>
+stations and an episodes database with <episodes> episodes per show (half
+of them expired), and measures loading the configuration, generating the
+feeds and pages of all stations and shows, removing the expired episodes
+and scanning the destination like 'recorder config update'. The cost per
+item should not grow with the scale; the suite fails if it grows by more
+than --max-growth between the smallest and the largest scale.
+
+Finally it captures a stream from a local HTTP server that sends at a
+fixed bit rate, and from one that sends as fast as it can.
+
+Usage:
+    bench_suite.py [--stations=<n>] [--shows=<n>] [--episodes=<n>]
+                   [--scales=<list>] [--rate=<kbit>] [--seconds=<n>]
+                   [--max-growth=<f>]
+
+Options:
+    --stations=<n>    Number of stations at scale 1 [default: 2]
+    --shows=<n>       Number of shows per station [default: 10]
+    --episodes=<n>    Number of episodes per show [default: 28]
+    --scales=<list>   Comma separated scales [default: 1,4,16]
+    --rate=<kbit>     Bit rate of the throttled stream [default: 128]
+    --seconds=<n>     Seconds to capture each stream [default: 3]
+    --max-growth=<f>  Allowed growth of the cost per item [default: 3]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capturadio import Configuration, Episode
+from capturadio.database import EpisodeStore
+from capturadio.generator import generate_feed, generate_page, root_entity
+from capturadio.recorder import Recorder
+from capturadio.recorder_cli import _cleanup_database
+from capturadio.scanner import update_episodes
+from benchmarks.bench_render import create_episodes
+
+STREAM_CHUNK = 4096
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Sends an endless mp3 stream, at server.rate bytes per second or
+    unthrottled if the rate is 0."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+        rate = self.server.rate
+        chunk = b'\xff\xfb\x90\x64' + b'\0' * (STREAM_CHUNK - 4)
+        started = time.perf_counter()
+        sent = 0
+        try:
+            while True:
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate > 0:
+                    delay = started + sent / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def setup(folder, stations, shows, episodes):
+    config = Configuration(reset=True, folder=folder,
+                           destination=os.path.join(folder, 'podcasts'))
+    with EpisodeStore(os.path.join(folder, 'episodes.sqlite')) as db:
+        create_episodes(config, db, stations, shows, episodes)
+    config.write_config()
+    return config
+
+
+def bench_scale(folder, stations, shows, episodes):
+    """Return the (name, seconds, items) of every measurement."""
+    results = []
+    setup(folder, stations, shows, episodes)
+
+    start = time.perf_counter()
+    config = Configuration(reset=True, folder=folder)
+    results.append(('config load', time.perf_counter() - start,
+                    len(config.shows)))
+
+    root = root_entity(config)
+    entities = [root] + list(config.stations.values()) + list(config.shows.values())
+    with EpisodeStore(os.path.join(folder, 'episodes.sqlite')) as db:
+        count = len(db)
+        for name, generate in (('generate feed', generate_feed),
+                               ('generate page', generate_page)):
+            start = time.perf_counter()
+            for entity in entities:
+                generate(config, db, entity)
+            results.append((name, time.perf_counter() - start, count))
+
+        mappings = {show.slug: show for show in config.shows.values()}
+        start = time.perf_counter()
+        update_episodes(config, db, mappings, 1)
+        results.append(('config update', time.perf_counter() - start, count))
+
+        start = time.perf_counter()
+        expired, reclaimed = _cleanup_database(db)
+        results.append(('cleanup', time.perf_counter() - start, count))
+    return results
+
+
+def bench_stream(folder, rate, seconds):
+    """Capture from a local stream and return the bytes per second."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+    server.daemon_threads = True
+    server.rate = rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config = Configuration(reset=True, folder=folder,
+                               destination=os.path.join(folder, 'podcasts'))
+        station = config.add_station(
+            'stream', 'http://127.0.0.1:{:d}/'.format(server.server_port), 'Stream')
+        show = config.add_show(station, 'capture', 'Capture', seconds)
+        episode = Episode(config, show)
+        Recorder()._write_stream_to_file(episode)
+        return int(episode.filesize) / episode.duration
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    args = docopt(__doc__)
+    scales = [int(scale) for scale in args['--scales'].split(',')]
+    costs = {}
+    for scale in scales:
+        folder = tempfile.mkdtemp(prefix='capturadio-bench-')
+        try:
+            stations = scale * int(args['--stations'])
+            for name, seconds, items in bench_scale(
+                    folder, stations, int(args['--shows']), int(args['--episodes'])):
+                costs.setdefault(name, []).append(seconds / max(items, 1))
+                print('{:<14} x{:<4d} {:8.3f}s  {:8.1f}us/item  {:d} items'.format(
+                    name, scale, seconds, 1e6 * seconds / max(items, 1), items))
+        finally:
+            shutil.rmtree(folder)
+
+    seconds = int(args['--seconds'])
+    for label, rate in (('throttled', int(args['--rate']) * 1000 // 8),
+                        ('unthrottled', 0)):
+        folder = tempfile.mkdtemp(prefix='capturadio-bench-')
+        try:
+            speed = bench_stream(folder, rate, seconds)
+        finally:
+            shutil.rmtree(folder)
+        print('capture {:<11} {:10.1f} kB/s{}'.format(
+            label, speed / 1000,
+            '  ({:.0%} of the stream rate)'.format(speed / rate) if rate else ''))
+
+    failed = False
+    for name, values in costs.items():
+        growth = values[-1] / values[0] if values[0] > 0 else 0.0
+        if growth > float(args['--max-growth']):
+            print('{}: cost per item grew {:.1f}x from scale {:d} to {:d}'.format(
+                name, growth, scales[0], scales[-1]))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
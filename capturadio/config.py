@@ -2,11 +2,14 @@ import codecs
 import logging
 import os
 import re
+import signal
 import tempfile
 from configparser import RawConfigParser, DEFAULTSECT
 
 from capturadio import Station, Show
-from capturadio.util import parse_duration
+from capturadio.util import parse_duration, parse_size
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
 
 
 class UnicodeConfigParser(RawConfigParser):
@@ -62,6 +65,11 @@ class Configuration(object):   # implements Borg pattern
             'stations': {},
             'shows': {},
             'tempdir': tempfile.gettempdir(),
+            'quota': None,
+            'pipeline_workers': 2,
+            'dedup': False,
+            'metrics': False,
+            'storage': {'backend': 'local'},
             'date_pattern': r"%Y-%m-%d",
             'comment_pattern': '''Show: %(show)s
 Date: %(date)s
@@ -113,7 +121,7 @@ Copyright: %(year)s %(station)s''',
         logging.debug('Enter write_config')
         config = UnicodeConfigParser()
         config.add_section('settings')
-        for key in ('destination', 'date_pattern', 'comment_pattern'):
+        for key in ('destination', 'date_pattern', 'comment_pattern', 'quota'):
             if self.__dict__[key] is not None:
                 val = self.__dict__[key]
                 config.set('settings', key, val)
@@ -180,7 +188,16 @@ Copyright: %(year)s %(station)s''',
                 pattern = config.get('settings', 'comment_pattern', raw=True)
                 pattern = re.sub(r'%([a-z_][a-z_]+)', r'%(\1)s', pattern)
                 self.comment_pattern = pattern
+            if config.has_option('settings', 'quota'):
+                self.quota = parse_size(config.get('settings', 'quota'))
+            if config.has_option('settings', 'pipeline_workers'):
+                self.pipeline_workers = config.getint('settings', 'pipeline_workers')
+            if config.has_option('settings', 'dedup'):
+                self.dedup = config.getboolean('settings', 'dedup')
+            if config.has_option('settings', 'metrics'):
+                self.metrics = config.getboolean('settings', 'metrics')
         self._read_feed_settings(config)
+        self._read_storage_settings(config)
         self._add_stations(config)
         if Configuration.changed_settings:
             import shutil
@@ -188,7 +205,21 @@ Copyright: %(year)s %(station)s''',
             with codecs.open(config_file, 'w', 'utf8') as file:
                 config.write(file)
             print("WARNING: Saved the old version of config file as '%s.bak' and updated configuration." % (config_file))
-
+        self.mtime = os.path.getmtime(config_file)
+
+
+    def _read_storage_settings(self, config):
+        if config.has_section('storage'):
+            storage = dict(self.storage)
+            for key in ('backend', 'endpoint', 'bucket', 'access_key',
+                        'secret_key', 'region', 'prefix'):
+                if config.has_option('storage', key):
+                    storage[key] = config.get('storage', key)
+            if config.has_option('storage', 'part_size'):
+                storage['part_size'] = parse_size(config.get('storage', 'part_size'))
+            if storage['backend'] not in ('local', 's3'):
+                raise Exception('Unknown storage backend "%s".' % storage['backend'])
+            self.storage = storage
 
     def _read_feed_settings(self, config):
         if config.has_section('feed'):
@@ -265,6 +296,12 @@ Copyright: %(year)s %(station)s''',
                 if config.has_option(station_id, 'date_pattern'):
                     station.date_pattern = config.get(station_id, 'date_pattern', raw=True)
 
+                if config.has_option(station_id, 'bitrate'):
+                    station.bitrate = config.getint(station_id, 'bitrate')
+
+                if config.has_option(station_id, 'quota'):
+                    station.quota = parse_size(config.get(station_id, 'quota'))
+
                 self._add_shows(config, station)
 
 
@@ -303,6 +340,99 @@ Copyright: %(year)s %(station)s''',
                 if config.has_option(show_id, 'date_pattern'):
                     show.date_pattern = config.get(show_id, 'date_pattern', raw=True)
 
+                if config.has_option(show_id, 'bitrate'):
+                    show.bitrate = config.getint(show_id, 'bitrate')
+
+                if config.has_option(show_id, 'transcode'):
+                    show.transcode = config.getint(show_id, 'transcode')
+
+                if config.has_option(show_id, 'normalize'):
+                    show.normalize = config.getboolean(show_id, 'normalize')
+
+                if config.has_option(show_id, 'silence_detection'):
+                    detection = config.get(show_id, 'silence_detection')
+                    if detection not in ('flag', 'trim'):
+                        raise Exception('Option "silence_detection" of show "%s" has to be "flag" or "trim".' % show_id)
+                    show.silence_detection = detection
+
+                if config.has_option(show_id, 'start'):
+                    show.start = config.get(show_id, 'start')
+                    if re.match(r'([01]\d|2[0-3]):[0-5]\d$', show.start) is None:
+                        raise Exception('Option "start" of show "%s" has to be a time like 06:30.' % show_id)
+
+                if config.has_option(show_id, 'days'):
+                    show.days = config.get(show_id, 'days').lower().replace(' ', '')
+                    if not set(show.days.split(',')) <= set(WEEKDAYS):
+                        raise Exception('Option "days" of show "%s" has to be a list of %s.' % (show_id, ', '.join(WEEKDAYS)))
+
+
+    def reload(self):
+        """Re-read the configuration file and apply only the differences.
+
+        Stations and shows whose settings did not change keep their existing
+        objects, so running captures that hold a reference to a ``Show`` are
+        not disturbed. Returns a dict with the ids of the added, removed and
+        changed stations and shows."""
+        logging.debug("Enter reload(%s)" % self.filename)
+        state = self.__dict__
+        Configuration._reset()
+        fresh = Configuration._shared_state
+        for key in ('folder', 'filename', 'destination'):
+            fresh[key] = state[key]
+        self.__dict__ = fresh
+        try:
+            self._load_config()
+        finally:
+            self.__dict__ = state
+            Configuration._shared_state = state
+            Configuration._loaded_from_disk = True
+
+        stations = {}
+        for station_id, station in fresh['stations'].items():
+            old = state['stations'].get(station_id)
+            if old is not None and _settings(old) == _settings(station):
+                stations[station_id] = old
+            else:
+                stations[station_id] = station
+
+        shows = {}
+        for show_id, show in fresh['shows'].items():
+            old = state['shows'].get(show_id)
+            station = stations[show.station.id]
+            if old is not None and old.station is station \
+                    and _settings(old) == _settings(show):
+                shows[show_id] = old
+            else:
+                show.station = station
+                shows[show_id] = show
+
+        for station in stations.values():
+            station.shows = [show for show in shows.values()
+                             if show.station is station]
+
+        changes = {
+            'stations': _diff(state['stations'], stations),
+            'shows': _diff(state['shows'], shows),
+        }
+
+        for key, value in fresh.items():
+            if key not in ('stations', 'shows'):
+                state[key] = value
+        state['stations'].clear()
+        state['stations'].update(stations)
+        state['shows'].clear()
+        state['shows'].update(shows)
+        return changes
+
+
+    def reload_if_changed(self):
+        """Reload the configuration if the file was modified since it has
+        been read. Returns the changes or None."""
+        config_file = os.path.expanduser(self.filename)
+        if os.path.getmtime(config_file) != self.__dict__.get('mtime'):
+            return self.reload()
+        return None
+
 
     def set_destination(self, destination):
         if destination is not None:
@@ -335,3 +465,37 @@ Copyright: %(year)s %(station)s''',
         logging.debug(u'    %s' % show)
         self.shows[id] = show
         return show
+
+
+def install_reload_handler(signum=signal.SIGHUP):
+    """Reload the configuration whenever the process receives `signum`."""
+    def _reload(signum, frame):
+        try:
+            changes = Configuration().reload()
+        except Exception as e:
+            logging.error("Could not reload configuration: {}".format(e))
+        else:
+            logging.info("Reloaded configuration: {}".format(changes))
+
+    signal.signal(signum, _reload)
+
+
+def _settings(entity):
+    """Return the comparable settings of a station or show."""
+    settings = {}
+    for key, value in entity.__dict__.items():
+        if key == 'shows' or key.endswith('_escaped'):
+            continue
+        if isinstance(value, Station):
+            value = value.id
+        settings[key] = value
+    return settings
+
+
+def _diff(old, new):
+    return {
+        'added': sorted(new.keys() - old.keys()),
+        'removed': sorted(old.keys() - new.keys()),
+        'changed': sorted(key for key in new.keys() & old.keys()
+                          if new[key] is not old[key]),
+    }
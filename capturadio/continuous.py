@@ -0,0 +1,373 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.continuous records the stream of a station all day
+into rotating segment files and cuts the episodes of its scheduled shows
+(shows with the setting `start`) out of the segments when they ended, so a
+station needs a single upstream connection and overlapping shows come for
+free.
+
+Every segment <start>.mp3 has an index <start>.idx with an (offset, time)
+checkpoint per second, which locates a point in time to the byte; the cut
+is moved to the next MP3 frame. The bytes are copied with
+os.copy_file_range, i.e. without passing through user space, where the
+platform supports it.
+"""
+# -*- coding: utf-8 -*-
+import bisect
+import builtins
+import datetime
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from urllib.request import urlopen
+
+import capturadio.database as database
+from capturadio import app_folder
+from capturadio.config import WEEKDAYS
+from capturadio.dedup import audio_hash, link_duplicate
+from capturadio.entities import Episode
+from capturadio.retention import enforce_quotas, QuotaExceeded
+from capturadio.util import find_mp3_frame
+
+SEGMENT_SECONDS = 900
+CHECKPOINT_SECONDS = 1.0
+READ_SIZE = 10240
+COPY_SIZE = 1 << 20
+MAX_BACKOFF = 5  # reconnect delays grow up to 2 ** 5 seconds
+
+Segment = namedtuple('Segment', 'start filename checkpoints')
+
+
+class SegmentWriter(object):
+    """Writes a stream into segment files of about `segment_seconds`."""
+
+    def __init__(self, folder, segment_seconds=SEGMENT_SECONDS):
+        self.folder = folder
+        self.segment_seconds = segment_seconds
+        self.file = None
+        self.index = None
+        self.size = 0
+        self.rotate_at = 0.0
+        self.checkpoint_at = 0.0
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def write(self, chunk, now):
+        if now >= self.rotate_at:
+            self.rotate(now)
+        self.file.write(chunk)
+        self.size += len(chunk)
+        if now >= self.checkpoint_at:
+            self.index.write('{:d} {:.3f}\n'.format(self.size, now))
+            self.checkpoint_at = now + CHECKPOINT_SECONDS
+
+    def rotate(self, now):
+        """Continue in a new segment starting at `now`."""
+        self.close()
+        name = os.path.join(self.folder, '{:.3f}'.format(now))
+        # Unbuffered, so the segments can be cut while they are written
+        self.file = builtins.open(name + '.mp3', 'wb', buffering=0)
+        self.index = builtins.open(name + '.idx', 'w', buffering=1)
+        self.size = 0
+        self.rotate_at = now + self.segment_seconds
+        self.checkpoint_at = now
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = self.index = None
+
+
+class StationRecorder(object):
+    """Records the stream of a station until it is interrupted and cuts
+    the episodes of the scheduled shows of the station. Only copying the
+    bytes of an episode happens in the read loop; a worker thread stores
+    it and runs the pipeline and `recorder`, which adds the ID3 tags (see
+    capturadio.recorder), so the stream is never left unread for long."""
+
+    def __init__(self, config, station, recorder, folder=None,
+                 segment_seconds=SEGMENT_SECONDS):
+        self.config = config
+        self.station = station
+        self.recorder = recorder
+        self.folder = folder or os.path.join(app_folder, 'segments', station.slug)
+        self.writer = SegmentWriter(self.folder, segment_seconds)
+        self.plan = {}  # show -> (start, end) of its next episode
+        self.due = float('inf')
+        self.worker = None
+        self.loaded = None  # the mtime of the configuration of the plan
+
+    def run(self, until=None):
+        self.replan(time.time())
+        if len(self.plan) == 0:
+            logging.warning("Station {} has no shows with a start time"
+                            .format(self.station.id))
+        self.worker = ThreadPoolExecutor(1)
+        stream = urlopen(self.station.stream_url)
+        failures = 0
+        try:
+            while until is None or time.time() < until:
+                try:
+                    chunk = stream.read(READ_SIZE) if stream is not None else b''
+                except (OSError, HTTPException) as e:
+                    logging.warning("Reading {} failed: {}".format(
+                        self.station.stream_url, e))
+                    chunk = b''
+                now = time.time()
+                if chunk:
+                    failures = 0
+                    if now >= self.writer.rotate_at:
+                        self.config.reload_if_changed()
+                        self.prune(now)
+                    if self.config.__dict__.get('mtime') != self.loaded:
+                        # Reloaded, also on SIGHUP (see config.install_reload_handler)
+                        self.replan(now)
+                    self.writer.write(chunk, now)
+                    if now >= self.due:
+                        self.cut(now)
+                else:
+                    stream = self.recorder.reconnect(
+                        self.station, stream, failures, float('inf'))
+                    failures = min(failures + 1, MAX_BACKOFF)
+                    # Segments are contiguous parts of one connection
+                    self.writer.rotate_at = 0.0
+        except KeyboardInterrupt:
+            logging.warning('Recording interupted.')
+        finally:
+            self.writer.close()
+            if stream is not None:
+                stream.close()
+            self.worker.shutdown(wait=True)
+
+    def replan(self, now):
+        """Plan the next episodes of the scheduled shows of the station,
+        after the configuration was (re)loaded. Planned episodes of shows
+        whose schedule didn't change are kept, even if they started."""
+        self.loaded = self.config.__dict__.get('mtime')
+        station = self.config.stations.get(self.station.id)
+        if station is None:
+            logging.error("Station {} was removed from the configuration"
+                          .format(self.station.id))
+            return
+        self.station = station
+        planned = {show.id: occurrence for show, occurrence in self.plan.items()}
+        self.plan = {}
+        for show in station.shows:
+            if show.start is None:
+                continue
+            occurrence = planned.get(show.id)
+            if occurrence is not None and \
+                    next_occurrence(show, occurrence[0]) == occurrence:
+                self.plan[show] = occurrence
+            else:
+                self._schedule(show, now)
+        self.due = min((end for _, end in self.plan.values()), default=float('inf'))
+
+    def _schedule(self, show, after):
+        occurrence = next_occurrence(show, after)
+        if occurrence is None:
+            self.plan.pop(show, None)
+        else:
+            self.plan[show] = occurrence
+        self.due = min((end for _, end in self.plan.values()), default=float('inf'))
+
+    def cut(self, now):
+        """Cut the episodes of the shows that ended before `now`, hand them
+        to the worker and remove the segments no pending show needs."""
+        segments = load_segments(self.folder)
+        for show, (start, end) in sorted(self.plan.items(), key=lambda item: item[1]):
+            if end > now:
+                continue
+            try:
+                cut = self.cut_episode(show, start, end, segments)
+                if cut is not None:
+                    self.worker.submit(self.store_episode, *cut)
+            except Exception as e:
+                logging.error("Could not cut episode of {}: {}".format(show.id, e))
+            self._schedule(show, end)
+        self.prune(now, segments)
+
+    def prune(self, now, segments=None):
+        """Remove the segments that end before the start of the earliest
+        pending show."""
+        if segments is None:
+            segments = load_segments(self.folder)
+        earliest = min((start for start, _ in self.plan.values()), default=now)
+        prune_segments(segments, earliest)
+
+    def cut_episode(self, show, start, end, segments):
+        """Copy the recording of the show to a temporary file. Returns the
+        episode, the temporary filename and its size, or None."""
+        episode = Episode(self.config, show, time.localtime(start))
+        episode.duration = end - start
+        temp_filename = episode.filename + '.cutting'
+        if not os.path.isdir(os.path.dirname(episode.filename)):
+            os.makedirs(os.path.dirname(episode.filename))
+        size = slice_segments(segments, start, end, temp_filename)
+        if size == 0:
+            os.remove(temp_filename)
+            logging.warning("No recording of {} at {}".format(show.id, episode.pubdate))
+            return None
+        return episode, temp_filename, size
+
+    def store_episode(self, episode, temp_filename, size):
+        """Move the cut episode into place, process it and add it to the
+        episodes database. Runs in the worker thread."""
+        try:
+            try:
+                with database.open('episodes_db') as db:
+                    enforce_quotas(self.config, db, episode.station, size)
+            except QuotaExceeded as e:
+                os.remove(temp_filename)
+                logging.error('Not enough space for episode of {}: {}'.format(
+                    episode.show.id, e))
+                return None
+            os.replace(temp_filename, episode.filename)
+
+            episode.duration_string = str(datetime.timedelta(seconds=int(episode.duration)))
+            episode.filesize = str(size)
+            episode.mimetype = 'audio/mpeg'
+            episode.audio_hash = audio_hash(episode.filename)
+            self.recorder.process(episode)
+            with database.open('episodes_db') as db:
+                with db.transaction():
+                    if self.config.dedup:
+                        link_duplicate(db, episode)
+                    db[episode.slug] = episode
+        except Exception as e:
+            logging.error("Could not store episode {}: {}".format(episode.slug, e))
+            return None
+        logging.info("Cut {} ({:d} bytes) from the recording of {}".format(
+            episode.slug, size, self.station.id))
+        return episode
+
+
+def next_occurrence(show, after):
+    """Return the (start, end) timestamps of the first episode of the
+    scheduled show that starts at or after `after`, or None."""
+    hour, minute = map(int, show.start.split(':'))
+    days = show.days.split(',') if show.days is not None else WEEKDAYS
+    today = datetime.date.fromtimestamp(after)
+    for offset in range(8):
+        date = today + datetime.timedelta(days=offset)
+        if WEEKDAYS[date.weekday()] not in days:
+            continue
+        start = time.mktime(datetime.datetime.combine(
+            date, datetime.time(hour, minute)).timetuple())
+        if start >= after:
+            return start, start + show.duration
+    return None
+
+
+def load_segments(folder):
+    """Return the segments in the folder, the oldest first."""
+    segments = []
+    for name in os.listdir(folder):
+        if not name.endswith('.mp3'):
+            continue
+        base = os.path.join(folder, name[:-4])
+        start = float(name[:-4])
+        checkpoints = [(0, start)]
+        try:
+            with builtins.open(base + '.idx') as index:
+                for line in index:
+                    try:
+                        offset, timestamp = line.split()
+                        checkpoints.append((int(offset), float(timestamp)))
+                    except ValueError:
+                        pass  # incomplete last line
+        except FileNotFoundError:
+            pass
+        segments.append(Segment(start, base + '.mp3', checkpoints))
+    segments.sort()
+    return segments
+
+
+def locate(segments, timestamp):
+    """Return the segment index and the offset of the byte received at
+    `timestamp`, interpolated between the checkpoints."""
+    starts = [segment.start for segment in segments]
+    index = bisect.bisect_right(starts, timestamp) - 1
+    if index < 0:
+        return 0, 0
+    checkpoints = segments[index].checkpoints
+    position = bisect.bisect_right([time for _, time in checkpoints], timestamp)
+    if position == len(checkpoints):
+        return index, checkpoints[-1][0]
+    (offset, time), (next_offset, next_time) = \
+        checkpoints[position - 1], checkpoints[position]
+    if next_time <= time:
+        return index, next_offset
+    return index, offset + int((next_offset - offset) * (timestamp - time)
+                               / (next_time - time))
+
+
+def slice_segments(segments, start, end, filename):
+    """Copy the recording between the timestamps `start` and `end` to a
+    new file, cut at MP3 frames. Returns its size."""
+    first = _align(segments, locate(segments, start))
+    last = _align(segments, locate(segments, end))
+    size = 0
+    with builtins.open(filename, 'wb', buffering=0) as target:
+        for index in range(first[0], min(last[0] + 1, len(segments))):
+            begin = first[1] if index == first[0] else 0
+            stop = last[1] if index == last[0] \
+                else os.path.getsize(segments[index].filename)
+            if stop > begin:
+                with builtins.open(segments[index].filename, 'rb') as source:
+                    size += _copy(source, target, begin, stop - begin)
+    return size
+
+
+def prune_segments(segments, before):
+    """Remove the segments that ended before the timestamp `before`. The
+    last segment is kept, it is still being written."""
+    for segment, following in zip(segments, segments[1:]):
+        if following.start <= before:
+            for filename in (segment.filename, segment.filename[:-4] + '.idx'):
+                try:
+                    os.remove(filename)
+                except OSError as e:
+                    logging.error("Could not remove segment {}: {}".format(filename, e))
+
+
+def _align(segments, position):
+    index, offset = position
+    if index >= len(segments):
+        return position
+    with builtins.open(segments[index].filename, 'rb') as file:
+        file.seek(offset)
+        data = file.read(4096)
+    frame = find_mp3_frame(data)
+    return index, offset + (frame if frame < len(data) else 0)
+
+
+def _copy(source, target, offset, count):
+    """Copy `count` bytes at `offset` of `source` to the end of `target`,
+    inside the kernel if possible. Returns the number of bytes copied."""
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    copied = 0
+    while copied < count:
+        length = 0
+        if copy_file_range is not None:
+            try:
+                length = copy_file_range(source.fileno(), target.fileno(),
+                                         count - copied, offset + copied)
+            except OSError:
+                copy_file_range = None  # e.g. not supported by the filesystem
+        if copy_file_range is None:
+            data = os.pread(source.fileno(), min(count - copied, COPY_SIZE),
+                            offset + copied)
+            target.write(data)
+            length = len(data)
+        if length == 0:
+            break
+        copied += length
+    return copied
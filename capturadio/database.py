@@ -3,67 +3,654 @@ the recorded media files and generate an podcast-like rss feed.
 
  * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
 
-The module capturadio.database provides a simple database backend, based on the
-shelve module.
+The module capturadio.database provides a simple database backend for
+episodes. Episodes are stored pickled in a sqlite database, together with
+some indexed columns (e.g. the expiry time) that allow to query episodes
+without unpickling them. The store behaves like a shelve.
 """
 # -*- coding: utf-8 -*-
+import dbm
 import shelve
+import sqlite3
 import os
-import fcntl
-import types
-import builtins
+import pickle
 import logging
-from fcntl import LOCK_SH, LOCK_EX, LOCK_UN, LOCK_NB
+from collections.abc import MutableMapping
+from time import mktime, perf_counter, time
 
-from capturadio import app_folder
+from capturadio import app_folder, metrics
 
 
-# Based on: https://code.activestate.com/recipes/576591-simple-shelve-with-linux-file-locking/
-def _close_shelve_and_remove_lock(self):
+DEFAULT_ENDURANCE = 14 * 24 * 3600  # two weeks
+DEFAULT_TIMEOUT = 60.0  # seconds a writer waits for another writer
+
+LOCK_WAIT = metrics.REGISTRY.histogram(
+    'capturadio_db_lock_wait_seconds',
+    'Time writes to the episode db waited for the write lock',
+    buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0))
+
+
+
+def _bump_versions(event, row):
+    """Return a trigger that increments the content version of the root,
+    the station and the show of every added or removed episode."""
+    return '''CREATE TRIGGER episodes_{0} AFTER {0} ON episodes BEGIN
+            INSERT INTO versions (slug, version)
+            VALUES ('', 1), ({1}.station, 1), ({2}, 1)
+            ON CONFLICT (slug) DO UPDATE SET version = version + 1;
+        END'''.format(event.lower(), row, _show_slug(row))
+
+
+def _show_slug(row):
+    """Return the expression of the show slug of an episode row."""
+    rest = 'substr({0}.slug, length({0}.station) + 2)'.format(row)
+    return "{0}.station || '/' || substr({1}, 1, instr({1}, '/') - 1)".format(row, rest)
+
+
+def _fill_listing(connection):
+    """Copy the name and the duration of the pickled episodes into their
+    columns, so listings don't have to unpickle them."""
+    rows = connection.execute('SELECT slug, data FROM episodes').fetchall()
+    for slug, data in rows:
+        episode = pickle.loads(data)
+        connection.execute(
+            'UPDATE episodes SET name = ?, duration = ? WHERE slug = ?',
+            (episode.__dict__.get('name'), _duration(episode), slug))
+
+
+def _fill_duplicates(connection):
+    """Copy the duplicate_of slug of the hashed episodes, see
+    capturadio.dedup, into its column."""
+    rows = connection.execute(
+        'SELECT slug, data FROM episodes WHERE audio_hash IS NOT NULL').fetchall()
+    for slug, data in rows:
+        episode = pickle.loads(data)
+        connection.execute(
+            'UPDATE episodes SET duplicate_of = ? WHERE slug = ?',
+            (episode.__dict__.get('duplicate_of'), slug))
+
+
+# Every entry migrates the schema to the next version (PRAGMA user_version),
+# an entry is a SQL statement or a function called with the connection.
+_MIGRATIONS = [
+    [
+        '''CREATE TABLE episodes (
+            slug TEXT PRIMARY KEY,
+            starttime REAL NOT NULL,
+            expires REAL NOT NULL,
+            filename TEXT,
+            filesize INTEGER,
+            data BLOB NOT NULL
+        )''',
+        'CREATE INDEX episodes_expires ON episodes (expires)',
+    ],
+    [
+        'ALTER TABLE episodes ADD COLUMN station TEXT',
+        "UPDATE episodes SET station = substr(slug, 1, instr(slug, '/') - 1)",
+        'CREATE INDEX episodes_station ON episodes (station, filesize)',
+        'CREATE INDEX episodes_starttime ON episodes (starttime)',
+        '''CREATE TABLE reservations (
+            id INTEGER PRIMARY KEY,
+            station TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            expires REAL NOT NULL
+        )''',
+    ],
+    [
+        '''CREATE TABLE manifest (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        )''',
+    ],
+    [
+        '''CREATE TABLE versions (
+            slug TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )''',
+        _bump_versions('INSERT', 'NEW'),
+        _bump_versions('DELETE', 'OLD'),
+    ],
+    [
+        'ALTER TABLE episodes ADD COLUMN audio_hash TEXT',
+        'CREATE INDEX episodes_audio_hash ON episodes (audio_hash)',
+    ],
+    [
+        # Kept apart from the episodes, so feeds never unpickle them
+        '''CREATE TABLE stream_logs (
+            slug TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        )''',
+        '''CREATE TRIGGER stream_logs_delete AFTER DELETE ON episodes BEGIN
+            DELETE FROM stream_logs WHERE slug = OLD.slug;
+        END''',
+    ],
+    [
+        'ALTER TABLE episodes ADD COLUMN show TEXT',
+        'ALTER TABLE episodes ADD COLUMN name TEXT',
+        'ALTER TABLE episodes ADD COLUMN duration REAL',
+        'UPDATE episodes SET show = {}'.format(_show_slug('episodes')),
+        'CREATE INDEX episodes_show ON episodes (show, starttime)',
+        _fill_listing,
+    ],
+    [
+        'CREATE INDEX episodes_station_starttime ON episodes (station, starttime)',
+    ],
+    [
+        # The rendered feed item and page entry, see generator.attach_fragments
+        '''CREATE TABLE fragments (
+            slug TEXT PRIMARY KEY,
+            key TEXT NOT NULL,
+            feed TEXT NOT NULL,
+            page TEXT NOT NULL
+        )''',
+        # INSERT OR REPLACE doesn't fire delete triggers
+        '''CREATE TRIGGER fragments_insert AFTER INSERT ON episodes BEGIN
+            DELETE FROM fragments WHERE slug = NEW.slug;
+        END''',
+        '''CREATE TRIGGER fragments_delete AFTER DELETE ON episodes BEGIN
+            DELETE FROM fragments WHERE slug = OLD.slug;
+        END''',
+    ],
+    [
+        # The slug of the episode whose media file is hard-linked
+        'ALTER TABLE episodes ADD COLUMN duplicate_of TEXT',
+        'CREATE INDEX episodes_duplicate_of ON episodes (duplicate_of)',
+        _fill_duplicates,
+    ],
+]
+
+
+class EpisodeStore(MutableMapping):
+    """A shelve-like mapping of episode slugs to episodes, backed by sqlite.
+
+    Besides the pickled episode every row carries the start time, the
+    expiry time, the filename and the filesize of the episode, so that
+    maintenance tasks like the cleanup of expired episodes only touch the
+    rows they need."""
+
+    def __init__(self, filename, flag='c', protocol=None,
+                 timeout=DEFAULT_TIMEOUT):
+        self.filename = filename
+        self.protocol = protocol
+        self.readonly = flag == 'r'
+        if self.readonly:
+            uri = 'file:{}?mode=ro'.format(filename)
+            self.connection = sqlite3.connect(uri, uri=True, timeout=timeout)
+        else:
+            self.connection = sqlite3.connect(filename, timeout=timeout)
+        self.connection.isolation_level = None  # autocommit, see transaction()
+        if not self.readonly:
+            with _locked_errors(self.connection):
+                # Readers never block the writer and vice versa in WAL mode
+                self.connection.execute('PRAGMA journal_mode = WAL')
+                self._migrate()
+                if flag == 'n':
+                    self.connection.execute('DELETE FROM episodes')
+
+    def _migrate(self):
+        if self._schema_version() == len(_MIGRATIONS):
+            return
+        with self.transaction():
+            version = self._schema_version()
+            for number, statements in enumerate(_MIGRATIONS[version:], version + 1):
+                for statement in statements:
+                    if callable(statement):
+                        statement(self.connection)
+                    else:
+                        self.connection.execute(statement)
+                self.connection.execute('PRAGMA user_version = {:d}'.format(number))
+
+    def _schema_version(self):
+        return self.connection.execute('PRAGMA user_version').fetchone()[0]
+
+    def transaction(self):
+        """Return a context manager that runs the enclosed statements in a
+        single transaction. It takes the write lock when it starts; nested
+        transactions are part of the outer one."""
+        return _Transaction(self.connection)
+
+    def __getitem__(self, slug):
+        row = self.connection.execute(
+            'SELECT data FROM episodes WHERE slug = ?', (slug,)).fetchone()
+        if row is None:
+            raise KeyError(slug)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, slug, episode):
+        row = (
+            slug,
+            mktime(episode.starttime),
+            expiry_time(episode),
+            episode.__dict__.get('filename'),
+            _filesize(episode),
+            slug.split('/')[0],
+            '/'.join(slug.split('/')[:2]),
+            episode.__dict__.get('name'),
+            _duration(episode),
+            episode.__dict__.get('audio_hash'),
+            episode.__dict__.get('duplicate_of'),
+            pickle.dumps(episode, self.protocol),
+        )
+        with _locked_errors(self.connection):
+            self.connection.execute(
+                'INSERT OR REPLACE INTO episodes '
+                '(slug, starttime, expires, filename, filesize, station, show, '
+                'name, duration, audio_hash, duplicate_of, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def __delitem__(self, slug):
+        with _locked_errors(self.connection):
+            cursor = self.connection.execute(
+                'DELETE FROM episodes WHERE slug = ?', (slug,))
+        if cursor.rowcount == 0:
+            raise KeyError(slug)
+
+    def __contains__(self, slug):
+        return self.connection.execute(
+            'SELECT 1 FROM episodes WHERE slug = ?', (slug,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        for (slug,) in self.connection.execute('SELECT slug FROM episodes'):
+            yield slug
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM episodes').fetchone()[0]
+
+    def items(self, prefix=''):
+        """Yield the (slug, episode) pairs, optionally only those below
+        the entity with the slug `prefix`, using the primary key index."""
+        if prefix == '':
+            cursor = self.connection.execute('SELECT slug, data FROM episodes')
+        else:
+            # '0' is the character after '/'
+            cursor = self.connection.execute(
+                'SELECT slug, data FROM episodes WHERE slug >= ? AND slug < ?',
+                (prefix + '/', prefix + '0'))
+        for (slug, data) in cursor:
+            yield slug, pickle.loads(data)
+
+    def newest(self, prefix, key, batch_size=500):
+        """Yield (slug, filename, filesize, fragments, episode) of the
+        episodes below the entity with the slug `prefix` (the root, a
+        station or a show), the newest episode first. `fragments` are the
+        stored (feed, page) fragments rendered with `key`; only episodes
+        without them are unpickled, the others are None.
+
+        Every batch is a query of its own, using the starttime index of the
+        entity, so no statement is pending while the caller writes to the
+        store between batches."""
+        if prefix == '':
+            condition, parameters = '', [key]
+        else:
+            column = 'show' if '/' in prefix else 'station'
+            condition, parameters = 'episodes.{} = ? AND '.format(column), [key, prefix]
+        position = (float('inf'), '')
+        while True:
+            rows = self.connection.execute(
+                'SELECT episodes.slug, starttime, filename, filesize, feed, page, '
+                'CASE WHEN feed IS NULL THEN data END FROM episodes '
+                'LEFT JOIN fragments ON fragments.slug = episodes.slug '
+                'AND fragments.key = ? '
+                'WHERE {}(starttime, episodes.slug) < (?, ?) '
+                'ORDER BY starttime DESC, episodes.slug DESC LIMIT ?'.format(condition),
+                parameters + list(position) + [batch_size]).fetchall()
+            for slug, _, filename, filesize, feed, page, data in rows:
+                if data is None:
+                    yield slug, filename, filesize, (feed, page), None
+                else:
+                    yield slug, filename, filesize, None, pickle.loads(data)
+            if len(rows) < batch_size:
+                return
+            position = (rows[-1][1], rows[-1][0])
+
+    def values(self):
+        for (data,) in self.connection.execute('SELECT data FROM episodes'):
+            yield pickle.loads(data)
+
+    def listing(self, start=None, end=None, limit=None, newest_first=False,
+                station=None, show=None, min_size=None):
+        """Yield (slug, starttime, show, name, filesize, duration, filename)
+        of the episodes that started between the timestamps `start` and
+        `end`, ordered by the start time. The episodes can be restricted to
+        the station or show with the given slug and to a minimum filesize;
+        all filters are optional. The rows are read from the starttime
+        index (or the station or show index), the episodes are not
+        unpickled."""
+        conditions = ['starttime >= ?', 'starttime < ?']
+        parameters = [float('-inf') if start is None else start,
+                      float('inf') if end is None else end]
+        if station is not None:
+            conditions.append('station = ?')
+            parameters.append(station)
+        if show is not None:
+            conditions.append('show = ?')
+            parameters.append(show)
+        if min_size is not None:
+            conditions.append('filesize >= ?')
+            parameters.append(min_size)
+        parameters.append(-1 if limit is None else limit)
+        cursor = self.connection.execute(
+            'SELECT slug, starttime, show, name, filesize, duration, filename '
+            'FROM episodes WHERE {0} ORDER BY starttime {1}, slug {1} LIMIT ?'
+            .format(' AND '.join(conditions), 'DESC' if newest_first else 'ASC'),
+            parameters)
+        rows = cursor.fetchmany()
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany()
+
+    def expired(self, now):
+        """Return (slug, filename, filesize) of all episodes that expired
+        before `now`, using the expiry index."""
+        return self.connection.execute(
+            'SELECT slug, filename, filesize FROM episodes '
+            'WHERE expires < ? ORDER BY expires', (now,)).fetchall()
+
+    def delete_many(self, slugs):
+        """Delete the episodes with the given slugs in one transaction."""
+        with self.transaction():
+            self.connection.executemany(
+                'DELETE FROM episodes WHERE slug = ?',
+                ((slug,) for slug in slugs))
+
+    def oldest(self):
+        """Yield (slug, filename, filesize, station) of all episodes, the
+        oldest episode first."""
+        cursor = self.connection.execute(
+            'SELECT slug, filename, filesize, station FROM episodes '
+            'ORDER BY starttime')
+        rows = cursor.fetchmany()
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany()
+
+    def usage(self, now):
+        """Return the bytes used by the episodes and the reservations that
+        are active at `now`, per station slug. Hard-linked episodes (see
+        links()) use the bytes of their media file once, charged to the
+        first episode of their group."""
+        usage = {}
+        for station, size in self.connection.execute(
+                'SELECT station, TOTAL(filesize) FROM episodes GROUP BY station'):
+            usage[station] = int(size)
+        for station, size in self.connection.execute(
+                'SELECT station, TOTAL(filesize) FROM episodes '
+                'WHERE duplicate_of IS NOT NULL GROUP BY station'):
+            usage[station] -= int(size)
+        # Groups whose original episode is gone are charged to the oldest copy
+        for station, size, _ in self.connection.execute(
+                'SELECT station, filesize, MIN(starttime) FROM episodes '
+                'WHERE duplicate_of NOT IN (SELECT slug FROM episodes) '
+                'GROUP BY duplicate_of'):
+            usage[station] += size or 0
+        for station, size in self.connection.execute(
+                'SELECT station, TOTAL(bytes) FROM reservations '
+                'WHERE expires > ? GROUP BY station', (now,)):
+            usage[station] = usage.get(station, 0) + int(size)
+        return usage
+
+    def reserve(self, station, size, expires):
+        """Reserve `size` bytes for a recording of `station` until
+        `expires`. Returns the id of the reservation."""
+        with self.transaction():
+            self.connection.execute(
+                'DELETE FROM reservations WHERE expires <= ?', (time(),))
+            return self.connection.execute(
+                'INSERT INTO reservations (station, bytes, expires) '
+                'VALUES (?, ?, ?)', (station, size, expires)).lastrowid
+
+    def release(self, reservation):
+        """Release a reservation made with reserve()."""
+        with _locked_errors(self.connection):
+            self.connection.execute(
+                'DELETE FROM reservations WHERE id = ?', (reservation,))
+
+    def with_audio_hash(self, audio_hash):
+        """Return (slug, filename, duplicate_of) of the episodes with the
+        given hash of their audio payload, the oldest episode first."""
+        return self.connection.execute(
+            'SELECT slug, filename, duplicate_of FROM episodes '
+            'WHERE audio_hash = ? ORDER BY starttime', (audio_hash,)).fetchall()
+
+    def duplicates(self):
+        """Return (audio_hash, slug, filename, duplicate_of) of all episodes
+        whose audio payload is shared with another episode, grouped by the
+        hash and the oldest episode of a group first."""
+        return self.connection.execute(
+            'SELECT audio_hash, slug, filename, duplicate_of FROM episodes '
+            'WHERE audio_hash IN (SELECT audio_hash FROM episodes '
+            'WHERE audio_hash IS NOT NULL GROUP BY audio_hash '
+            'HAVING COUNT(*) > 1) ORDER BY audio_hash, starttime').fetchall()
+
+    def links(self):
+        """Return (slug, original, station) of the episodes whose media
+        files are hard-linked, see capturadio.dedup. `original` is the slug
+        all episodes of a group are linked to; it comes first in its
+        group, followed by the copies, the oldest first."""
+        return self.connection.execute(
+            'SELECT slug, COALESCE(duplicate_of, slug), station FROM episodes '
+            'WHERE duplicate_of IS NOT NULL '
+            'OR slug IN (SELECT duplicate_of FROM episodes) '
+            'ORDER BY duplicate_of IS NOT NULL, starttime').fetchall()
+
+    def without_audio_hash(self):
+        """Return the slugs of the episodes without audio_hash."""
+        return [slug for (slug,) in self.connection.execute(
+            'SELECT slug FROM episodes WHERE audio_hash IS NULL')]
+
+    def save_stream_log(self, slug, log):
+        """Store the stream log of a capture (see capturadio.streamlog).
+        It is removed together with the episode."""
+        with _locked_errors(self.connection):
+            self.connection.execute(
+                'INSERT OR REPLACE INTO stream_logs (slug, data) VALUES (?, ?)',
+                (slug, pickle.dumps(log, self.protocol)))
+
+    def stream_logs(self, prefix, limit=None):
+        """Return (slug, starttime, log) of the episodes below the entity
+        with the slug `prefix` that have a stream log, newest first."""
+        rows = self.connection.execute(
+            'SELECT episodes.slug, starttime, stream_logs.data FROM stream_logs '
+            'JOIN episodes ON episodes.slug = stream_logs.slug '
+            'WHERE episodes.slug >= ? AND episodes.slug < ? '
+            'ORDER BY starttime DESC LIMIT ?',
+            (prefix + '/', prefix + '0', -1 if limit is None else limit))
+        return [(slug, starttime, pickle.loads(data))
+                for slug, starttime, data in rows]
+
+    def fragments(self, key, slugs):
+        """Return the stored (feed, page) fragments rendered with `key` of
+        the episodes with the given slugs, by slug."""
+        rows = self.connection.execute(
+            'SELECT slug, feed, page FROM fragments WHERE key = ? AND slug IN '
+            '({})'.format(', '.join('?' * len(slugs))), [key] + list(slugs))
+        return {slug: (feed, page) for slug, feed, page in rows}
+
+    def save_fragments(self, rows):
+        """Store (slug, key, feed, page) rows of rendered fragments."""
+        with self.transaction():
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fragments (slug, key, feed, page) '
+                'VALUES (?, ?, ?, ?)', rows)
+
+    def version(self, slug):
+        """Return the content version of the root (slug ''), a station or
+        a show. The version changes whenever one of its episodes is added,
+        replaced or removed."""
+        row = self.connection.execute(
+            'SELECT version FROM versions WHERE slug = ?', (slug,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def manifest(self):
+        """Return the size and mtime of the files recorded by
+        update_manifest(), keyed by their path."""
+        return {path: (size, mtime) for path, size, mtime in
+                self.connection.execute('SELECT path, size, mtime FROM manifest')}
+
+    def update_manifest(self, rows):
+        """Record the (path, size, mtime) of scanned files."""
+        with _locked_errors(self.connection):
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO manifest (path, size, mtime) '
+                'VALUES (?, ?, ?)', rows)
+
+    def sync(self):
+        if self.connection.in_transaction:
+            self.connection.commit()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.sync()
+        self.connection.close()
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            EpisodeStore.close(self)
+        except Exception:
+            pass
+
+
+class DatabaseLocked(IOError):
+    """Raised if the database is locked by another writer."""
+    pass
+
+
+class _locked_errors(object):
+    """Translate sqlite's "database is locked" errors into DatabaseLocked.
+    Statements outside of a transaction wait for the write lock, so their
+    time is recorded as lock wait time."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.started = None
+
+    def __enter__(self):
+        if not self.connection.in_transaction:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.started is not None:
+            seconds = perf_counter() - self.started
+            LOCK_WAIT.observe(seconds)
+            metrics.log_span('db.lock', seconds)
+        if type is sqlite3.OperationalError and 'locked' in str(value):
+            raise DatabaseLocked(str(value)) from value
+
+
+class _Transaction(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.nested = False
+
+    def __enter__(self):
+        self.nested = self.connection.in_transaction
+        if not self.nested:
+            with _locked_errors(self.connection):
+                self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, type, value, traceback):
+        if self.nested:
+            return
+        if type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+def expiry_time(episode):
+    """Return the timestamp after which the episode can be removed."""
+    endurance = episode.endurance \
+        if 'endurance' in episode.__dict__ \
+        else DEFAULT_ENDURANCE
+    return mktime(episode.starttime) + endurance
+
+
+def _filesize(episode):
+    try:
+        return int(episode.__dict__['filesize'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _duration(episode):
     try:
-        self.orig_close()
-    except OSError as e:
-        logging.error("Could not close shelve: {}".format(e))
+        return float(episode.__dict__['duration'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
+def _import_shelve(filename, store):
+    """Copy the episodes of a legacy shelve database into the store."""
+    if not dbm.whichdb(filename):
+        return
+    logging.warning("Import legacy episodes database {}".format(filename))
+    legacy = shelve.open(filename, 'r')
     try:
-        fcntl.flock(self.lckfile, LOCK_UN)
-    except ValueError as e:
-        pass
+        with store.transaction():
+            for slug, episode in legacy.items():
+                store[slug] = episode
+    finally:
+        legacy.close()
 
+
+def _outdated(filename):
+    """Return True if the schema of the store needs to be migrated."""
+    connection = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
     try:
-        self.lckfile.close()
-    except OSError as e:
-        pass
+        return connection.execute('PRAGMA user_version').fetchone()[0] \
+            < len(_MIGRATIONS)
     finally:
-        if os.path.exists(self.lckfile.name):
-            os.unlink(self.lckfile.name)
+        connection.close()
 
 
-# Based on: https://code.activestate.com/recipes/576591-simple-shelve-with-linux-file-locking/
-def open(dbname, flag='c', protocol=None, writeback=False, block=True):
-    """Open the sheve file, createing a lockfile at filename.lck.  If
-    block is False then a IOError will be raised if the lock cannot
-    be acquired"""
-    filename = os.path.join(app_folder, dbname)
-    lckfilename = filename + ".lck"
-    lckfile = builtins.open(lckfilename, 'w')
+def _empty_store(protocol):
+    """Return a read-only store without episodes."""
+    store = EpisodeStore(':memory:', 'c', protocol)
+    store.readonly = True
+    return store
 
-    # Accquire the lock
+
+def store_path(dbname):
+    """Return the filename of the episode store `dbname`."""
+    return os.path.join(app_folder, dbname + '.sqlite')
+
+
+def open(dbname, flag='c', protocol=None, block=True, timeout=DEFAULT_TIMEOUT):
+    """Open the episode store. Any number of readers and one writer can
+    use the store at the same time. A writer waits up to `timeout` seconds
+    for another writer to finish its transaction; if block is False, then
+    a DatabaseLocked error is raised immediately. An existing shelve
+    database with the same name is imported when the store is created.
+
+    A store opened read-only ('r') is created and migrated first, if
+    needed; if there is neither a store nor a shelve, an empty read-only
+    store is returned."""
+    filename = os.path.join(app_folder, dbname)
+    store_filename = store_path(dbname)
+    created = not os.path.exists(store_filename)
     if flag == 'r':
-        lockflags = LOCK_SH
-    else:
-        lockflags = LOCK_EX
-    if not block:
-        lockflags = LOCK_NB
-    fcntl.flock(lckfile, lockflags)
-
-    # Open the shelf
-    shelf = shelve.open(filename, flag, protocol, writeback)
-
-    # Override close
-    shelf.orig_close = shelf.close
-    shelf.close = types.MethodType(_close_shelve_and_remove_lock, shelf)
-    shelf.lckfile = lckfile
-
-    # And return it
-    return shelf
+        if created and not dbm.whichdb(filename):
+            return _empty_store(protocol)
+        if created or _outdated(store_filename):
+            open(dbname, 'c', protocol, block, timeout).close()
+            created = False
+    with metrics.span('db.open', db=dbname, flag=flag):
+        store = EpisodeStore(store_filename, flag, protocol,
+                             timeout=timeout if block else 0)
+    if created and flag != 'r':
+        _import_shelve(filename, store)
+    return store
@@ -0,0 +1,139 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.dedup finds episodes with identical audio and
+replaces their media files by hard links to a single copy. Episodes are
+compared by a hash of their audio payload, i.e. the media file without
+ID3 tags. The recorder computes the hash while it writes the stream, so
+captured episodes never have to be read again.
+"""
+# -*- coding: utf-8 -*-
+import builtins
+import hashlib
+import logging
+import os
+
+CHUNK_SIZE = 1 << 20
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+def audio_hash(filename):
+    """Return the hash of the audio payload of an mp3 file, skipping an
+    ID3v2 tag at the start and an ID3v1 tag at the end."""
+    digest = new_hash()
+    with builtins.open(filename, 'rb') as file:
+        start, end = _payload_range(file)
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def link_duplicate(db, episode):
+    """Replace the media file of the episode by a hard link to the media
+    file of the oldest other episode with the same audio. Returns the slug
+    of that episode or None. The linked file keeps the ID3 tags of the
+    original."""
+    if episode.__dict__.get('audio_hash') is None:
+        return None
+    for slug, filename, duplicate_of in db.with_audio_hash(episode.audio_hash):
+        if slug != episode.slug and _link(filename, episode.filename):
+            # All copies of a group refer to the same original
+            episode.duplicate_of = duplicate_of or slug
+            episode.filesize = str(os.path.getsize(episode.filename))
+            logging.info("Linked {} to identical {}".format(episode.slug, slug))
+            return slug
+    return None
+
+
+def deduplicate(db, dry_run=False):
+    """Compute missing hashes and hard-link all episodes with identical
+    audio to the oldest one. Returns (original, duplicate, reclaimed bytes)
+    rows; duplicates that are already linked reclaim 0 bytes."""
+    hashed = []
+    for slug in db.without_audio_hash():
+        episode = db[slug]
+        try:
+            episode.audio_hash = audio_hash(episode.filename)
+        except (OSError, TypeError) as e:
+            logging.warning("Could not hash {}: {}".format(episode.filename, e))
+            continue
+        hashed.append(episode)
+    if len(hashed) > 0:
+        with db.transaction():
+            for episode in hashed:
+                db[episode.slug] = episode
+
+    rows = []
+    original = None
+    for digest, slug, filename, duplicate_of in db.duplicates():
+        if original is None or original[0] != digest:
+            original = (digest, slug, filename, duplicate_of or slug)
+            continue
+        reclaimed = _reclaimable(original[2], filename)
+        if reclaimed is None:
+            continue
+        if reclaimed > 0 and not dry_run:
+            if not _link(original[2], filename):
+                continue
+            episode = db[slug]
+            episode.duplicate_of = original[3]
+            episode.filesize = str(os.path.getsize(filename))
+            db[slug] = episode
+        rows.append((original[1], slug, reclaimed))
+    return rows
+
+
+def _reclaimable(original, duplicate):
+    """Return the bytes a hard link would save, 0 if the files are linked
+    already, or None if they cannot be linked."""
+    try:
+        first, second = os.stat(original), os.stat(duplicate)
+    except (OSError, TypeError):
+        return None
+    if first.st_dev != second.st_dev:
+        return None
+    if first.st_ino == second.st_ino:
+        return 0
+    return second.st_size
+
+
+def _link(original, duplicate):
+    if not _reclaimable(original, duplicate):
+        return False
+    temp_filename = duplicate + '.link'
+    try:
+        os.link(original, temp_filename)
+        os.replace(temp_filename, duplicate)
+    except OSError as e:
+        logging.error("Could not link {} to {}: {}".format(duplicate, original, e))
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return False
+    return True
+
+
+def _payload_range(file):
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    file.seek(0)
+    start = 0
+    header = file.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        start = 10 + size + (10 if header[5] & 0x10 else 0)
+    if end - start >= 128:
+        file.seek(end - 128)
+        if file.read(3) == b'TAG':
+            end -= 128
+    return start, max(start, end)
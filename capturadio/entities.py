@@ -39,6 +39,8 @@ class Station(Entity):
             self.endurance = config.feed['endurance']
         self.shows = []
         self.date_pattern = config.date_pattern
+        self.bitrate = 128  # kbit/s, used to estimate the size of episodes
+        self.quota = None
         self.slug = slugify(self.id)
         self.filename = os.path.join(config.destination, self.slug)
 
@@ -65,10 +67,22 @@ class Show(Entity):
         self.author = station.name
         self.duration = duration
         self.endurance = station.endurance
+        self.bitrate = station.bitrate
+        self.transcode = None  # target bitrate in kbit/s
+        self.normalize = False
+        self.silence_detection = None  # 'flag' or 'trim'
+        self.start = None  # 'HH:MM', the schedule of continuous recordings
+        self.days = None  # e.g. 'mon,fri', every day if None
         self.slug = os.path.join(station.slug, slugify(self.id))
         self.filename = os.path.join(config.destination, self.slug)
         station.shows.append(self)
 
+    def expected_filesize(self, duration=None):
+        """Estimate the size in bytes of an episode of this show."""
+        if duration is None:
+            duration = self.duration
+        return int(self.bitrate * 1000 / 8 * duration)
+
     def __repr__(self):
         return 'Show(id=%s, name=%s, duration=%d, station_id=%s)' % (
             self.id, self.name, self.duration, self.station.id)
@@ -79,14 +93,14 @@ class Episode(Entity):
     Describes an episode of a show.
     """
 
-    def __init__(self, config, show):
+    def __init__(self, config, show, starttime=None):
         if not isinstance(show, Show):
             raise TypeError('show has to be of type "Show"')
 
         super(Episode, self).__init__(show.id)
         self.__dict__ = show.__dict__.copy()
 
-        self.starttime = time.localtime()
+        self.starttime = time.localtime() if starttime is None else starttime
         self.show = show
         self.name = "{}, {}".format(show.name, time.strftime(config.date_pattern, self.starttime))
         self.pubdate = time.strftime('%a, %d %b %Y %X %z', self.starttime)
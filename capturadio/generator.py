@@ -1,101 +1,493 @@
 # -*- coding: utf-8 -*-
 """Collection of routines to generate files"""
+import hashlib
+import itertools
 import os
 import time
 import operator
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
 
 import jinja2
 
-from capturadio import version_string
+from capturadio import metrics, version_string, silence
+from capturadio.entities import Station
+from capturadio.storage import open_storage
+from capturadio.util import FileStatCache
+import capturadio.database as database
 
+# The attributes the templates need, see compact()
+ENTITY_ATTRIBUTES = ('id', 'name', 'author', 'slug', 'filename', 'link_url',
+                     'logo_url', 'language')
+ITEM_ATTRIBUTES = ('slug', 'name', 'author', 'link_url', 'logo_url', 'pubdate',
+                   'starttime', 'filesize', 'mimetype', 'duration_string',
+                   'description', 'silence')
 
-def generate_page(config, db, entity):
+# The templates of the feed item and the page entry of an episode, which are
+# rendered once and stored in the db (see attach_fragments)
+FRAGMENT_TEMPLATES = {'feed': 'item.xml.jinja2', 'page': 'item.html.jinja2'}
+FRAGMENT_BATCH = 500
+
+RENDER_SECONDS = metrics.REGISTRY.gauge(
+    'capturadio_render_seconds',
+    'Time the last rendering of the feed or page of an entity took',
+    ('kind', 'entity'))
+FEED_ITEMS = metrics.REGISTRY.gauge(
+    'capturadio_feed_items', 'Items in the feed of an entity', ('entity',))
+
+_environment = None
+
+
+def generate_page(config, db, entity, stats=None):
     """
     Write the list of files and folders (show, station) as HTML file.
+    Returns the number of listed episodes.
     """
-    this_dir = os.path.dirname(__file__)
-    templates_dir = os.path.join(this_dir, 'templates')
-    j2_env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_dir),
-        trim_blocks=True,
-    )
+    if stats is None:
+        stats = FileStatCache()
+    shows = _existing_shows(entity, stats)
+    if len(shows) > 0:
+        render_page(config.feed, entity, shows, [])
+        return 0
+    fragments = _stream_fragments(db, config.feed, entity, stats, 'page', logging.debug)
+    first = next(fragments, None)
+    if first is None:
+        return 0
+    counter = itertools.count()
+    template = _get_environment().get_template('page.html.jinja2')
+    _write_stream(os.path.join(entity.filename, 'index.html'), template.generate(
+        items=_counted(itertools.chain([first], fragments), counter),
+        **_page_context(config.feed, entity, [])))
+    return next(counter)
 
-    shows = []
-    if 'shows' in entity.__dict__:
-        for show in entity.shows:
-            if not os.path.exists(show.filename):
-                logging.debug("Skipping non-existant file {}".format(show.filename))
-            else:
-                shows.append(_escape_string_attributes(show))
 
-    items = []
-    if len(shows) == 0:
-        for (slug, episode) in db.items():
-            if entity.slug == "" or slug.startswith(entity.slug):
-                if not os.path.exists(episode.filename):
-                    logging.debug("Skipping non-existant file {}".format(episode.filename))
-                    continue
-                items.append(_escape_string_attributes(episode))
+def generate_feed(config, db, entity, stats=None):
+    """
+    Write the list of files as RSS formatted file. The episodes are
+    streamed from the db, the newest first, and only a window of them is
+    held in memory, however many episodes the entity has. Returns the
+    number of items.
+    """
+    if stats is None:
+        stats = FileStatCache()
+    fragments = _stream_fragments(db, config.feed, entity, stats, 'feed', logging.warning)
+    first = next(fragments, None)
+    if first is None:
+        return 0
+    counter = itertools.count()
+    template = _get_environment().get_template('feed.xml.jinja2')
+    _write_stream(os.path.join(entity.filename, 'rss.xml'), template.generate(
+        items=_counted(itertools.chain([first], fragments), counter),
+        **_feed_context(config.feed, entity)))
+    return next(counter)
+
+
+def generate_all(config, db, root, stats=None):
+    """Write the feeds and pages of the root, all stations and all shows
+    one after the other, see generate_feed(). Unlike render_tasks() only
+    a window of episodes is held in memory, but the episodes are read
+    once for every entity they belong to."""
+    if stats is None:
+        stats = FileStatCache()
+    for entity in _entities(root):
+        for kind, generate in (('feed', generate_feed), ('page', generate_page)):
+            started = time.perf_counter()
+            items = generate(config, db, entity, stats)
+            _record_render(kind, entity.slug, time.perf_counter() - started, items)
+
 
+def render_page(settings, entity, shows, items):
+    """Write the HTML page of the entity, listing the given shows or items.
+    `settings` are the feed settings of the configuration."""
+    contents = page_contents(settings, entity, shows, items)
+    if contents is not None:
+        _write(os.path.join(entity.filename, 'index.html'), contents)
+
+
+def page_contents(settings, entity, shows, items):
+    """Return the HTML page of the entity, or None if it has neither
+    shows nor items."""
     if len(items) == 0 and len(shows) == 0:
         # logging.warning('Skipped "{}" because of empty db'.format(entity.slug))
-        return
+        return None
 
-    logging.debug("Generating feed for {}".format(entity.slug if entity.slug is not "" else '<root>'))
     items = sorted(items, key=operator.attrgetter('starttime'), reverse=True)
-    contents = j2_env.get_template('page.html.jinja2').render(
+    return _get_environment().get_template('page.html.jinja2').render(
+        items=[_fragment(settings, 'page', item) for item in items],
+        **_page_context(settings, entity, shows))
+
+
+def _page_context(settings, entity, shows):
+    logging.debug("Generating page for {}".format(entity.slug if entity.slug != "" else '<root>'))
+    return dict(
         feed=_escape_string_attributes(entity),
-        shows=shows,
-        items=items,
-        title=config.feed['title'],
-        base_url=config.feed['base_url'],
+        shows=[_escape_string_attributes(show) for show in shows],
+        title=settings['title'],
+        base_url=settings['base_url'],
         build_date=time.strftime('%c', time.localtime()),
         generator='CaptuRadio v{}'.format(version_string),
     )
-    filename = os.path.join(entity.filename, 'index.html')
-    with open(filename, "w") as rssfile:
-        rssfile.write(contents)
 
 
-def generate_feed(config, db, entity):
-    """
-    Write the list of files as RSS formatted file.
-    """
-    this_dir = os.path.dirname(__file__)
-    templates_dir = os.path.join(this_dir, 'templates')
-    j2_env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_dir),
-        trim_blocks=True,
-    )
+def render_feed(settings, entity, items):
+    """Write the RSS feed of the entity, listing the given items.
+    `settings` are the feed settings of the configuration."""
+    contents = feed_contents(settings, entity, items)
+    if contents is not None:
+        _write(os.path.join(entity.filename, 'rss.xml'), contents)
 
-    items = []
-    for (slug, episode) in db.items():
-        if entity.slug == "" or slug.startswith(entity.slug):
-            if not os.path.exists(episode.filename):
-                logging.warning("Skipping non-existant file {}".format(episode.filename))
-                continue
-            items.append(_escape_string_attributes(episode))
 
+def feed_contents(settings, entity, items):
+    """Return the RSS feed of the entity, or None if it has no items."""
     if len(items) == 0:
         # logging.warning('Skipped "{}" because of empty db'.format(entity.slug))
-        return
+        return None
 
-    logging.debug("Generating feed for {}".format(entity.slug if entity.slug is not "" else '<root>'))
     items = sorted(items, key=operator.attrgetter('starttime'), reverse=True)
+    return _get_environment().get_template('feed.xml.jinja2').render(
+        items=[_fragment(settings, 'feed', item) for item in items],
+        **_feed_context(settings, entity))
+
+
+def _feed_context(settings, entity):
+    logging.debug("Generating feed for {}".format(entity.slug if entity.slug != "" else '<root>'))
     slug = entity.slug + ("/" if entity.slug != '' else '') + 'rss.xml'
-    contents = j2_env.get_template('feed.xml.jinja2').render(
+    return dict(
         feed=_escape_string_attributes(entity),
-        items=items,
-        title=config.feed['title'],
-        base_url=config.feed['base_url'],
+        title=settings['title'],
+        base_url=settings['base_url'],
         slug=slug,
         build_date=time.strftime('%a, %d %b %Y %X %z', time.localtime()),
         generator='CaptuRadio v{}'.format(version_string),
     )
-    filename = os.path.join(entity.filename, 'rss.xml')
-    with open(filename, "w") as rssfile:
-        rssfile.write(contents)
+
+
+def root_entity(config):
+    """Return the pseudo station that contains all stations."""
+    root = Station(config, 'root', None, 'All recordings')
+    root.filename = config.destination
+    root.slug = ''
+    root.shows = config.stations.values()
+    return root
+
+
+def render_tasks(config, db, root, stats=None):
+    """Collect the episodes of the root, all stations and all shows in a
+    single pass over the db and return the tasks to render their feeds
+    and pages. Every task only carries the compact items it needs, but
+    the items of all episodes are held in memory; see generate_all()."""
+    if stats is None:
+        stats = FileStatCache()
+    entities = _entities(root)
+
+    items = {entity.slug: [] for entity in entities}
+    collected = [compact(episode, ITEM_ATTRIBUTES) for episode
+                 in _collect_items(db, root, stats, logging.warning)]
+    attach_fragments(db, config.feed, collected)
+    for item in collected:
+        # The fragments are all the tasks need of an item
+        item = SimpleNamespace(slug=item.slug, starttime=item.starttime,
+                               feed_fragment=item.feed_fragment,
+                               page_fragment=item.page_fragment)
+        parts = item.slug.split('/')
+        for slug in ('', parts[0], '/'.join(parts[:2])):
+            if slug in items:
+                items[slug].append(item)
+
+    tasks = []
+    for entity in entities:
+        shows = [compact(show, ENTITY_ATTRIBUTES)
+                 for show in _existing_shows(entity, stats)]
+        feed = compact(entity, ENTITY_ATTRIBUTES)
+        tasks.append(('feed', config.feed, feed, [], items[entity.slug]))
+        tasks.append(('page', config.feed, feed, shows,
+                      [] if len(shows) > 0 else items[entity.slug]))
+    return tasks
+
+
+def run_render_tasks(tasks, jobs=None):
+    """Render the tasks, in a pool of `jobs` processes if jobs > 1."""
+    if jobs is None or jobs <= 1:
+        for task in tasks:
+            _record_render(*_render(task))
+    else:
+        # The workers return their timings, metrics are kept in this process
+        with ProcessPoolExecutor(jobs) as executor:
+            for result in executor.map(_render, tasks, chunksize=16):
+                _record_render(*result)
+
+
+def fragment_key(settings):
+    """Return the key of the fragments rendered with the feed settings. It
+    changes with the settings, the fragment templates and the version of
+    capturadio, which invalidates all stored fragments."""
+    environment = _get_environment()
+    digest = hashlib.sha1(version_string.encode('utf-8'))
+    for name in sorted(FRAGMENT_TEMPLATES.values()):
+        source, _, _ = environment.loader.get_source(environment, name)
+        digest.update(source.encode('utf-8'))
+    digest.update(repr(sorted(settings.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def render_fragment(settings, kind, item):
+    """Return the 'feed' item or the 'page' entry of an episode."""
+    return _get_environment().get_template(FRAGMENT_TEMPLATES[kind]).render(
+        item=_escape_string_attributes(item),
+        base_url=settings['base_url'],
+    )
+
+
+def attach_fragments(db, settings, items):
+    """Set the attributes feed_fragment and page_fragment of the items.
+    The fragments are read from the db; missing or outdated ones are
+    rendered and stored, unless the db is read-only. Storing an episode
+    removes its fragments."""
+    key = fragment_key(settings)
+    for start in range(0, len(items), FRAGMENT_BATCH):
+        batch = items[start:start + FRAGMENT_BATCH]
+        stored = db.fragments(key, [item.slug for item in batch])
+        rendered = []
+        for item in batch:
+            if item.slug in stored:
+                item.feed_fragment, item.page_fragment = stored[item.slug]
+            else:
+                item.feed_fragment = render_fragment(settings, 'feed', item)
+                item.page_fragment = render_fragment(settings, 'page', item)
+                rendered.append((item.slug, key, item.feed_fragment,
+                                 item.page_fragment))
+        if len(rendered) > 0 and not db.readonly:
+            db.save_fragments(rendered)
+
+
+def compact(entity, attributes):
+    """Return a small, cheaply pickled copy of the entity that only has
+    the given attributes."""
+    return SimpleNamespace(**{attr: entity.__dict__[attr] for attr in attributes
+                              if attr in entity.__dict__})
+
+
+class FeedCache(object):
+    """Renders feeds and pages on request instead of writing them to disk.
+
+    The renderings are kept in a bounded LRU cache keyed by the kind, the
+    slug and the content version of the entity (see EpisodeStore.version),
+    so a capture committing an episode invalidates the renderings of its
+    show, its station and the root."""
+
+    def __init__(self, config, filename=None, size=128):
+        self.config = config
+        self.filename = filename or database.store_path('episodes_db')
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def entity(self, slug):
+        """Return the root, station or show with the given slug, or None."""
+        if slug == '':
+            return root_entity(self.config)
+        for entity in list(self.config.stations.values()) + \
+                list(self.config.shows.values()):
+            if entity.slug == slug:
+                return entity
+        return None
+
+    def get(self, kind, slug):
+        """Return the version and the contents (bytes) of the 'feed' or
+        'page' of the entity, or None if there is nothing to show."""
+        entity = self.entity(slug)
+        if entity is None or not os.path.exists(self.filename):
+            return None
+        with database.EpisodeStore(self.filename, 'r') as db:
+            version = db.version(slug)
+            key = (kind, slug, version)
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return version, self.entries[key]
+                self.misses += 1
+            contents = self._render(db, kind, entity)
+
+        with self.lock:
+            self.entries[key] = contents
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return None if contents is None else (version, contents)
+
+    def _render(self, db, kind, entity):
+        started = time.perf_counter()
+        stats = open_storage(self.config).stat_cache()
+        settings = self.config.feed
+        shows = []
+        if kind == 'page':
+            shows = _existing_shows(entity, stats)
+        items = []
+        if len(shows) == 0:
+            # The read-only store can't update changed episodes, their
+            # fragments are rendered again instead of using the stored ones
+            items = list(_stream_fragments(db, settings, entity, stats, kind,
+                                           logging.debug))
+        contents = None
+        if kind == 'feed' and len(items) > 0:
+            contents = _get_environment().get_template('feed.xml.jinja2').render(
+                items=items, **_feed_context(settings, entity))
+        elif kind == 'page' and (len(items) > 0 or len(shows) > 0):
+            contents = _get_environment().get_template('page.html.jinja2').render(
+                items=items, **_page_context(settings, entity, shows))
+        _record_render(kind, entity.slug, time.perf_counter() - started, len(items))
+        return None if contents is None else contents.encode('utf-8')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def _render(task):
+    """Render a task, return its kind, slug, duration and number of items."""
+    kind, settings, entity, shows, items = task
+    started = time.perf_counter()
+    if kind == 'feed':
+        render_feed(settings, entity, items)
+    else:
+        render_page(settings, entity, shows, items)
+    return kind, entity.slug, time.perf_counter() - started, len(items)
+
+
+def _record_render(kind, slug, seconds, items):
+    entity = slug if slug != '' else '<root>'
+    RENDER_SECONDS.set(seconds, kind=kind, entity=entity)
+    metrics.log_span('render', seconds, kind=kind, entity=entity, items=items)
+    if kind == 'feed':
+        FEED_ITEMS.set(items, entity=entity)
+
+
+def _write(filename, contents):
+    _write_stream(filename, [contents])
+
+
+def _write_stream(filename, chunks):
+    """Write the chunks to a temporary file next to `filename` and replace
+    the file when all chunks are written, so readers never see a partial
+    feed. The temporary file is removed if rendering fails."""
+    temp_filename = filename + '.rendering'
+    with metrics.span('write', file=filename):
+        try:
+            with open(temp_filename, "w") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+
+def _get_environment():
+    global _environment
+    if _environment is None:
+        this_dir = os.path.dirname(__file__)
+        templates_dir = os.path.join(this_dir, 'templates')
+        _environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(templates_dir),
+            trim_blocks=True,
+        )
+        _environment.filters['silence_summary'] = silence.summary
+    return _environment
+
+
+def _entities(root):
+    entities = [root]
+    for station in root.shows:
+        entities.append(station)
+        entities.extend(station.shows)
+    return entities
+
+
+def _counted(items, counter):
+    """Yield the items, advancing the counter for each of them."""
+    for item in items:
+        next(counter)
+        yield item
+
+
+def _existing_shows(entity, stats):
+    shows = []
+    if 'shows' in entity.__dict__:
+        for show in entity.shows:
+            if not stats.exists(show.filename):
+                logging.debug("Skipping non-existant file {}".format(show.filename))
+            else:
+                shows.append(show)
+    return shows
+
+
+def _collect_items(db, entity, stats, log):
+    """Return the episodes of the entity whose media file exists. The
+    filesize of episodes whose media file changed is updated in the db."""
+    items = []
+    changed = []
+    for (slug, episode) in db.items(entity.slug):
+        size = stats.getsize(episode.filename)
+        if size is None:
+            log("Skipping non-existant file {}".format(episode.filename))
+            continue
+        if str(size) != episode.__dict__.get('filesize'):
+            episode.filesize = str(size)
+            changed.append(episode)
+        items.append(episode)
+    if len(changed) > 0 and not db.readonly:
+        with db.transaction():
+            for episode in changed:
+                db[episode.slug] = episode
+    return items
+
+
+def _fragment(settings, kind, item):
+    fragment = item.__dict__.get(kind + '_fragment')
+    return render_fragment(settings, kind, item) if fragment is None else fragment
+
+
+def _stream_fragments(db, settings, entity, stats, kind, log):
+    """Yield the fragments of the episodes of the entity whose media file
+    exists, the newest first. Stored fragments are used as they are, the
+    other episodes are rendered in windows of FRAGMENT_BATCH; episodes
+    whose media file changed are updated in the db and rendered again."""
+    key = fragment_key(settings)
+    index = 0 if kind == 'feed' else 1
+    window = []  # fragments and episodes still to be rendered
+    for slug, filename, filesize, fragments, episode in \
+            db.newest(entity.slug, key, FRAGMENT_BATCH):
+        size = stats.getsize(filename)
+        if size is None:
+            log("Skipping non-existant file {}".format(filename))
+            continue
+        if size != filesize:
+            episode = db[slug] if episode is None else episode
+            episode.filesize = str(size)
+            if not db.readonly:
+                db[slug] = episode
+            else:
+                # The stored fragments are outdated, but can't be replaced
+                episode.__dict__[kind + '_fragment'] = \
+                    render_fragment(settings, kind, episode)
+            fragments = None
+        window.append(episode if fragments is None else fragments[index])
+        if len(window) == FRAGMENT_BATCH:
+            yield from _window_fragments(db, settings, window, kind)
+            window = []
+    yield from _window_fragments(db, settings, window, kind)
+
+
+def _window_fragments(db, settings, window, kind):
+    attach_fragments(db, settings, [
+        item for item in window if not isinstance(item, str)
+        and kind + '_fragment' not in item.__dict__])
+    for item in window:
+        yield item if isinstance(item, str) else item.__dict__[kind + '_fragment']
 
 
 def _escape_string_attributes(entity):
@@ -0,0 +1,158 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.journal provides an append-only journal of captures.
+A capture appends a "started" entry before it writes the media file and a
+"finished" entry after the episode has been committed to the episodes
+database. Replaying the journal reveals the captures that never finished,
+so their media files can be recovered without scanning the destination.
+"""
+# -*- coding: utf-8 -*-
+import builtins
+import fcntl
+import json
+import logging
+import os
+from datetime import timedelta
+from time import mktime, time, localtime
+
+from capturadio import app_folder
+from capturadio.entities import Episode
+
+
+class Journal(object):
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(app_folder, 'episodes_journal')
+        self.filename = filename
+
+    def started(self, episode):
+        self._append({
+            'event': 'started',
+            'slug': episode.slug,
+            'show': episode.show.id,
+            'starttime': mktime(episode.starttime),
+            'duration': episode.duration,
+            'filename': episode.filename,
+            'pid': os.getpid(),
+        })
+
+    def finished(self, episode):
+        self._append({'event': 'finished', 'slug': episode.slug})
+
+    def _append(self, entry):
+        """Append an entry with a single write. Entries are appended under
+        a shared lock, so they never get lost by a concurrent compact()."""
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        while True:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if os.fstat(fd).st_ino == _inode(self.filename):
+                    os.write(fd, line)
+                    return
+            finally:
+                os.close(fd)
+
+    def pending(self):
+        """Return the "started" entries without a "finished" entry,
+        keyed by the episode slug."""
+        try:
+            file = builtins.open(self.filename, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return {}
+        with file:
+            return _pending(file)
+
+    def compact(self, resolved=()):
+        """Rewrite the journal, dropping all finished captures and the
+        captures with a slug contained in `resolved`."""
+        while True:
+            try:
+                file = builtins.open(self.filename, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                return
+            with file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                if os.fstat(file.fileno()).st_ino != _inode(self.filename):
+                    continue  # compacted by another process meanwhile
+                entries = _pending(file)
+                temp_filename = self.filename + '.new'
+                with builtins.open(temp_filename, 'w', encoding='utf-8') as temp:
+                    for slug, entry in entries.items():
+                        if slug not in resolved:
+                            temp.write(json.dumps(entry) + '\n')
+                os.rename(temp_filename, self.filename)
+                return
+
+
+def recover(config, db, journal, now=None):
+    """Replay the journal and add the media files of interrupted captures
+    to the episodes database. Captures whose process is still running are
+    left alone. Returns the recovered episodes."""
+    now = time() if now is None else now
+    recovered = []
+    resolved = set()
+    for slug, entry in journal.pending().items():
+        if _is_running(entry) and \
+                now < entry['starttime'] + 2 * entry['duration']:
+            continue
+        resolved.add(slug)
+        if slug in db:
+            continue
+        filename = entry['filename']
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            continue
+        if entry['show'] not in config.shows:
+            logging.warning("Could not recover {}, show {} is unknown"
+                            .format(filename, entry['show']))
+            continue
+
+        logging.warning("Recover interrupted capture {}".format(filename))
+        episode = Episode(config, config.shows[entry['show']],
+                          localtime(entry['starttime']))
+        episode.slug = slug
+        episode.filename = filename
+        episode.duration = int(os.path.getmtime(filename) - entry['starttime'])
+        episode.duration_string = str(timedelta(seconds=episode.duration))
+        episode.filesize = str(os.path.getsize(filename))
+        episode.mimetype = 'audio/mpeg'
+        episode.partial = True
+        db[slug] = episode
+        recovered.append(episode)
+    journal.compact(resolved)
+    return recovered
+
+
+def _pending(file):
+    entries = {}
+    for line in file:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # a torn write of a crashed process
+        if entry['event'] == 'started':
+            entries[entry['slug']] = entry
+        else:
+            entries.pop(entry['slug'], None)
+    return entries
+
+
+def _inode(filename):
+    try:
+        return os.stat(filename).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def _is_running(entry):
+    try:
+        os.kill(entry['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
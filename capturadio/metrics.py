@@ -0,0 +1,253 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.metrics collects counters, gauges and histograms and
+exports them in the Prometheus text format. Every recorder command writes
+its metrics to a file in the textfile collector folder (see
+write_textfile()), 'recorder serve' exports the merged files at /metrics.
+
+Timing spans (see span()) are logged as structured records of the logger
+'capturadio.spans' if it is enabled for DEBUG, e.g. by 'recorder --profile'.
+"""
+# -*- coding: utf-8 -*-
+import bisect
+import builtins
+import glob
+import logging
+import os
+import threading
+import time
+
+import capturadio
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+span_logger = logging.getLogger('capturadio.spans')
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._register(_Metric(name, help, 'counter', labels, self.lock))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(_Metric(name, help, 'gauge', labels, self.lock))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(_Histogram(name, help, labels, self.lock, buckets))
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Return all metrics with at least one sample in the Prometheus
+        text format."""
+        return ''.join(metric.render() for name, metric
+                       in sorted(self.metrics.items()) if metric.children)
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+
+    def __init__(self, name, help, type, labels, lock):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = tuple(labels)
+        self.lock = lock
+        self.children = {}
+
+    def labels(self, **labels):
+        """Return the child for the given label values. Keep the child
+        around in hot loops instead of passing the labels every time."""
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            if key not in self.children:
+                self.children[key] = self._child()
+            return self.children[key]
+
+    def _child(self):
+        return _Value(self.lock)
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for key, child in sorted(self.children.items()):
+            lines.extend(child.samples(self.name, _labels(self.label_names, key)))
+        return '\n'.join(lines) + '\n'
+
+
+class _Histogram(_Metric):
+
+    def __init__(self, name, help, labels, lock, buckets):
+        super(_Histogram, self).__init__(name, help, 'histogram', labels, lock)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _HistogramValue(self.lock, self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+
+class _Value(object):
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return ['{}{} {}'.format(name, _format_labels(labels), _number(self.value))]
+
+
+class _HistogramValue(object):
+
+    def __init__(self, lock, buckets):
+        self.lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            lines.append('{}_bucket{} {:d}'.format(
+                name, _format_labels(labels + [('le', _number(bound))]), total))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _number(self.sum)))
+        lines.append('{}_count{} {:d}'.format(name, _format_labels(labels), total))
+        return lines
+
+
+def textfile_folder():
+    return os.path.join(capturadio.app_folder, 'metrics')
+
+
+class span(object):
+    """Time the enclosed block and log it with log_span(). Costs a single
+    level check if span logging is disabled."""
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.started = None
+
+    def __enter__(self):
+        if span_logger.isEnabledFor(logging.DEBUG):
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.started is not None:
+            log_span(self.name, time.perf_counter() - self.started, **self.fields)
+
+
+def log_span(name, seconds, **fields):
+    """Log a timing span as "span=<name> seconds=<s> key=value ...". The
+    record has the attributes `span`, `seconds` and `fields`."""
+    if not span_logger.isEnabledFor(logging.DEBUG):
+        return
+    span_logger.debug(
+        ' '.join(['span={}'.format(name), 'seconds={:.6f}'.format(seconds)] +
+                 ['{}={}'.format(key, value) for key, value in sorted(fields.items())]),
+        extra={'span': name, 'seconds': seconds, 'fields': fields})
+
+
+def write_textfile(name, registry=REGISTRY, folder=None):
+    """Write the metrics to <folder>/<name>.prom for the textfile collector
+    of the Prometheus node exporter. The file is replaced atomically."""
+    text = registry.render()
+    if text == '':
+        return
+    folder = folder or textfile_folder()
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, name + '.prom')
+    with builtins.open(filename + '.tmp', 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(filename + '.tmp', filename)
+
+
+def collect(registry=REGISTRY, folder=None):
+    """Return the metrics of all textfiles and the registry, merged into
+    one exposition with a single HELP and TYPE line per metric."""
+    folder = folder or textfile_folder()
+    texts = []
+    for filename in sorted(glob.glob(os.path.join(folder, '*.prom'))):
+        try:
+            with builtins.open(filename, encoding='utf-8') as file:
+                texts.append(file.read())
+        except OSError:
+            pass  # replaced meanwhile
+    texts.append(registry.render())
+    return merge(texts)
+
+
+def merge(texts):
+    headers = {}
+    samples = {}
+    for text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                parts = line.split(' ', 3)
+                name = parts[2]
+                headers.setdefault(name, {}).setdefault(parts[1], line)
+                samples.setdefault(name, [])
+            elif line and name is not None:
+                samples[name].append(line)
+    lines = []
+    for name in sorted(headers):
+        lines.extend(headers[name][kind] for kind in ('HELP', 'TYPE')
+                     if kind in headers[name])
+        lines.extend(samples[name])
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _labels(names, values):
+    return list(zip(names, values))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
@@ -0,0 +1,238 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.pipeline re-encodes and loudness-normalizes captured
+media files with an external encoder (ffmpeg, or lame for plain
+re-encoding) after the stream has been written, and finds silence in them
+(see capturadio.silence). Every capture runs in its own process, so the
+number of concurrent encoders is bounded by a set of slot files in the app
+folder that are locked while an encoder runs.
+"""
+# -*- coding: utf-8 -*-
+import datetime
+import fcntl
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from mutagenx.mp3 import MP3
+
+from capturadio import app_folder, metrics, silence
+from capturadio.dedup import audio_hash
+
+LOUDNORM_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+
+EPISODES = metrics.REGISTRY.counter(
+    'capturadio_pipeline_episodes_total',
+    'Episodes processed, analyzed, trimmed or failed by the pipeline',
+    ('result',))
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'capturadio_pipeline_queue_depth',
+    'Captures that waited for an encoder slot with the last episode')
+WAIT_SECONDS = metrics.REGISTRY.counter(
+    'capturadio_pipeline_wait_seconds_total',
+    'Time episodes waited for an encoder slot')
+ENCODE_SECONDS = metrics.REGISTRY.counter(
+    'capturadio_pipeline_encode_seconds_total',
+    'Time the encoders and the silence detection took')
+AUDIO_SECONDS = metrics.REGISTRY.counter(
+    'capturadio_pipeline_audio_seconds_total', 'Audio processed by the pipeline')
+PROCESSED_BYTES = metrics.REGISTRY.counter(
+    'capturadio_pipeline_bytes_total',
+    'Size of the processed episodes before (input) and after (output)',
+    ('direction',))
+THROUGHPUT = metrics.REGISTRY.gauge(
+    'capturadio_pipeline_throughput',
+    'Seconds of audio processed per second of encoding of the last episode')
+
+
+class Pipeline(object):
+    """Re-encodes episodes whose show has the settings `transcode` (the
+    target bitrate in kbit/s) or `normalize`, and detects silence if the
+    show has the setting `silence_detection` ('flag' or 'trim'). At most
+    `workers` encoders run at the same time, in all capture processes."""
+
+    def __init__(self, workers=2, folder=None):
+        self.workers = max(1, workers)
+        self.folder = folder or os.path.join(app_folder, 'pipeline')
+
+    def process(self, episode):
+        """Run the stages the show of the episode asks for: re-encoding and
+        silence detection. Filesize, mimetype and duration of the episode
+        are updated. The original file is kept if the encoder fails."""
+        bitrate = episode.__dict__.get('transcode')
+        normalize = episode.__dict__.get('normalize', False)
+        detection = episode.__dict__.get('silence_detection')
+        if bitrate is None and not normalize and detection is None:
+            return episode
+
+        input_size = os.path.getsize(episode.filename)
+        waiting = time.time()
+        with self.slot() as depth:
+            started = time.time()
+            QUEUE_DEPTH.set(depth)
+            WAIT_SECONDS.inc(started - waiting)
+            changed = False
+            if bitrate is not None or normalize:
+                changed = self._transcode(episode, bitrate, normalize)
+            if detection is not None:
+                changed = self._detect_silence(episode, detection == 'trim') \
+                    or changed
+            encode_seconds = time.time() - started
+            ENCODE_SECONDS.inc(encode_seconds)
+        if not changed:
+            return episode
+
+        duration = MP3(episode.filename).info.length
+        episode.duration = duration
+        episode.duration_string = str(datetime.timedelta(seconds=int(duration)))
+        episode.filesize = str(os.path.getsize(episode.filename))
+        episode.mimetype = 'audio/mpeg'
+        episode.audio_hash = audio_hash(episode.filename)
+        EPISODES.inc(result='processed')
+        AUDIO_SECONDS.inc(duration)
+        PROCESSED_BYTES.inc(input_size, direction='input')
+        PROCESSED_BYTES.inc(int(episode.filesize), direction='output')
+        if encode_seconds > 0:
+            THROUGHPUT.set(duration / encode_seconds)
+        logging.info("Processed {} from {:d} to {} bytes in {:.1f}s, "
+                     "{:d} captures waiting".format(
+                         episode.filename, input_size, episode.filesize,
+                         time.time() - started, depth))
+        return episode
+
+    def _transcode(self, episode, bitrate, normalize):
+        command = encoder_command(episode.filename,
+                                  _temp_filename(episode.filename),
+                                  bitrate, normalize)
+        if command is None:
+            logging.warning("Could not transcode {}: neither ffmpeg nor lame "
+                            "found on PATH".format(episode.filename))
+            return False
+        if not self._run(command, episode.filename):
+            EPISODES.inc(result='failed')
+            return False
+        return True
+
+    def _detect_silence(self, episode, trim):
+        """Store the silent parts of the recording in episode.silence and
+        cut off leading and trailing silence if `trim` is set."""
+        result = silence.analyze(episode.filename)
+        if result is None:
+            return False
+        episode.silence = result
+        EPISODES.inc(result='analyzed')
+        if result['dead_air']:
+            logging.warning("Recording {} is mostly silent".format(episode.filename))
+        if not trim or result['dead_air'] or \
+                result['leading'] == result['trailing'] == 0:
+            return False
+
+        command = silence.trim_command(
+            episode.filename, _temp_filename(episode.filename),
+            result['leading'], result['duration'] - result['trailing'])
+        if not self._run(command, episode.filename):
+            EPISODES.inc(result='failed')
+            return False
+        EPISODES.inc(result='trimmed')
+        # The result describes the trimmed recording
+        result['gaps'] = [(round(start - result['leading'], 1), length)
+                          for start, length in result['gaps']]
+        result['duration'] = round(
+            result['duration'] - result['leading'] - result['trailing'], 1)
+        result['leading'] = result['trailing'] = 0.0
+        return True
+
+    def slot(self):
+        """Return a context manager that waits for a free encoder slot. It
+        yields the number of captures that were waiting for a slot."""
+        return _Slot(self.folder, self.workers)
+
+    def _run(self, command, filename):
+        temp_filename = _temp_filename(filename)
+        try:
+            subprocess.run(command, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           check=True)
+            os.replace(temp_filename, filename)
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            message = e.stderr.decode('utf-8', 'replace').strip() \
+                if isinstance(e, subprocess.CalledProcessError) else e
+            logging.error("Could not transcode {}: {}".format(filename, message))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+
+
+def encoder_command(source, target, bitrate=None, normalize=False):
+    """Return the command line that encodes `source` to an mp3 file
+    `target`, or None if no encoder is installed. Normalization needs
+    ffmpeg."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error',
+                   '-y', '-i', source, '-map_metadata', '-1']
+        if normalize:
+            command += ['-af', LOUDNORM_FILTER]
+        command += ['-codec:a', 'libmp3lame']
+        if bitrate is not None:
+            command += ['-b:a', '{:d}k'.format(bitrate)]
+        return command + ['-f', 'mp3', target]
+
+    lame = shutil.which('lame')
+    if lame is not None and bitrate is not None:
+        if normalize:
+            logging.warning("Normalization needs ffmpeg, only re-encoding {}"
+                            .format(source))
+        return [lame, '--quiet', '--mp3input', '-b', str(bitrate), source, target]
+    return None
+
+
+class _Slot(object):
+
+    def __init__(self, folder, workers):
+        self.folder = folder
+        self.workers = workers
+        self.fd = None
+
+    def __enter__(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        for number in range(self.workers):
+            if self._lock(number, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                return 0
+
+        # All slots are busy: register as waiting and queue up for a slot
+        marker = os.path.join(self.folder, 'waiting.{:d}'.format(os.getpid()))
+        open(marker, 'w').close()
+        try:
+            depth = len(glob.glob(os.path.join(self.folder, 'waiting.*')))
+            self._lock(os.getpid() % self.workers, fcntl.LOCK_EX)
+        finally:
+            os.remove(marker)
+        return depth
+
+    def _lock(self, number, operation):
+        filename = os.path.join(self.folder, 'slot.{:d}'.format(number))
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def __exit__(self, type, value, traceback):
+        os.close(self.fd)  # releases the lock
+        self.fd = None
+
+
+def _temp_filename(filename):
+    return filename + '.transcoding'
@@ -1,7 +1,7 @@
 import datetime
 import logging
-import os
 import time
+from http.client import HTTPException
 from urllib.error import HTTPError, URLError
 from urllib.request import urlopen, Request
 
@@ -10,70 +10,232 @@ from mutagenx._id3frames import \
 from mutagenx.mp3 import MP3
 from mutagenx.id3 import ID3, error
 
+from capturadio import metrics
 from capturadio.config import Configuration
+from capturadio.dedup import new_hash
+from capturadio.storage import LocalStorage
+from capturadio.streamlog import StreamLog
+from capturadio.util import find_mp3_frame
 from capturadio.entities import Episode
 
+READ_SIZE = 10240
+STALL_SECONDS = 2.0  # reads that take longer count as stall
+MAX_RECONNECT_DELAY = 30.0
+MAX_RECONNECTS = 10  # failed reconnects in a row before giving up
+
+CAPTURED_BYTES = metrics.REGISTRY.counter(
+    'capturadio_capture_bytes_total', 'Bytes captured from the stream',
+    ('station', 'show'))
+CAPTURE_RATE = metrics.REGISTRY.gauge(
+    'capturadio_capture_bytes_per_second',
+    'Average bytes per second of the last capture', ('station', 'show'))
+FIRST_BYTE = metrics.REGISTRY.gauge(
+    'capturadio_capture_first_byte_seconds',
+    'Time from opening the stream to its first byte', ('station', 'show'))
+READ_LATENCY = metrics.REGISTRY.histogram(
+    'capturadio_capture_read_seconds', 'Time a read from the stream took',
+    ('station', 'show'))
+STALLS = metrics.REGISTRY.histogram(
+    'capturadio_capture_stall_seconds',
+    'Reads from the stream that took longer than {:.0f}s'.format(STALL_SECONDS),
+    ('station', 'show'), buckets=(5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+RECONNECTS = metrics.REGISTRY.counter(
+    'capturadio_capture_reconnects_total',
+    'Reconnects after the stream ended or failed', ('station', 'show'))
+
 
 class Recorder(object):
 
+    def __init__(self, journal=None, relay=None, pipeline=None, storage=None):
+        self.journal = journal
+        # Where the media files are written, see capturadio.storage
+        self.storage = LocalStorage() if storage is None else storage
+        # Passes the captured chunks to live listeners, see capturadio.relay
+        self.relay = relay
+        # Re-encodes the captured file, see capturadio.pipeline
+        self.pipeline = pipeline
+        # The episodes of the last capture and how the stream behaved in
+        # them (by slug), see capturadio.streamlog
+        self.captured = []
+        self.stream_logs = {}
+
     def capture(self, config, show):
         logging.debug('capture "{}"'.format(show))
-        episode = Episode(config, show)
+        return self.capture_sequence(config, [show])[0]
+
+    def capture_sequence(self, config, shows):
+        """Capture episodes of the shows back to back over one connection
+        to the stream of their station. Returns the captured episodes; if
+        capturing fails, the episodes finished before are in self.captured.
+        They are processed and tagged in either case."""
+        logging.debug('capture {}'.format(', '.join(str(show) for show in shows)))
+        start = time.time()
+        episodes = []
+        for show in shows:
+            episodes.append(Episode(config, show, time.localtime(start)))
+            start += show.duration
         try:
-            self._write_stream_to_file(episode)
-            self._add_metadata(episode)
-            return episode
+            return self._write_stream(episodes)
         except Exception as e:
             logging.error("Could not complete capturing, because an exception occured: {}".format(e))
             raise e
+        finally:
+            for episode in self.captured:
+                self.process(episode)
+
+    def process(self, episode):
+        """Run the pipeline and add the ID3 tags of a captured episode."""
+        if self.storage.local_path(episode.filename) is None:
+            logging.info("Skip processing and ID3 tags of remote {}"
+                         .format(episode.filename))
+            return
+        try:
+            if self.pipeline is not None:
+                self.pipeline.process(episode)
+            self._add_metadata(episode)
+        except Exception as e:
+            logging.error("Could not process {}: {}".format(episode.filename, e))
 
     def _write_stream_to_file(self, episode):
-        not_ready = True
+        return self._write_stream([episode])[0]
+
+    def _write_stream(self, episodes):
+        """Write the stream of the first episode to the media files of the
+        episodes, one after the other. The stream is split at the first MP3
+        frame after the end of an episode, so no audio is lost between
+        them. Finished episodes are appended to self.captured. Returns the
+        captured episodes, fewer than given if capturing was interrupted."""
+        self.captured = []
+        self.stream_logs = {}
+        url = episodes[0].stream_url
         logging.debug("write {} to {}".format(
-            episode.stream_url, episode.filename
-        ))
-        try:
-            dirname = os.path.dirname(episode.filename)
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-
-            with open(episode.filename, 'wb') as file:
-                stream = urlopen(episode.stream_url)
-                starttimestamp = time.mktime(episode.starttime)
-                while not_ready:
-                    try:
-                        file.write(stream.read(10240))
-                        if time.time() - starttimestamp > episode.duration:
+            url, ', '.join(episode.filename for episode in episodes)))
+        starttimestamp = time.mktime(episodes[0].starttime)
+        stream = None
+        pending = b''  # the part of the last chunk after the split
+        failures = 0
+        interrupted = False
+        for index, episode in enumerate(episodes):
+            last = index == len(episodes) - 1
+            end = starttimestamp + episode.duration
+            labels = {'station': episode.station.id, 'show': episode.show.id}
+            # Keep the metric children, looking them up per read is too slow
+            read_latency = READ_LATENCY.labels(**labels)
+            stalls = STALLS.labels(**labels)
+            if self.journal is not None:
+                self.journal.started(episode)
+            try:
+                # The writer removes the media file if capturing fails
+                with self.storage.create(episode.filename) as file:
+                    log = self.stream_logs[episode.slug] = StreamLog(url)
+                    if stream is None:
+                        stream = urlopen(url)
+                    digest = new_hash()
+                    if pending:
+                        file.write(pending)
+                        digest.update(pending)
+                        log.received(log.started, len(pending))
+                    not_ready = True
+                    while not_ready:
+                        try:
+                            started = time.perf_counter()
+                            try:
+                                chunk = stream.read(READ_SIZE) \
+                                    if stream is not None else b''
+                            except (OSError, HTTPException) as e:
+                                logging.warning("Reading {} failed: {}".format(url, e))
+                                chunk = b''
+                            now = time.perf_counter()
+                            elapsed = now - started
+                            wall = time.time()
+                            if chunk:
+                                read_latency.observe(elapsed)
+                                if elapsed > STALL_SECONDS:
+                                    stalls.observe(elapsed)
+                                    log.stalled(now, elapsed)
+                                if index == 0 and log.first_byte is None:
+                                    FIRST_BYTE.set(now - log.started, **labels)
+                                failures = 0
+                                if self.relay is not None:
+                                    self.relay.publish(chunk)
+                                if wall > end and not last:
+                                    # Split where the chunk crossed the end,
+                                    # assuming it arrived during the read
+                                    late = min(1.0, (wall - end) / max(elapsed, 1e-6))
+                                    split = find_mp3_frame(
+                                        chunk, int(len(chunk) * (1.0 - late)))
+                                    chunk, pending = chunk[:split], chunk[split:]
+                                log.received(now, len(chunk))
+                                file.write(chunk)
+                                digest.update(chunk)
+                            elif failures == MAX_RECONNECTS:
+                                logging.error("Giving up on {} after {:d} failed "
+                                              "reconnects".format(url, failures))
+                                not_ready = False
+                                interrupted = True
+                            else:
+                                stream = self.reconnect(episode, stream, failures,
+                                                         end - wall)
+                                failures += 1
+                                RECONNECTS.inc(**labels)
+                                log.reconnected(time.perf_counter())
+                                wall = time.time()
+                            if wall > end:
+                                not_ready = False
+                        except KeyboardInterrupt:
+                            logging.warning('Capturing interupted.')
                             not_ready = False
-                    except KeyboardInterrupt:
-                        logging.warning('Capturing interupted.')
-                        not_ready = False
-
-            episode.duration = time.time() - starttimestamp
-            episode.duration_string = str(datetime.timedelta(seconds=episode.duration))
-            episode.filesize = str(os.path.getsize(episode.filename))
-            episode.mimetype = 'audio/mpeg'
-            return episode
-
-        except UnicodeDecodeError as e:
-            logging.error("Invalid input: {} ({})".format(e.reason, e.object[e.start:e.end]))
-            os.remove(episode.filename)
-            raise e
+                            interrupted = True
 
-        except HTTPError as e:
-            logging.error("Could not open URL {} ({:d}): {}".format(episode.stream_url, e.code, e.msg))
-            os.remove(episode.filename)
-            raise e
+                episode.duration = time.time() - starttimestamp
+                episode.duration_string = str(datetime.timedelta(seconds=episode.duration))
+                episode.filesize = str(file.size)
+                episode.mimetype = 'audio/mpeg'
+                episode.audio_hash = digest.hexdigest()
+                CAPTURED_BYTES.inc(file.size, **labels)
+                if episode.duration > 0:
+                    CAPTURE_RATE.set(file.size / episode.duration, **labels)
+                self.captured.append(episode)
+                starttimestamp = end
 
-        except IOError as e:
-            logging.error("Could not write file {}: {}".format(episode.filename, e))
-            os.remove(episode.filename)
-            raise e
+            except UnicodeDecodeError as e:
+                logging.error("Invalid input: {} ({})".format(e.reason, e.object[e.start:e.end]))
+                raise e
 
-        except Exception as e:
-            logging.error("Could not capture show, because an exception occured: {}".format(e))
-            os.remove(episode.filename)
-            raise e
+            except HTTPError as e:
+                logging.error("Could not open URL {} ({:d}): {}".format(url, e.code, e.msg))
+                raise e
+
+            except IOError as e:
+                logging.error("Could not write file {}: {}".format(episode.filename, e))
+                raise e
+
+            except Exception as e:
+                logging.error("Could not capture show, because an exception occured: {}".format(e))
+                raise e
+
+            if interrupted:
+                break
+        if stream is not None:
+            stream.close()
+        return list(self.captured)
+
+    def reconnect(self, episode, stream, failures, remaining):
+        """Reopen the stream of the episode (or station) after it ended or
+        failed, waiting longer after every failed attempt, but not past the
+        end of the show. Returns the new stream or None."""
+        if stream is not None:
+            stream.close()
+        delay = min(2.0 ** failures, MAX_RECONNECT_DELAY, max(remaining, 0.0))
+        logging.info("Reconnecting to {} in {:.0f}s".format(
+            episode.stream_url, delay))
+        time.sleep(delay)
+        try:
+            return urlopen(episode.stream_url)
+        except (OSError, HTTPException) as e:
+            logging.warning("Could not reconnect to {}: {}".format(
+                episode.stream_url, e))
+            return None
 
     def _add_metadata(self, episode):
         if episode.filename is None:
@@ -136,3 +298,4 @@ class Recorder(object):
             except Exception as e:
                 message = "Error during embedding logo %s - %s" % (url, e)
                 logging.error(message)
+
@@ -16,14 +16,28 @@ import sys
 import os
 import re
 import logging
-from time import time, mktime
+import datetime
+import json
+from itertools import islice
+from time import localtime, mktime, strftime, time
 
 from docopt import docopt
 
-from capturadio import Recorder, Station, version_string as capturadio_version
-from capturadio.config import Configuration
-from capturadio.util import find_configuration, parse_duration, slugify, migrate_mediafile_to_episode
-from capturadio.generator import generate_feed, generate_page
+from capturadio import Recorder, app_folder, metrics, streamlog, \
+    version_string as capturadio_version
+from capturadio.config import Configuration, install_reload_handler
+from capturadio.continuous import StationRecorder
+from capturadio.util import find_configuration, parse_duration, parse_size, \
+    slugify
+from capturadio.generator import generate_all, render_tasks, run_render_tasks, \
+    root_entity, FeedCache
+from capturadio.journal import Journal, recover
+from capturadio.dedup import link_duplicate, deduplicate
+from capturadio.pipeline import Pipeline
+from capturadio.scanner import update_episodes
+from capturadio.retention import enforce_quotas, remove_episodes, \
+    reserve_recording, QuotaExceeded
+from capturadio.storage import open_storage
 import capturadio.database as database
 
 logging.basicConfig(
@@ -34,12 +48,16 @@ logging.basicConfig(
 
 def show_capture(*args):
     """Usage:
-    recorder show capture [--duration=<duration>] [options]
+    recorder show capture <show>... [--duration=<duration>] [--live=<address>] [options]
 
-Capture a show.
+Capture a show. Several shows of the same station are captured one after
+the other over a single connection; the stream is split between their
+episodes without a gap.
 
 Options:
     --duration,-d=<duration> Set the duration, overrides show setting
+    --live=<address>         Relay the capture to listeners while it is
+                             running, at [<host>:]<port>
 
 Examples:
     1. Capture an episode of the show 'nighttalk'
@@ -48,6 +66,12 @@ Examples:
     2. Capture an episode of the show 'nighttalk', but only 35 minutes
         recorder show capture nighttalk -d 35m
 
+    3. Capture the show 'nighttalk' and listen to it at http://<server>:8000/
+        recorder show capture nighttalk --live=0.0.0.0:8000
+
+    4. Capture the news and then the weather forecast
+        recorder show capture news weather
+
     """
     config = Configuration()
     if len(config.stations) == 0:
@@ -58,18 +82,144 @@ Examples:
         print('No shows defined, add shows at first!')
         sys.exit(0)
     args = args[0]
-    if args['<show>'] in config.shows:
-        show = config.shows[args['<show>']]
+    unknown = [id for id in args['<show>'] if id not in config.shows]
+    if len(unknown) > 0:
+        print('Unknown show %r' % unknown[0])
+        return
+    shows = [config.shows[id] for id in args['<show>']]
+    if len(set(show.stream_url for show in shows)) > 1:
+        print('Shows captured together must share the stream of a station')
+        return
+
+    station = shows[0].station
+    try:
+        storage = open_storage(config)
+        with database.open('episodes_db') as db:
+            reservation = reserve_recording(
+                config, db, station,
+                sum(show.expected_filesize() for show in shows),
+                time() + 2 * sum(show.duration for show in shows),
+                storage=storage)
+        journal = Journal()
+        relay = _relay(args['--live']) if args['--live'] else None
+        recorder = Recorder(journal, relay, Pipeline(config.pipeline_workers),
+                            storage)
         try:
-            recorder = Recorder()
-            episode = recorder.capture(config, show)
-            db = database.open('episodes_db')
-            db[episode.slug] = episode
-            db.close()
-        except Exception as e:
-            logging.error('Unable to capture recording: {}'.format(e))
-    else:
-        print('Unknown show %r' % args['<show>'])
+            recorder.capture_sequence(config, shows)
+        finally:
+            if relay is not None:
+                relay.close()
+            # The finished episodes are committed even if a later one failed
+            with database.open('episodes_db') as db:
+                with db.transaction():
+                    db.release(reservation)
+                    for episode in recorder.captured:
+                        if config.dedup:
+                            link_duplicate(db, episode)
+                        db[episode.slug] = episode
+                        if episode.slug in recorder.stream_logs:
+                            db.save_stream_log(
+                                episode.slug,
+                                recorder.stream_logs[episode.slug].to_dict())
+            for episode in recorder.captured:
+                journal.finished(episode)
+    except QuotaExceeded as e:
+        logging.error('Not enough space to capture recording: {}'.format(e))
+    except Exception as e:
+        logging.error('Unable to capture recording: {}'.format(e))
+
+
+def show_stats(args):
+    """Usage:
+    recorder show stats <show> [--last=<n>]
+
+Summarize how the stream of a show behaved in its recent captures: the
+mean and minimum rate, starved seconds (less than half the median rate),
+stalled reads, reconnects and the time to the first byte. The captures are
+grouped by stream URL, to compare the mirrors of a station.
+
+Options:
+    --last=<n>  Number of recent captures [default: 20]
+
+    """
+    config = Configuration()
+    # <show> is repeatable in 'show capture', so docopt returns a list
+    id = args['<show>'][0]
+    if id not in config.shows:
+        print('Unknown show %r' % id)
+        return
+    show = config.shows[id]
+    with database.open('episodes_db', 'r') as db:
+        logs = db.stream_logs(show.slug, int(args['--last'] or 20))
+    if len(logs) == 0:
+        print('No captures of {} with stream statistics.'.format(show.id))
+        return
+
+    by_url = {}
+    print('{:<20} {:>8} {:>9} {:>9} {:>7} {:>7} {:>6} {:>6}'.format(
+        'Capture', 'Duration', 'kB/s', 'Min kB/s', 'Starved', 'Stalls',
+        'Reconn', 'TTFB'))
+    for slug, starttime, log in logs:
+        entry = streamlog.summary(log)
+        by_url.setdefault(entry['url'], []).append(entry)
+        print('{:<20} {:>8} {:>9.1f} {:>9.1f} {:>6d}s {:>7d} {:>6d} {:>6}'.format(
+            strftime('%Y-%m-%d %H:%M', localtime(starttime)),
+            str(datetime.timedelta(seconds=entry['duration'])),
+            entry['mean_rate'] / 1000, entry['min_rate'] / 1000,
+            entry['starved'], entry['stalls'], entry['reconnects'],
+            _seconds(entry['first_byte'])))
+
+    print()
+    for url, summaries in sorted(by_url.items()):
+        total = streamlog.health(summaries)
+        print(url)
+        print('    {:d} captures, {:.1f}h, {:.1f} kB/s, per hour: {:.1f} '
+              'starved seconds, {:.1f} stalls, {:.1f} reconnects, TTFB {}'.format(
+                  total['episodes'], total['hours'], total['mean_rate'] / 1000,
+                  total['starved_per_hour'], total['stalls_per_hour'],
+                  total['reconnects_per_hour'], _seconds(total['first_byte'])))
+
+
+def _seconds(value):
+    return '-' if value is None else '{:.2f}s'.format(value)
+
+
+def _relay(address):
+    from capturadio.relay import Relay
+    host, _, port = address.rpartition(':')
+    return Relay(host or '127.0.0.1', int(port)).start()
+
+
+def station_record(args):
+    """Usage:
+    recorder station record <station> [--segment=<duration>]
+
+Record the stream of a station continuously into segment files and cut
+the episodes of its scheduled shows (the setting "start" and optionally
+"days") out of them when the shows ended. Runs until it is interrupted.
+Changes of the configuration file are picked up when a segment starts,
+send SIGHUP to reload it right away.
+
+Options:
+    --segment=<duration>  Length of a segment file [default: 15m]
+
+Example:
+    recorder station record station1
+
+    """
+    config = Configuration()
+    if args['<station>'] not in config.stations:
+        print('Unknown station %r' % args['<station>'])
+        return
+    if open_storage(config).local_path(config.destination) is None:
+        print('Stations can only be recorded to the destination folder')
+        return
+    station = config.stations[args['<station>']]
+    install_reload_handler()
+    recorder = Recorder(pipeline=Pipeline(config.pipeline_workers))
+    segment_seconds = parse_duration(args['--segment'] or '15m')
+    StationRecorder(config, station, recorder,
+                    segment_seconds=segment_seconds).run()
 
 
 def config_setup(args):
@@ -130,7 +280,8 @@ Show program settings.
 
     print("%s: %s" % ('Configutation file', config.filename))
     for key in ['destination', 'date_pattern', 'comment_pattern', 'folder',
-                'filename', 'tempdir']:
+                'filename', 'tempdir', 'quota', 'pipeline_workers', 'dedup',
+                'metrics']:
         val = config._shared_state[key]
         if key == 'comment_pattern':
             val = val.replace('\n', '\n      ')
@@ -149,9 +300,15 @@ Show program settings.
 
 def config_update(args):
     """Usage:
-    recorder config update
+    recorder config update [--jobs=<n>]
+
+Update program settings and episodes database. Media files in the
+destination folder that are not part of the episodes database are
+migrated into episodes.
 
-Update program settings and episodes database.
+Options:
+    --jobs=<n>  Number of processes reading the media files
+                [default: number of CPUs]
 
     """
     config = Configuration()
@@ -165,29 +322,15 @@ Update program settings and episodes database.
         show_mappings[old_path] = show
         show_mappings[show.slug] = show
 
-    import glob
-
     with database.open('episodes_db') as db:
-        episode_filenames = db.keys()
-        for filename in glob.glob(os.path.join(config.destination, "*", "*", "*.*")):
-            relative_filename = filename.replace(config.destination + '/', '')
-            if filename.endswith('.xml'):
-                continue
-
-            if relative_filename in episode_filenames:
-                continue
-
-            show_slug = os.path.dirname(relative_filename)
-            if show_slug not in show_mappings.keys():
-                logging.warning(
-                    "Could not migrate {} to episode_db".format(filename))
-                continue
+        migrated = update_episodes(config, db, show_mappings, _jobs(args))
+    if migrated:
+        print("Migrated {:d} media files to episodes.".format(migrated))
 
-            logging.info("Migrate {}".format(filename))
 
-            show = show_mappings[show_slug]
-            episode = migrate_mediafile_to_episode(config, filename, show)
-            db[episode.slug] = episode
+def _jobs(args):
+    jobs = args.get('--jobs')
+    return int(jobs) if jobs is not None else None
 
 
 def ignore_folder(dirname, patterns=['.git', '.bzr', 'svn', '.svn', '.hg']):
@@ -200,58 +343,227 @@ def ignore_folder(dirname, patterns=['.git', '.bzr', 'svn', '.svn', '.hg']):
 
 def feed_update(args):
     """Usage:
-    recorder feed update
+    recorder feed update [--jobs=<n>] [--lazy]
 
 Generate rss feed files.
 
+Options:
+    --jobs=<n>  Render the feeds and pages in <n> processes. This holds
+                all episodes in memory, without it they are streamed.
+    --lazy      Only maintain the episodes database, do not render the
+                feeds and pages. Use it if they are rendered on request
+                by 'recorder serve --lazy'.
+
     """
     config = Configuration()
-    root = Station(config, 'root', None, 'All recordings')
-    root.filename = config.destination
-    root.slug = ''
-    root.shows = config.stations.values()
-
+    storage = open_storage(config)
     with database.open('episodes_db') as db:
-        _cleanup_database(db)
+        recover(config, db, Journal())
+        _cleanup_database(db, storage=storage)
+        enforce_quotas(config, db, storage=storage)
         db.sync()
+        if args['--lazy']:
+            return
 
-        generate_feed(config, db, root)
-        generate_page(config, db, root)
-        for station in config.stations.values():
-            generate_feed(config, db, station)
-            generate_page(config, db, station)
-            for show in station.shows:
-                generate_feed(config, db, show)
-                generate_page(config, db, show)
+        jobs = _jobs(args)
+        if jobs is None or jobs <= 1:
+            generate_all(config, db, root_entity(config), storage.stat_cache())
+            return
+        tasks = render_tasks(config, db, root_entity(config),
+                             storage.stat_cache())
+    run_render_tasks(tasks, jobs)
 
 
 def feed_list(args):
     """Usage:
-    recorder feed list
+    recorder feed list [--station=<station>] [--show=<show>] [--from=<date>]
+                       [--to=<date>] [--min-size=<size>] [--missing]
+                       [--last=<n>] [--format=<format>]
+
+List the episodes in the episodes database, the oldest first.
+
+Options:
+    --station=<station>  Only episodes of this station
+    --show=<show>        Only episodes of this show
+    --from=<date>        Only episodes that started on or after this day
+                         (YYYY-MM-DD)
+    --to=<date>          Only episodes that started on or before this day
+    --min-size=<size>    Only episodes of at least this size, e.g. 50M
+    --missing            Only episodes whose media file is missing
+    --last=<n>           Only the latest <n> episodes, the newest first
+    --format=<format>    "table" or "json" (JSON lines) [default: table]
+
+Example:
+    recorder feed list --station=dlf --from=2017-01-01 --min-size=10M
 
-    List all episodes containes in any rss feeds.
     """
+    config = Configuration()
+    output = args['--format'] or 'table'
+    if output not in ('table', 'json'):
+        print('Unknown format %r' % output)
+        return
+    try:
+        filters = _listing_filters(config, args)
+    except (KeyError, ValueError) as e:
+        print('Invalid filter: %s' % e)
+        return
+    limit = int(args['--last']) if args['--last'] else None
+    with database.open('episodes_db', 'r') as db:
+        rows = db.listing(limit=None if args['--missing'] else limit,
+                          newest_first=limit is not None, **filters)
+        if args['--missing']:
+            stat_cache = open_storage(config).stat_cache()
+            rows = islice((row for row in rows
+                           if not stat_cache.exists(row[6])), limit)
+        for row in rows:
+            print(_format_listing(row, output))
+
+
+def _listing_filters(config, args):
+    """Return the arguments of EpisodeStore.listing() for the filter
+    options of 'feed list'."""
+    filters = {}
+    if args['--station']:
+        filters['station'] = config.stations[args['--station']].slug
+    if args['--show']:
+        filters['show'] = config.shows[args['--show']].slug
+    if args['--from']:
+        filters['start'] = _day(args['--from'])
+    if args['--to']:
+        filters['end'] = _day(args['--to']) + 24 * 3600
+    if args['--min-size']:
+        filters['min_size'] = parse_size(args['--min-size'])
+    return filters
+
+
+def _day(value):
+    """Return the timestamp of the start of the local day YYYY-MM-DD."""
+    return mktime(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+
+def _format_listing(row, output):
+    slug, starttime, show, name, filesize, duration, filename = row
+    if output == 'json':
+        return json.dumps({
+            'slug': slug,
+            'starttime': strftime('%Y-%m-%dT%H:%M:%S%z', localtime(starttime)),
+            'show': show,
+            'name': name,
+            'filesize': filesize,
+            'duration': duration,
+            'filename': filename,
+        })
+    return '{}  {:>8}  {:>10}  {}'.format(
+        strftime('%Y-%m-%d %H:%M', localtime(starttime)),
+        str(datetime.timedelta(seconds=int(duration or 0))),
+        '-' if filesize is None else filesize,
+        slug)
+
+
+def feed_cleanup(args):
+    """Usage:
+    recorder feed cleanup [--dry-run]
+
+Remove expired episodes from the episodes database and delete their
+media files. If a quota is exceeded, the oldest episodes are removed, too.
+
+Options:
+    --dry-run   Only report the expired episodes, do not remove them
+
+    """
+    config = Configuration()
+    dry_run = args['--dry-run']
+    now = time()
+    with database.open('episodes_db', 'r' if dry_run else 'c') as db:
+        if not dry_run:
+            recover(config, db, Journal())
+        storage = open_storage(config)
+        # A dry run leaves the expired episodes in place, the quotas are
+        # checked as if they were gone
+        expired = db.expired(now) if dry_run else ()
+        count, reclaimed = _cleanup_database(db, dry_run=dry_run, now=now,
+                                             storage=storage)
+        evictions, evicted = enforce_quotas(config, db, dry_run=dry_run,
+                                            storage=storage, exclude=expired)
+        if dry_run:
+            for slug, filename, filesize, station in evictions:
+                print(slug)
+        count += len(evictions)
+        reclaimed += evicted
+    print("{} {} expired episodes, {} {:d} bytes.".format(
+        'Found' if dry_run else 'Removed',
+        count,
+        'would reclaim' if dry_run else 'reclaimed',
+        reclaimed,
+    ))
+
+
+def feed_dedup(args):
+    """Usage:
+    recorder feed dedup [--dry-run]
+
+Find episodes with identical audio and replace their media files by hard
+links to the oldest copy. Episodes captured while the setting "dedup" is
+enabled are linked right away.
+
+Options:
+    --dry-run   Only report the duplicates, do not link them
+
+    """
+    dry_run = args['--dry-run']
     with database.open('episodes_db') as db:
-        for episode in sorted(db.values()):
-            print("{}: {}".format(episode.slug, episode))
+        rows = deduplicate(db, dry_run)
+    for original, duplicate, reclaimed in rows:
+        print("{} = {} ({:d} bytes)".format(duplicate, original, reclaimed))
+    print("Found {} duplicate episodes, {} {:d} bytes.".format(
+        len(rows),
+        'would reclaim' if dry_run else 'reclaimed',
+        sum(reclaimed for _, _, reclaimed in rows),
+    ))
+
+
+def _cleanup_database(db, dry_run=False, now=None, storage=None):
+    """Remove the expired episodes from the database and delete their media
+    files. Only expired rows are read from the database.
+    Returns the number of expired episodes and the reclaimed bytes."""
+    expired = db.expired(time() if now is None else now)
+    if dry_run:
+        for slug, filename, filesize in expired:
+            print(slug)
+    return len(expired), remove_episodes(db, expired, dry_run, storage=storage)
+
+
+def serve(args):
+    """Usage:
+    recorder serve [--host=<host>] [--port=<port>] [--lazy] [--cache-size=<n>]
+                   [--metrics]
 
+Serve the feeds, pages and media files of the destination folder via HTTP.
+Send SIGHUP to reload the configuration.
 
-def _cleanup_database(db):
-    for slug, episode in db.items():
-        endurance = episode.endurance \
-            if 'endurance' in episode.__dict__ \
-            else parse_duration('14d')
-        if endurance < (time() - mktime(episode.starttime)):
-            del db[slug]
-            try:
-                os.unlink(episode.filename)
-            except OSError as e:
-                logging.error('Could not remove episode media file {}: {}'
-                              .format(episode.slug, e))
+Options:
+    --host=<host>     Address to listen on [default: 127.0.0.1]
+    --port=<port>     Port to listen on [default: 8080]
+    --lazy            Render feeds and pages on request from the episodes
+                      database instead of serving the generated files
+    --cache-size=<n>  Number of rendered feeds and pages to keep in
+                      memory [default: 128]
+    --metrics         Export the metrics of all recorder commands for
+                      Prometheus at /metrics
+
+    """
+    from capturadio.server import serve as run_server
+    config = Configuration()
+    feeds = FeedCache(config, size=int(args['--cache-size'] or 128)) \
+        if args['--lazy'] else None
+    run_server(config, args['--host'] or '127.0.0.1',
+               int(args['--port'] or 8080), feeds,
+               '/metrics' if args['--metrics'] else None)
 
 
 def help(args):
-    cmd = r'%s_%s' % (args['<command>'], args['<action>'])
+    cmd = r'%s_%s' % (args['<command>'], args['<action>']) \
+        if args['<action>'] else args['<command>']
     try:
         print(globals()[cmd].__doc__)
     except KeyError:
@@ -260,11 +572,13 @@ def help(args):
 
 
 def find_command(args):
+    if args['serve']:
+        return 'serve'
     if not args['help']:
-        for command in ['feed', 'config', 'show']:
+        for command in ['feed', 'config', 'show', 'station']:
             if args[command]:
-                for action in ['list', 'update', 'capture', 'show',
-                               'setup', 'cleanup']:
+                for action in ['list', 'update', 'capture', 'stats', 'show',
+                               'setup', 'cleanup', 'dedup', 'record']:
                     if args[action]:
                         return r'%s_%s' % (command, action)
     return 'help'
@@ -275,33 +589,49 @@ def main(argv=None):
 capturadio - Capture internet radio broadcasts in mp3 encoding format.
 
 Usage:
-    recorder help <command> <action>
-    recorder show capture <show>
+    recorder help <command> [<action>]
+    recorder show capture <show>... [--live=<address>]
+    recorder show stats <show> [--last=<n>]
+    recorder station record <station> [--segment=<duration>]
     recorder config list
     recorder config setup
-    recorder config update
-    recorder feed update
-    recorder feed list
+    recorder config update [--jobs=<n>]
+    recorder feed update [--jobs=<n>] [--lazy]
+    recorder feed cleanup [--dry-run]
+    recorder feed dedup [--dry-run]
+    recorder feed list [--station=<station>] [--show=<show>] [--from=<date>]
+                       [--to=<date>] [--min-size=<size>] [--missing]
+                       [--last=<n>] [--format=<format>]
+    recorder serve [--host=<host>] [--port=<port>] [--lazy] [--cache-size=<n>]
+                   [--metrics]
 
 General Options:
     -h, --help        show this screen and exit
     --version         Show version and exit.
+    --profile[=<path>]  Profile the command with cProfile, write the stats
+                      to <path> (default: the folder profiles in the app
+                      folder) and log timing spans.
 
 Commands:
     show capture      Capture an episode of a show
+    show stats        Summarize the stream health of recent captures
+    station record    Record a station and cut its scheduled shows
     config setup      Create configuration file
     config list       Show configuration values
     config update     Update configuration settings and episodes database
     feed update       Update rss feed files
-    feed list         List all episodes contained in any rss feeds
+    feed cleanup      Remove expired episodes and their media files
+    feed dedup        Hard-link the media files of identical episodes
+    feed list         List and filter the episodes
+    serve             Serve feeds and media files via HTTP
 
 See 'recorder.py help <command>' for more information on a specific command."""
 
+    argv, profile = _profile_option(argv or sys.argv[1:])
     args = docopt(
         main.__doc__,
         version=capturadio_version,
-        options_first=True,
-        argv=argv or sys.argv[1:]
+        argv=argv
     )
 
     if len(sys.argv) == 1:
@@ -322,9 +652,62 @@ See 'recorder.py help <command>' for more information on a specific command."""
              cmd.replace('_', ' '))
 
     try:
-        method(args)
+        if profile is not None:
+            _run_profiled(method, args, profile or _profile_filename(cmd))
+        else:
+            method(args)
     except RuntimeError as e:
       exit("ERROR: {}".format(e.message))
+    finally:
+        if cmd not in ('help', 'serve') and Configuration().metrics:
+            _write_metrics(cmd, args)
+
+
+def _profile_option(argv):
+    """Remove the option --profile[=<path>] from the arguments, docopt has
+    no options with optional values. Returns the remaining arguments and
+    the path ('' for the default path) or None."""
+    profile = None
+    remaining = []
+    for arg in argv:
+        if arg == '--profile' or arg.startswith('--profile='):
+            profile = arg.partition('=')[2]
+        else:
+            remaining.append(arg)
+    return remaining, profile
+
+
+def _profile_filename(cmd):
+    return os.path.join(app_folder, 'profiles', '{}-{}.prof'.format(
+        cmd, strftime('%Y%m%d-%H%M%S')))
+
+
+def _run_profiled(method, args, filename):
+    """Run the command in cProfile and log timing spans (see
+    capturadio.metrics.span). The stats can be read with pstats."""
+    import cProfile
+    metrics.span_logger.setLevel(logging.DEBUG)
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(method, args)
+    finally:
+        folder = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        profiler.dump_stats(filename)
+        print("Profile written to {}".format(filename), file=sys.stderr)
+
+
+def _write_metrics(cmd, args):
+    """Write the metrics of the command to the textfile collector folder,
+    captures of different shows to different files."""
+    name = cmd
+    for show in args.get('<show>') or []:
+        name += '_' + slugify(show)
+    try:
+        metrics.write_textfile(name)
+    except OSError as e:
+        logging.error('Could not write metrics: {}'.format(e))
 
 
 if __name__ == "__main__":
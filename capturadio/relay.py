@@ -0,0 +1,138 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.relay lets listeners tune into a capture while it is
+running. The capture loop publishes every chunk it writes to the media
+file, and a small threaded HTTP server streams the chunks to any number of
+listeners with chunked transfer encoding, without opening another
+connection to the station.
+"""
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_QUEUE_SIZE = 256  # chunks of 10 KiB, see Recorder
+
+
+class Relay(object):
+    """Relays the chunks of a running capture to HTTP listeners.
+
+    Every listener has a bounded queue. The capture never waits for a
+    listener: a listener whose queue is full is too slow to keep up with
+    the station and gets disconnected."""
+
+    def __init__(self, host='127.0.0.1', port=0, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.listeners = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dropped = 0
+        self.server = ThreadingHTTPServer((host, port), _RelayHandler)
+        self.server.daemon_threads = True
+        self.server.relay = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{:d}/'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='relay', daemon=True)
+        self.thread.start()
+        logging.warning("Relaying capture at {}".format(self.url))
+        return self
+
+    def subscribe(self):
+        """Return the queue of a new listener, or None if the capture has
+        already finished."""
+        listener = queue.Queue(self.queue_size)
+        with self.lock:
+            if self.closed:
+                return None
+            self.listeners.add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+
+    def is_subscribed(self, listener):
+        with self.lock:
+            return listener in self.listeners
+
+    def publish(self, chunk):
+        """Pass a chunk of the capture to all listeners."""
+        if len(chunk) == 0:
+            return
+        with self.lock:
+            for listener in list(self.listeners):
+                try:
+                    listener.put_nowait(chunk)
+                except queue.Full:
+                    logging.info("Disconnect slow listener of live stream")
+                    self.listeners.discard(listener)
+                    self.dropped += 1
+
+    def close(self):
+        """End the streams of all listeners and stop the server."""
+        with self.lock:
+            self.closed = True
+            for listener in self.listeners:
+                try:
+                    listener.put_nowait(None)
+                except queue.Full:
+                    pass
+            self.listeners.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class _RelayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        relay = self.server.relay
+        if self.path.split('?')[0] != '/':
+            self.send_error(404)
+            return
+        listener = relay.subscribe()
+        if listener is None:
+            self.send_error(404, 'Capture finished')
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            while True:
+                try:
+                    chunk = listener.get(timeout=1.0)
+                except queue.Empty:
+                    if relay.is_subscribed(listener):
+                        continue
+                    break  # disconnected by publish()
+                if chunk is None:
+                    break
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            relay.unsubscribe(listener)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logging.debug("Relay: " + format % args)
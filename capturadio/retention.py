@@ -0,0 +1,138 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.retention removes episodes from the episodes database
+and the disk, either because they expired or because a disk quota would be
+exceeded.
+"""
+# -*- coding: utf-8 -*-
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from capturadio.storage import LocalStorage
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def remove_episodes(db, rows, dry_run=False, batch_size=500, storage=None):
+    """Delete the episodes given as (slug, filename, ...) rows from the
+    database in batched transactions and remove their media files from the
+    storage in a thread pool. Returns the number of reclaimed bytes."""
+    if storage is None:
+        storage = LocalStorage()
+    if not dry_run:
+        for start in range(0, len(rows), batch_size):
+            db.delete_many(row[0] for row in rows[start:start + batch_size])
+    action = storage.reclaimable if dry_run else storage.remove
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return sum(executor.map(action, (row[1] for row in rows)))
+
+
+def plan_evictions(config, db, station=None, reserve=0, now=None, exclude=()):
+    """Return the (slug, filename, filesize, station) rows of the episodes
+    that have to be removed to keep the destination and every station
+    within its quota, oldest episodes first. `reserve` bytes are added to
+    the usage of `station` (a Station) for a recording about to start.
+    The (slug, filename, filesize) rows `exclude` are planned to be
+    removed already, e.g. the expired episodes of a dry run. Removing a
+    hard-linked episode frees its bytes only with the last link."""
+    quotas = {s.slug: s.quota for s in config.stations.values()
+              if s.quota is not None}
+    if config.quota is None and len(quotas) == 0:
+        return []
+
+    usage = db.usage(time() if now is None else now)
+    groups = _link_groups(db)
+    excluded = set()
+    for slug, filename, filesize in exclude:
+        excluded.add(slug)
+        for charged, size in _release(groups, slug, filesize):
+            usage[charged] = usage.get(charged, 0) - size
+    if station is not None:
+        usage[station.slug] = usage.get(station.slug, 0) + reserve
+        quota = quotas.get(station.slug)
+        if quota is not None and reserve > quota:
+            raise QuotaExceeded(
+                'Recording of {:d} bytes exceeds quota of station "{}"'
+                .format(reserve, station.id))
+    if config.quota is not None and reserve > config.quota:
+        raise QuotaExceeded(
+            'Recording of {:d} bytes exceeds quota of destination'
+            .format(reserve))
+
+    excess = {slug: usage.get(slug, 0) - quota
+              for slug, quota in quotas.items()}
+    total_excess = sum(usage.values()) - config.quota \
+        if config.quota is not None else 0
+
+    evictions = []
+    for row in db.oldest():
+        if total_excess <= 0 and all(e <= 0 for e in excess.values()):
+            break
+        slug, filename, filesize, station_slug = row
+        if slug in excluded:
+            continue
+        if total_excess <= 0 and excess.get(station_slug, 0) <= 0:
+            continue
+        evictions.append(row)
+        for charged, size in _release(groups, slug, filesize):
+            total_excess -= size
+            if charged in excess:
+                excess[charged] -= size
+    return evictions
+
+
+def _link_groups(db):
+    """Return the (slug, station) lists of the hard-linked episodes,
+    keyed by every slug of the group. The first episode of a list is
+    charged with the bytes of the group, see EpisodeStore.usage()."""
+    groups = {}
+    by_slug = {}
+    for slug, original, station_slug in db.links():
+        by_slug[slug] = groups.setdefault(original, [])
+        by_slug[slug].append((slug, station_slug))
+    return by_slug
+
+
+def _release(groups, slug, filesize):
+    """Return the (station slug, bytes) that removing the episode frees.
+    The charge of a hard-linked group moves to the next episode until
+    the last one is removed."""
+    station_slug = slug.split('/')[0]
+    members = groups.pop(slug, None)
+    if members is None:
+        return [(station_slug, filesize or 0)]
+    index = next(i for i, member in enumerate(members) if member[0] == slug)
+    members.pop(index)
+    if index > 0:
+        return []
+    if len(members) == 0:
+        return [(station_slug, filesize or 0)]
+    return [(station_slug, filesize or 0), (members[0][1], -(filesize or 0))]
+
+
+def reserve_recording(config, db, station, size, expires, storage=None):
+    """Evict episodes to make room for a recording of `size` bytes of the
+    station and reserve the bytes until `expires`, see enforce_quotas().
+    Both happen in one transaction, so a concurrent recording can't pass
+    the quota check before the reservation exists. Returns the id of the
+    reservation."""
+    with db.transaction():
+        enforce_quotas(config, db, station, size, storage=storage)
+        return db.reserve(station.slug, size, expires)
+
+
+def enforce_quotas(config, db, station=None, reserve=0, dry_run=False,
+                   storage=None, exclude=()):
+    """Evict the oldest episodes until all quotas are met, see
+    plan_evictions(). Returns the evicted rows and the reclaimed bytes."""
+    evictions = plan_evictions(config, db, station, reserve, exclude=exclude)
+    for slug, filename, filesize, station_slug in evictions:
+        logging.info('Evict episode {} ({} bytes)'.format(slug, filesize))
+    return evictions, remove_episodes(db, evictions, dry_run, storage=storage)
@@ -0,0 +1,109 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.scanner finds media files in the destination folder
+that are not yet part of the episodes database and migrates them into
+episodes. Files that could not be migrated are remembered in a manifest
+with their size and mtime, so unchanged files are skipped by later scans.
+"""
+# -*- coding: utf-8 -*-
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from capturadio.util import read_media_tags, migrate_mediafile_to_episode
+
+IGNORED_SUFFIXES = ('.xml', '.html')
+
+
+def walk(destination):
+    """Yield the os.DirEntry of every file in the show folders
+    (<station>/<show>/<file>) below `destination`."""
+    for station in _subfolders(destination):
+        for show in _subfolders(station.path):
+            with os.scandir(show.path) as entries:
+                for entry in entries:
+                    if entry.is_file() and \
+                            not entry.name.endswith(IGNORED_SUFFIXES):
+                        yield entry
+
+
+def find_mediafiles(config, db, show_mappings):
+    """Return the (filename, show) of the media files that are neither in
+    the episodes database nor unchanged since the last scan. Files of an
+    unknown show are recorded in the manifest."""
+    known = set(db)
+    manifest = db.manifest()
+    candidates = []
+    skipped = []
+    for entry in walk(config.destination):
+        relative_filename = os.path.relpath(entry.path, config.destination)
+        if relative_filename in known:
+            continue
+        stat = entry.stat()
+        if manifest.get(relative_filename) == (stat.st_size, stat.st_mtime):
+            continue
+
+        show_slug = os.path.dirname(relative_filename)
+        if show_slug not in show_mappings:
+            logging.warning(
+                "Could not migrate {} to episode_db".format(entry.path))
+            skipped.append((relative_filename, stat.st_size, stat.st_mtime))
+            continue
+        candidates.append((entry.path, show_mappings[show_slug]))
+    db.update_manifest(skipped)
+    return candidates
+
+
+def update_episodes(config, db, show_mappings, jobs=None, batch_size=500):
+    """Migrate new media files into episodes. The ID3 tags are read in a
+    pool of `jobs` worker processes and the episodes are committed in
+    batches. Returns the number of migrated files."""
+    candidates = find_mediafiles(config, db, show_mappings)
+    if len(candidates) == 0:
+        return 0
+
+    migrated = 0
+    batch = []
+    failed = []
+    with ProcessPoolExecutor(jobs) as executor:
+        filenames = [filename for filename, show in candidates]
+        results = executor.map(_read_media_tags, filenames, chunksize=64)
+        for (filename, show), tags in zip(candidates, results):
+            if tags is None:
+                stat = os.stat(filename)
+                failed.append((os.path.relpath(filename, config.destination),
+                               stat.st_size, stat.st_mtime))
+                continue
+            logging.info("Migrate {}".format(filename))
+            batch.append(migrate_mediafile_to_episode(config, filename, show, tags))
+            if len(batch) >= batch_size:
+                migrated += _commit(db, batch)
+    migrated += _commit(db, batch)
+    db.update_manifest(failed)
+    return migrated
+
+
+def _read_media_tags(filename):
+    try:
+        return read_media_tags(filename)
+    except Exception as e:
+        logging.warning("Could not read tags of {}: {}".format(filename, e))
+        return None
+
+
+def _commit(db, episodes):
+    with db.transaction():
+        for episode in episodes:
+            db[episode.slug] = episode
+    count = len(episodes)
+    del episodes[:]
+    return count
+
+
+def _subfolders(path):
+    with os.scandir(path) as entries:
+        return [entry for entry in entries
+                if entry.is_dir() and not entry.name.startswith('.')]
@@ -0,0 +1,341 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.server provides a small asyncio based HTTP server
+that serves the feeds, pages and media files of the destination folder.
+It supports conditional requests (ETag, Last-Modified), range requests
+for the enclosures and sends media files with sendfile. Feeds and pages
+are kept in memory until they change on disk, or are rendered on request
+from the episodes database (see capturadio.generator.FeedCache). The
+metrics of all recorder commands can be exported for Prometheus.
+"""
+# -*- coding: utf-8 -*-
+import asyncio
+import builtins
+import email.utils
+import logging
+import mimetypes
+import os
+import re
+import signal
+from urllib.parse import unquote, urlsplit
+
+from capturadio import metrics, version_string
+
+CACHED_FILES = ('rss.xml', 'index.html')
+RENDERED_FILES = {'feed': 'rss.xml', 'page': 'index.html'}
+CONTENT_TYPES = {
+    'rss.xml': 'application/rss+xml; charset=utf-8',
+    'index.html': 'text/html; charset=utf-8',
+}
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+}
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+CACHE_REQUESTS = metrics.REGISTRY.gauge(
+    'capturadio_feed_cache_requests',
+    'Requests for rendered feeds and pages by cache result', ('result',))
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, headers=None):
+        super(HttpError, self).__init__(REASONS[status])
+        self.status = status
+        self.headers = headers or {}
+
+
+class FeedServer(object):
+    """Serves the files below config.destination."""
+
+    def __init__(self, config, feeds=None, metrics_path=None):
+        self.config = config
+        self.cache = {}
+        # Render feeds and pages on request, see generator.FeedCache
+        self.feeds = feeds
+        # Export metrics at this path, see capturadio.metrics
+        self.metrics_path = metrics_path
+        self.generation = 0
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = await _read_headers(reader)
+                keep_alive = await self.handle_request(
+                    request_line.decode('latin-1'), headers, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_request(self, request_line, headers, writer):
+        """Answer a single request. Returns True if the connection can be
+        used for the next request."""
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        try:
+            method, target, version = request_line.split()
+        except ValueError:
+            await self.send_error(writer, HttpError(400), False)
+            return False
+        if version == 'HTTP/1.0':
+            keep_alive = headers.get('connection', '').lower() == 'keep-alive'
+
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise HttpError(405, {'Allow': 'GET, HEAD'})
+            if self.metrics_path is not None and \
+                    urlsplit(target).path == self.metrics_path:
+                await self.send_metrics(writer, headers, method == 'HEAD',
+                                        keep_alive)
+                return keep_alive
+            if self.feeds is not None:
+                kind, slug = _rendered_target(target)
+                if await self.send_rendered(writer, kind, slug, headers,
+                                            method == 'HEAD', keep_alive):
+                    return keep_alive
+            filename = self.resolve(target)
+            try:
+                await self.send_file(writer, filename, headers,
+                                     method == 'HEAD', keep_alive)
+            except FileNotFoundError:
+                raise HttpError(404)
+        except HttpError as e:
+            await self.send_error(writer, e, keep_alive)
+        return keep_alive
+
+    def resolve(self, target):
+        """Map the request target to a file below the destination."""
+        root = os.path.realpath(self.config.destination)
+        path = unquote(urlsplit(target).path)
+        filename = os.path.realpath(os.path.join(root, path.lstrip('/')))
+        if filename != root and not filename.startswith(root + os.sep):
+            raise HttpError(404)
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, 'index.html')
+        if not os.path.isfile(filename):
+            raise HttpError(404)
+        return filename
+
+    async def send_file(self, writer, filename, request_headers, head, keep_alive):
+        stat = os.stat(filename)
+        headers = {
+            'Content-Type': _content_type(filename),
+            'ETag': '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size),
+            'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+        }
+        body = filename
+        if os.path.basename(filename) in CACHED_FILES:
+            body = self.cached(filename, headers['ETag'])
+        await self.send_body(writer, body, stat.st_size, headers,
+                             request_headers, head, keep_alive, stat.st_mtime)
+
+    async def send_rendered(self, writer, kind, slug, request_headers, head,
+                            keep_alive):
+        """Send a feed or page rendered by the FeedCache. Returns False if
+        there is nothing to render for the entity."""
+        if self.feeds.entity(slug) is None:
+            return False
+        rendered = await asyncio.get_running_loop().run_in_executor(
+            None, self.feeds.get, kind, slug)
+        if rendered is None:
+            return False
+        version, contents = rendered
+        headers = {
+            'Content-Type': CONTENT_TYPES[RENDERED_FILES[kind]],
+            'ETag': 'W/"{}-{:x}-{:x}"'.format(kind, version, self.generation),
+        }
+        await self.send_body(writer, contents, len(contents), headers,
+                             request_headers, head, keep_alive)
+        return True
+
+    async def send_metrics(self, writer, request_headers, head, keep_alive):
+        """Send the metrics of this server and the textfiles written by the
+        other recorder commands."""
+        if self.feeds is not None:
+            CACHE_REQUESTS.set(self.feeds.hits, result='hit')
+            CACHE_REQUESTS.set(self.feeds.misses, result='miss')
+        contents = (await asyncio.get_running_loop().run_in_executor(
+            None, metrics.collect)).encode('utf-8')
+        headers = {
+            'Content-Type': metrics.CONTENT_TYPE,
+            'ETag': '"{:x}"'.format(hash(contents) & 0xffffffffffffffff),
+            'Cache-Control': 'no-cache',
+        }
+        await self.send_body(writer, contents, len(contents), headers,
+                             request_headers, head, keep_alive)
+
+    async def send_body(self, writer, body, size, headers, request_headers,
+                        head, keep_alive, mtime=None):
+        """Answer a request for `body`, either bytes or the name of a file
+        that is sent with sendfile, honoring conditional and range
+        requests."""
+        etag = headers['ETag']
+        headers['Accept-Ranges'] = 'bytes'
+        if _not_modified(request_headers, etag, mtime):
+            await self.send_response(writer, 304, headers, keep_alive)
+            return
+
+        status = 200
+        start, end = 0, size
+        if 'range' in request_headers and \
+                request_headers.get('if-range', etag) == etag:
+            start, end = _parse_range(request_headers['range'], size)
+            status = 206
+            headers['Content-Range'] = 'bytes {:d}-{:d}/{:d}'.format(
+                start, end - 1, size)
+        headers['Content-Length'] = str(end - start)
+        await self.send_response(writer, status, headers, keep_alive)
+        if head:
+            return
+
+        if isinstance(body, bytes):
+            writer.write(body[start:end])
+            await writer.drain()
+        else:
+            with builtins.open(body, 'rb') as file:
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, file, start, end - start)
+
+    def reload(self):
+        """Reload the configuration, the renderings depend on it."""
+        try:
+            changes = self.config.reload()
+        except Exception as e:
+            logging.error("Could not reload configuration: {}".format(e))
+            return
+        logging.info("Reloaded configuration: {}".format(changes))
+        if self.feeds is not None:
+            self.feeds.clear()
+        self.generation += 1
+
+    def cached(self, filename, etag):
+        """Return the contents of a feed or page, read from disk only if
+        the file changed."""
+        entry = self.cache.get(filename)
+        if entry is None or entry[0] != etag:
+            with builtins.open(filename, 'rb') as file:
+                entry = (etag, file.read())
+            self.cache[filename] = entry
+        return entry[1]
+
+    async def send_response(self, writer, status, headers, keep_alive):
+        lines = ['HTTP/1.1 {:d} {}'.format(status, REASONS[status])]
+        headers = dict(headers)
+        headers['Server'] = 'CaptuRadio/{}'.format(version_string)
+        headers['Date'] = email.utils.formatdate(usegmt=True)
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        if status == 304:
+            headers.pop('Content-Length', None)
+        for key, value in headers.items():
+            lines.append('{}: {}'.format(key, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_error(self, writer, error, keep_alive):
+        body = '{:d} {}\n'.format(error.status, REASONS[error.status]).encode('utf-8')
+        headers = dict(error.headers)
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        await self.send_response(writer, error.status, headers, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+
+def serve(config, host='127.0.0.1', port=8080, feeds=None, metrics_path=None):
+    """Run the server until it is interrupted. SIGHUP reloads the
+    configuration. If a FeedCache is given, feeds and pages are rendered
+    on request. Metrics are exported at `metrics_path` if it is set."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = FeedServer(config, feeds, metrics_path)
+    listener = loop.run_until_complete(server.start(host, port))
+    loop.add_signal_handler(signal.SIGHUP, server.reload)
+    logging.warning("Serving {} at http://{}:{:d}/".format(
+        config.destination, host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        loop.close()
+
+
+def _rendered_target(target):
+    """Return the kind ('feed' or 'page') and the slug of the entity a
+    request could refer to. Requests for folders refer to their page."""
+    path = unquote(urlsplit(target).path).strip('/')
+    folder, _, name = path.rpartition('/')
+    if name == 'rss.xml':
+        return 'feed', folder
+    if name == 'index.html':
+        return 'page', folder
+    return 'page', path
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+
+def _content_type(filename):
+    basename = os.path.basename(filename)
+    if basename in CONTENT_TYPES:
+        return CONTENT_TYPES[basename]
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _not_modified(headers, etag, mtime):
+    if 'if-none-match' in headers:
+        return etag in [tag.strip() for tag in headers['if-none-match'].split(',')] \
+            or headers['if-none-match'].strip() == '*'
+    if 'if-modified-since' in headers and mtime is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since.timestamp()
+    return False
+
+
+def _parse_range(value, size):
+    """Return the (start, end) byte positions of a single range header."""
+    matches = RANGE_PATTERN.match(value.strip())
+    if matches is None or matches.group(1) == matches.group(2) == '':
+        raise HttpError(416, {'Content-Range': 'bytes */{:d}'.format(size)})
+    first, last = matches.groups()
+    if first == '':
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last != '' else size
+    if start >= size or start >= end:
+        raise HttpError(416, {'Content-Range': 'bytes */{:d}'.format(size)})
+    return start, end
@@ -0,0 +1,170 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.silence finds leading and trailing silence and long
+gaps (dead air) in recordings. The media file is decoded by ffmpeg into a
+pipe of 8 kHz mono PCM samples, which are analyzed chunk by chunk in
+constant memory. The RMS level of every frame is computed with NumPy if it
+is installed, otherwise with a much slower pure Python fallback.
+"""
+# -*- coding: utf-8 -*-
+import array
+import logging
+import shutil
+import subprocess
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLE_RATE = 8000
+CHUNK_SIZE = 1 << 16
+DEFAULT_THRESHOLD = -50.0  # dBFS
+DEFAULT_MIN_GAP = 10.0  # seconds
+DEAD_AIR_RATIO = 0.5  # recordings that are mostly silent
+
+
+class SilenceDetector(object):
+    """Feed 16 bit mono PCM samples with feed(), get the silent parts of
+    the recording from finish()."""
+
+    def __init__(self, rate=SAMPLE_RATE, frame_seconds=0.1,
+                 threshold=DEFAULT_THRESHOLD, min_gap=DEFAULT_MIN_GAP):
+        self.frame_seconds = frame_seconds
+        self.frame_size = int(rate * frame_seconds)
+        # RMS of a full scale signal is 32768
+        self.limit = 32768.0 * 10 ** (threshold / 20.0)
+        self.min_gap = int(min_gap / frame_seconds)
+        self.frames = 0
+        self.run_start = None  # first frame of the current silent run
+        self.runs = []
+        self.rest = b''
+
+    def feed(self, data):
+        data = self.rest + data
+        usable = len(data) - len(data) % (2 * self.frame_size)
+        self.rest = data[usable:]
+        if usable == 0:
+            return
+        if numpy is not None:
+            self._feed_numpy(data[:usable])
+        else:
+            self._feed_python(data[:usable])
+
+    def _feed_numpy(self, data):
+        samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.float32)
+        frames = samples.reshape(-1, self.frame_size)
+        levels = numpy.sqrt(numpy.mean(frames * frames, axis=1))
+        silent = (levels < self.limit).astype(numpy.int8)
+        previous = 0 if self.run_start is None else 1
+        changes = numpy.diff(silent, prepend=numpy.int8(previous))
+        for index in numpy.flatnonzero(changes):
+            self._change(self.frames + int(index), changes[index] > 0)
+        self.frames += len(silent)
+
+    def _feed_python(self, data):
+        samples = array.array('h', data)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        size = self.frame_size
+        limit = self.limit * self.limit * size
+        for start in range(0, len(samples), size):
+            frame = samples[start:start + size]
+            silent = sum(sample * sample for sample in frame) < limit
+            if silent != (self.run_start is not None):
+                self._change(self.frames, silent)
+            self.frames += 1
+
+    def _change(self, frame, silent):
+        if silent:
+            self.run_start = frame
+        else:
+            self._close_run(frame)
+
+    def _close_run(self, end):
+        start, self.run_start = self.run_start, None
+        if start == 0 or end - start >= self.min_gap:
+            self.runs.append((start, end))
+
+    def finish(self):
+        """Return the duration, the leading and trailing silence and the
+        silent gaps (start, length) in seconds, and whether the recording
+        is mostly dead air."""
+        if self.run_start is not None:
+            end = self.frames
+            start, self.run_start = self.run_start, None
+            self.runs.append((start, end))
+        seconds = self.frame_seconds
+        leading = trailing = 0.0
+        gaps = []
+        for start, end in self.runs:
+            if start == 0:
+                leading = end * seconds
+            elif end == self.frames:
+                trailing = (end - start) * seconds
+            else:
+                gaps.append((round(start * seconds, 1),
+                             round((end - start) * seconds, 1)))
+        duration = self.frames * seconds
+        silent = sum(end - start for start, end in self.runs) * seconds
+        return {
+            'duration': round(duration, 1),
+            'leading': round(leading, 1),
+            'trailing': round(trailing, 1),
+            'gaps': gaps,
+            'dead_air': duration > 0 and silent / duration >= DEAD_AIR_RATIO,
+        }
+
+
+def analyze(filename, threshold=DEFAULT_THRESHOLD, min_gap=DEFAULT_MIN_GAP):
+    """Decode the media file with ffmpeg and return the result of the
+    SilenceDetector, or None if ffmpeg is not installed."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logging.warning("Could not analyze {}: ffmpeg not found on PATH"
+                        .format(filename))
+        return None
+    if numpy is None:
+        logging.info("NumPy is not installed, silence detection is slow")
+
+    detector = SilenceDetector(threshold=threshold, min_gap=min_gap)
+    command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error',
+               '-i', filename, '-f', 's16le', '-acodec', 'pcm_s16le',
+               '-ac', '1', '-ar', str(SAMPLE_RATE), '-']
+    with subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as decoder:
+        for chunk in iter(lambda: decoder.stdout.read(CHUNK_SIZE), b''):
+            detector.feed(chunk)
+    if decoder.returncode != 0:
+        logging.error("Could not decode {}".format(filename))
+        return None
+    return detector.finish()
+
+
+def trim_command(source, target, start, end):
+    """Return the ffmpeg command line that copies the part between `start`
+    and `end` seconds of `source` to `target` without re-encoding."""
+    return [shutil.which('ffmpeg') or 'ffmpeg', '-nostdin', '-hide_banner',
+            '-loglevel', 'error', '-y', '-i', source,
+            '-ss', '{:.1f}'.format(start), '-to', '{:.1f}'.format(end),
+            '-codec', 'copy', '-map_metadata', '-1', '-f', 'mp3', target]
+
+
+def summary(silence):
+    """Return a short description of the result of analyze()."""
+    if silence['dead_air']:
+        return 'Mostly silent (dead air)'
+    parts = []
+    if silence['leading'] > 0:
+        parts.append('{:.0f}s silence at the start'.format(silence['leading']))
+    if silence['trailing'] > 0:
+        parts.append('{:.0f}s silence at the end'.format(silence['trailing']))
+    if len(silence['gaps']) > 0:
+        parts.append('{:d} silent gaps ({:.0f}s)'.format(
+            len(silence['gaps']), sum(length for _, length in silence['gaps'])))
+    return ', '.join(parts)
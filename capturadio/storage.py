@@ -0,0 +1,319 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.storage stores the media files of episodes, either
+in the local destination folder or in an S3 compatible object store.
+
+Media files are always named by their path below config.destination (the
+episode filename), so episodes do not depend on the backend. The S3 backend
+uses the path relative to the destination as object key and streams
+captures with multipart uploads, so they never land on the local disk.
+"""
+# -*- coding: utf-8 -*-
+import builtins
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import threading
+from urllib.error import HTTPError
+from urllib.parse import quote, urlsplit
+from urllib.request import Request, urlopen
+from xml.etree import ElementTree
+
+from capturadio.util import FileStatCache
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024  # S3 needs at least 5 MiB per part
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+
+class LocalStorage(object):
+    """Media files in the local filesystem."""
+
+    def create(self, filename):
+        """Return a writer for a new media file. The writer is a context
+        manager that removes the file if the block raises an exception."""
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return _LocalWriter(filename)
+
+    def getsize(self, filename):
+        try:
+            return os.path.getsize(filename)
+        except (OSError, TypeError):
+            return None
+
+    def reclaimable(self, filename):
+        """Return the bytes removing the file would reclaim: 0 for files
+        that are hard-linked by another episode (see capturadio.dedup)."""
+        try:
+            stat = os.stat(filename)
+        except (OSError, TypeError):
+            return 0
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def remove(self, filename):
+        """Remove the media file and return the reclaimed bytes."""
+        size = self.reclaimable(filename)
+        try:
+            os.unlink(filename)
+        except (OSError, TypeError) as e:
+            logging.error('Could not remove episode media file {}: {}'
+                          .format(filename, e))
+            return 0
+        return size
+
+    def local_path(self, filename):
+        """Return the path of the media file in the local filesystem."""
+        return filename
+
+    def stat_cache(self):
+        return FileStatCache()
+
+
+class S3Storage(object):
+    """Media files in a bucket of an S3 compatible object store, addressed
+    path-style (http://endpoint/bucket/key) and signed with AWS
+    signature version 4."""
+
+    def __init__(self, destination, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', prefix='', part_size=DEFAULT_PART_SIZE):
+        self.destination = destination
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip('/')
+        self.part_size = part_size
+
+    def key(self, filename):
+        key = os.path.relpath(filename, self.destination).replace(os.sep, '/')
+        return self.prefix + '/' + key if self.prefix else key
+
+    def create(self, filename):
+        return _MultipartUpload(self, self.key(filename))
+
+    def getsize(self, filename):
+        try:
+            response = self.request('HEAD', self.key(filename))
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        return int(response.headers['Content-Length'])
+
+    def reclaimable(self, filename):
+        return self.getsize(filename) or 0
+
+    def remove(self, filename):
+        try:
+            size = self.reclaimable(filename)
+            self.request('DELETE', self.key(filename))
+        except (HTTPError, OSError) as e:
+            logging.error('Could not remove episode media file {}: {}'
+                          .format(filename, e))
+            return 0
+        return size
+
+    def local_path(self, filename):
+        return None
+
+    def stat_cache(self):
+        return _ObjectListing(self)
+
+    def list(self, prefix, delimiter=None):
+        """Yield the (key, size) of all objects below `prefix`. With a
+        `delimiter` only the objects up to the next delimiter are listed,
+        the keys below are rolled up into (common prefix, None)."""
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if delimiter is not None:
+                query['delimiter'] = delimiter
+            if token is not None:
+                query['continuation-token'] = token
+            response = self.request('GET', '', query)
+            result = ElementTree.fromstring(response.read())
+            for content in result.iter(S3_NAMESPACE + 'Contents'):
+                yield (content.find(S3_NAMESPACE + 'Key').text,
+                       int(content.find(S3_NAMESPACE + 'Size').text))
+            for common_prefix in result.iter(S3_NAMESPACE + 'CommonPrefixes'):
+                yield common_prefix.find(S3_NAMESPACE + 'Prefix').text, None
+            if result.findtext(S3_NAMESPACE + 'IsTruncated') != 'true':
+                return
+            token = result.findtext(S3_NAMESPACE + 'NextContinuationToken')
+
+    def request(self, method, key, query=None, body=b''):
+        """Send a signed request for the object `key` (or the bucket if key
+        is empty) and return the response."""
+        path = '/' + quote(self.bucket + ('/' + key if key else ''), safe='/-_.~')
+        query_string = '&'.join(
+            '{}={}'.format(quote(name, safe='-_.~'), quote(value, safe='-_.~'))
+            for name, value in sorted((query or {}).items()))
+        url = self.endpoint + path + ('?' + query_string if query_string else '')
+        headers = self._sign(method, path, query_string, urlsplit(url).netloc)
+        return urlopen(Request(url, data=body if method in ('PUT', 'POST') else None,
+                               headers=headers, method=method))
+
+    def _sign(self, method, path, query_string, host):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = '{}/{}/s3/aws4_request'.format(now.strftime('%Y%m%d'), self.region)
+        headers = {
+            'host': host,
+            'x-amz-content-sha256': 'UNSIGNED-PAYLOAD',
+            'x-amz-date': amz_date,
+        }
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method, path, query_string,
+            ''.join('{}:{}\n'.format(name, headers[name]) for name in sorted(headers)),
+            signed_headers, 'UNSIGNED-PAYLOAD'])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split('/'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        headers['Authorization'] = \
+            'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}' \
+            .format(self.access_key, scope, signed_headers, signature)
+        del headers['host']
+        return headers
+
+
+def open_storage(config):
+    """Return the storage configured in section [storage]."""
+    settings = config.storage
+    if settings.get('backend', 'local') == 'local':
+        return LocalStorage()
+    options = {name: value for name, value in settings.items()
+               if name in ('region', 'prefix', 'part_size')}
+    return S3Storage(config.destination, settings['endpoint'], settings['bucket'],
+                     settings['access_key'], settings['secret_key'], **options)
+
+
+class _LocalWriter(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = builtins.open(filename, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.file.close()
+        if type is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class _MultipartUpload(object):
+    """Writes an object with a multipart upload. Full parts are uploaded
+    by a background thread, so the capture only waits if the upload falls
+    behind by more than two parts."""
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.size = 0
+        self.buffer = bytearray()
+        self.etags = []
+        self.error = None
+        response = storage.request('POST', key, {'uploads': ''})
+        self.upload_id = ElementTree.fromstring(response.read()) \
+            .findtext(S3_NAMESPACE + 'UploadId')
+        self.parts = queue.Queue(2)
+        self.thread = threading.Thread(target=self._upload_parts, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if self.error is not None:
+            raise IOError('Upload of {} failed: {}'.format(self.key, self.error))
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.storage.part_size:
+            self.parts.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _upload_parts(self):
+        while True:
+            part = self.parts.get()
+            if part is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                response = self.storage.request('PUT', self.key, {
+                    'partNumber': str(len(self.etags) + 1),
+                    'uploadId': self.upload_id,
+                }, part)
+                self.etags.append(response.headers['ETag'])
+            except (HTTPError, OSError) as e:
+                self.error = e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None and (len(self.buffer) > 0 or len(self.etags) == 0):
+            self.parts.put(bytes(self.buffer))
+        self.parts.put(None)
+        self.thread.join()
+        if type is None and self.error is None:
+            body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+                ''.join('<Part><PartNumber>{:d}</PartNumber><ETag>{}</ETag></Part>'
+                        .format(number, etag)
+                        for number, etag in enumerate(self.etags, 1)))
+            self.storage.request('POST', self.key, {'uploadId': self.upload_id},
+                                 body.encode('utf-8'))
+            return
+        try:
+            self.storage.request('DELETE', self.key, {'uploadId': self.upload_id})
+        except (HTTPError, OSError) as e:
+            logging.error('Could not abort upload of {}: {}'.format(self.key, e))
+        if type is None:
+            raise IOError('Upload of {} failed: {}'.format(self.key, self.error))
+
+
+class _ObjectListing(object):
+    """A FileStatCache for the S3 storage: the objects of a folder are
+    listed with a single delimited request when a file in it is needed
+    first. Subfolders are the common prefixes of the listing, so the
+    objects below them are never paged through."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.folders = {}
+
+    def _folder(self, filename):
+        key = self.storage.key(filename)
+        folder = key.rpartition('/')[0]
+        if folder not in self.folders:
+            self.folders[folder] = {
+                name.rstrip('/').rpartition('/')[2]: size for name, size
+                in self.storage.list(folder + '/' if folder else '', '/')}
+        return self.folders[folder], key.rpartition('/')[2]
+
+    def exists(self, filename):
+        """Files exist if they are objects, folders if they contain one."""
+        entries, name = self._folder(filename)
+        return name in entries
+
+    def getsize(self, filename):
+        entries, name = self._folder(filename)
+        return entries.get(name)
@@ -0,0 +1,98 @@
+"""capturadio is a library to capture mp3 radio streams, process
+the recorded media files and generate an podcast-like rss feed.
+
+ * Copyright (c) 2012- Dirk Ruediger <dirk@niebegeg.net>
+
+The module capturadio.streamlog records how a stream behaved during a
+capture: the bytes received in every second, stalled reads and reconnects.
+The logs are kept in the episodes database (see EpisodeStore.stream_logs),
+separate from the episodes, and summarized by 'recorder show stats'.
+"""
+# -*- coding: utf-8 -*-
+import array
+import statistics
+import time
+
+STARVED_RATIO = 0.5  # seconds with less than half the median rate
+
+
+class StreamLog(object):
+    """Collects the time series of a capture. The recorder reports every
+    chunk with received(); this costs a subtraction and an array update."""
+
+    def __init__(self, url, started=None):
+        self.url = url
+        self.started = time.perf_counter() if started is None else started
+        self.bytes_per_second = array.array('I')
+        self.stalls = []  # (offset, seconds)
+        self.reconnects = []  # offset
+        self.first_byte = None
+
+    def received(self, now, size):
+        second = int(now - self.started)
+        rates = self.bytes_per_second
+        if second >= len(rates):
+            rates.frombytes(bytes(rates.itemsize * (second + 1 - len(rates))))
+        rates[second] += size
+        if self.first_byte is None:
+            self.first_byte = now - self.started
+
+    def stalled(self, now, seconds):
+        self.stalls.append((round(now - seconds - self.started, 1), round(seconds, 2)))
+
+    def reconnected(self, now):
+        self.reconnects.append(round(now - self.started, 1))
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'first_byte': self.first_byte,
+            'bytes_per_second': self.bytes_per_second.tobytes(),
+            'stalls': self.stalls,
+            'reconnects': self.reconnects,
+        }
+
+
+def summary(log):
+    """Return the health of a stream from the dict of StreamLog.to_dict():
+    its duration, mean and minimum rate in bytes per second, the number of
+    starved seconds (below half the median rate), the stalls and their
+    total duration, the reconnects and the time to the first byte."""
+    rates = array.array('I')
+    rates.frombytes(log['bytes_per_second'])
+    # The last second is incomplete
+    full = rates[:-1] if len(rates) > 1 else rates
+    median = statistics.median(full) if len(full) > 0 else 0
+    return {
+        'url': log['url'],
+        'duration': len(rates),
+        'mean_rate': sum(rates) / len(rates) if len(rates) > 0 else 0.0,
+        'min_rate': min(full) if len(full) > 0 else 0,
+        'starved': sum(1 for rate in full if rate < median * STARVED_RATIO),
+        'stalls': len(log['stalls']),
+        'stall_seconds': sum(seconds for _, seconds in log['stalls']),
+        'reconnects': len(log['reconnects']),
+        'first_byte': log['first_byte'],
+    }
+
+
+def health(summaries):
+    """Aggregate the summaries of several captures of the same stream URL:
+    starved seconds, stalls and reconnects per hour of recording."""
+    hours = sum(entry['duration'] for entry in summaries) / 3600.0
+    first_bytes = [entry['first_byte'] for entry in summaries
+                   if entry['first_byte'] is not None]
+    return {
+        'episodes': len(summaries),
+        'hours': hours,
+        'mean_rate': sum(entry['mean_rate'] * entry['duration'] for entry in summaries)
+        / (hours * 3600) if hours > 0 else 0.0,
+        'starved_per_hour': _per_hour(summaries, 'starved', hours),
+        'stalls_per_hour': _per_hour(summaries, 'stalls', hours),
+        'reconnects_per_hour': _per_hour(summaries, 'reconnects', hours),
+        'first_byte': statistics.median(first_bytes) if first_bytes else None,
+    }
+
+
+def _per_hour(summaries, key, hours):
+    return sum(entry[key] for entry in summaries) / hours if hours > 0 else 0.0
@@ -54,6 +54,27 @@ def parse_duration(duration_string):
     return duration
 
 
+def parse_size(size_string):
+    """Parse a size like '500M' or '1.5G' into bytes (binary units)."""
+    pattern = r"\s*(?P<value>\d+(\.\d+)?)\s*(?P<unit>[kmgt]?)i?b?\s*$"
+    matches = re.match(pattern, size_string, re.IGNORECASE)
+    if matches is None:
+        raise ValueError('Invalid size "{}"'.format(size_string))
+    exponent = ' kmgt'.index(matches.group('unit').lower() or ' ')
+    return int(float(matches.group('value')) * 1024 ** exponent)
+
+
+def find_mp3_frame(data, position=0):
+    """Return the position of the first MP3 frame header (a sync word of
+    11 set bits) at or after `position`, or len(data) if there is none."""
+    position = data.find(b'\xff', position)
+    while 0 <= position < len(data) - 1:
+        if data[position + 1] & 0xe0 == 0xe0:
+            return position
+        position = data.find(b'\xff', position + 1)
+    return len(data)
+
+
 # Taken from http://stackoverflow.com/questions/120951/how-can-i-normalize-a-url-in-python
 def url_fix(s, charset='utf-8'):
     """Sometimes you get an URL by a user that just isn't a real
@@ -107,19 +128,31 @@ def find_configuration():
     return os.path.join(XDG_CONFIG_HOME, 'capturadio')
 
 
-def migrate_mediafile_to_episode(config, filename, show):
+def read_media_tags(filename):
+    """Read the ID3 tags needed to migrate a media file into an episode.
+    The function is cheap to pickle and can run in worker processes."""
+    audiofile = MP3(filename)
+    return {
+        'TLEN': _get_mp3_tag(audiofile, 'TLEN', 0),
+        'TDRC': _get_mp3_tag(audiofile, 'TDRC', None),
+        'TIT2': _get_mp3_tag(audiofile, 'TIT2', None),
+    }
+
+
+def migrate_mediafile_to_episode(config, filename, show, tags=None):
     from datetime import datetime, date, timedelta
     from capturadio import Episode
 
     logging.info("Migrate {} to episode".format(filename))
+    if tags is None:
+        tags = read_media_tags(filename)
     episode = Episode(config, show)
-    audiofile = MP3(filename)
     episode.filename = filename
-    episode.duration = round(float(_get_mp3_tag(audiofile, 'TLEN', 0)) / 1000)
+    episode.duration = round(float(tags['TLEN']) / 1000)
     episode.duration_string = str(timedelta(seconds=episode.duration))
     filemtime = date.fromtimestamp(
         os.path.getmtime(filename)).strftime('%Y-%m-%d %H:%M')
-    starttimestr = _get_mp3_tag(audiofile, 'TDRC', filemtime)
+    starttimestr = tags['TDRC'] or filemtime
     episode.starttime = datetime.strptime(
         starttimestr,
         '%Y-%m-%d %H:%M'
@@ -133,7 +166,7 @@ def migrate_mediafile_to_episode(config, filename, show):
         )
     )
     basename = os.path.basename(filename)
-    episode.name = _get_mp3_tag(audiofile, 'TIT2', basename[:-4])
+    episode.name = tags['TIT2'] or basename[:-4]
     new_filename = os.path.join(show.filename, basename)
     if new_filename != filename:
         new_dirname = os.path.dirname(new_filename)
@@ -153,3 +186,46 @@ def _get_mp3_tag(audiofile, tag_string, default):
         return "{}".format(audiofile[tag_string])
     except (KeyError, TypeError):
         return default
+
+
+class FileStatCache(object):
+    """Caches the existence and size of files. Every folder is read with a
+    single os.scandir call when a file of the folder is requested first,
+    so checking many files of the same folder costs no extra round trips
+    on network filesystems."""
+
+    def __init__(self):
+        self._folders = {}
+
+    def _entries(self, folder):
+        entries = self._folders.get(folder)
+        if entries is None:
+            entries = {}
+            try:
+                with os.scandir(folder) as iterator:
+                    for entry in iterator:
+                        entries[entry.name] = \
+                            None if entry.is_dir() else entry.stat().st_size
+            except OSError:
+                pass
+            self._folders[folder] = entries
+        return entries
+
+    def exists(self, filename):
+        folder, name = os.path.split(filename)
+        return name in self._entries(folder)
+
+    def getsize(self, filename):
+        """Return the size of the file or None, if it does not exist."""
+        folder, name = os.path.split(filename)
+        return self._entries(folder).get(name)
+
+    def update(self, filename, size):
+        folder, name = os.path.split(filename)
+        if folder in self._folders:
+            self._folders[folder][name] = size
+
+    def remove(self, filename):
+        folder, name = os.path.split(filename)
+        if folder in self._folders:
+            self._folders[folder].pop(name, None)
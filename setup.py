@@ -32,6 +32,9 @@ setup(
         'mutagenx>=1.22',
         'pytest>=2.3',
     ],
+    extras_require={
+        'silence': ['numpy>=1.17'],
+    },
     packages=find_packages(exclude=('docs', 'examples')),
     include_package_data = True,
     package_data = {
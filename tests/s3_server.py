@@ -0,0 +1,129 @@
+"""A minimal stand-in for an S3 compatible object store (path-style
+requests to a single bucket), used by the storage tests."""
+# -*- coding: utf-8 -*-
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class S3Server(object):
+
+    def __init__(self, bucket='recordings'):
+        self.bucket = bucket
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.s3 = self
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{:d}'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _parse(self):
+        s3 = self.server.s3
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values
+                 in parse_qs(url.query, keep_blank_values=True).items()}
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        s3.requests.append((self.command, key, sorted(query)))
+        assert bucket == s3.bucket
+        assert re.match(r'AWS4-HMAC-SHA256 Credential=\S+/\d{8}/[\w-]+/s3/aws4_request, '
+                        r'SignedHeaders=host;x-amz-content-sha256;x-amz-date, '
+                        r'Signature=[0-9a-f]{64}$', self.headers['Authorization'])
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return s3, key, query, body
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, root, content):
+        return '<?xml version="1.0" encoding="UTF-8"?><{0} xmlns="{1}">{2}</{0}>' \
+            .format(root, NAMESPACE, content).encode('utf-8')
+
+    def do_POST(self):
+        s3, key, query, body = self._parse()
+        if 'uploads' in query:
+            upload_id = str(len(s3.uploads) + 1)
+            s3.uploads[upload_id] = {}
+            self._send(200, self._xml('InitiateMultipartUploadResult',
+                                      '<UploadId>{}</UploadId>'.format(upload_id)))
+        else:
+            parts = s3.uploads.pop(query['uploadId'])
+            numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>',
+                                                  body.decode('utf-8'))]
+            s3.objects[key] = b''.join(parts[number] for number in numbers)
+            self._send(200, self._xml('CompleteMultipartUploadResult', ''))
+
+    def do_PUT(self):
+        s3, key, query, body = self._parse()
+        s3.uploads[query['uploadId']][int(query['partNumber'])] = body
+        self._send(200, headers={'ETag': '"part{}"'.format(query['partNumber'])})
+
+    def do_HEAD(self):
+        s3, key, query, body = self._parse()
+        if key not in s3.objects:
+            self._send(404)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(s3.objects[key])))
+            self.end_headers()
+
+    def do_GET(self):
+        s3, key, query, body = self._parse()
+        prefix, delimiter = query.get('prefix', ''), query.get('delimiter')
+        keys = set()
+        for k in s3.objects:
+            if k.startswith(prefix):
+                rest = k[len(prefix):]
+                if delimiter and delimiter in rest:
+                    k = prefix + rest.partition(delimiter)[0] + delimiter
+                keys.add(k)
+        keys = sorted(keys)
+        start = int(query.get('continuation-token', 0))
+        page = keys[start:start + 2]  # tiny pages to test the pagination
+        content = ''.join(
+            '<Contents><Key>{}</Key><Size>{:d}</Size></Contents>'
+            .format(escape(k), len(s3.objects[k])) if k in s3.objects else
+            '<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(k))
+            for k in page)
+        if start + 2 < len(keys):
+            content += '<IsTruncated>true</IsTruncated>' \
+                '<NextContinuationToken>{:d}</NextContinuationToken>'.format(start + 2)
+        else:
+            content += '<IsTruncated>false</IsTruncated>'
+        self._send(200, self._xml('ListBucketResult', content))
+
+    def do_DELETE(self):
+        s3, key, query, body = self._parse()
+        if 'uploadId' in query:
+            s3.uploads.pop(query['uploadId'], None)
+        else:
+            s3.objects.pop(key, None)
+        self._send(204)
+
+    def log_message(self, format, *args):
+        pass
@@ -254,3 +254,58 @@ def test_parse_duration():
     assert parse_duration("1h-15m20") == 3600
     assert parse_duration("trara") == 0
     assert parse_duration("12trara") == 12
+
+
+def test_reload(test_folder):
+    config = Configuration(reset=True, folder=str(test_folder))
+    nachtradio = config.shows['nachtradio']
+    weather = config.shows['weather']
+    dlf = config.stations['dlf']
+
+    text = test_folder.join('capturadiorc').read('r')
+    text = text.replace('duration = 300\nlogo_url = http://example.org/weather.png',
+                        'duration = 600\nlogo_url = http://example.org/weather.png')
+    text = text.replace('[news]', '''[late_news]
+name = Late news
+duration = 300
+station = wdr2
+
+[news]''')
+    test_folder.join('capturadiorc').write(text, 'w')
+
+    changes = config.reload()
+    assert changes['shows'] == {
+        'added': ['late_news'],
+        'removed': [],
+        'changed': ['weather'],
+    }
+    assert changes['stations'] == {'added': [], 'removed': [], 'changed': []}
+
+    assert config.shows['nachtradio'] is nachtradio
+    assert config.stations['dlf'] is dlf
+    assert config.shows['weather'] is not weather
+    assert config.shows['weather'].duration == 600
+    assert config.shows['weather'].station is dlf
+    assert weather.duration == 300
+    assert weather not in dlf.shows
+    assert config.shows['weather'] in dlf.shows
+    assert 'late_news' in Configuration().shows
+    assert config.reload_if_changed() is None
+
+
+def test_file_stat_cache(test_folder):
+    from capturadio.util import FileStatCache
+
+    test_folder.mkdir('cache').join('episode.mp3').write('1234')
+    folder = str(test_folder.join('cache'))
+    stats = FileStatCache()
+    assert stats.exists(folder)
+    assert stats.getsize(os.path.join(folder, 'episode.mp3')) == 4
+    assert stats.getsize(os.path.join(folder, 'missing.mp3')) is None
+
+    test_folder.join('cache', 'new.mp3').write('12')
+    assert not stats.exists(os.path.join(folder, 'new.mp3'))  # cached
+    stats.update(os.path.join(folder, 'new.mp3'), 2)
+    assert stats.getsize(os.path.join(folder, 'new.mp3')) == 2
+    stats.remove(os.path.join(folder, 'episode.mp3'))
+    assert not stats.exists(os.path.join(folder, 'episode.mp3'))
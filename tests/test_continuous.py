@@ -0,0 +1,126 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.continuous module.
+"""
+
+import os
+import sys
+import time
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.continuous import SegmentWriter, load_segments, locate, \
+    slice_segments, prune_segments, next_occurrence
+
+FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413  # 128 kbit/s, 44.1 kHz
+
+
+def record(folder, seconds, start=1000.0, segment_seconds=10):
+    writer = SegmentWriter(folder, segment_seconds)
+    for second in range(seconds):
+        # 3 frames per second, written in one second steps
+        writer.write(FRAME * 3, start + second)
+    writer.close()
+    return load_segments(folder)
+
+
+def test_segments_rotate(test_folder):
+    segments = record(str(test_folder.join('segments')), 25)
+    assert [segment.start for segment in segments] == [1000.0, 1010.0, 1020.0]
+    assert segments[1].checkpoints[:3] == \
+        [(0, 1010.0), (3 * len(FRAME), 1010.0), (6 * len(FRAME), 1011.0)]
+    assert locate(segments, 1014.5) == (1, int(16.5 * len(FRAME)))
+    assert locate(segments, 999.0) == (0, 0)
+
+
+def test_slice_segments(test_folder):
+    segments = record(str(test_folder.join('segments')), 25)
+    target = str(test_folder.join('cut.mp3'))
+    # from the middle of the first into the last segment, cut at frames
+    size = slice_segments(segments, 1005.2, 1021.0, target)
+    assert size % len(FRAME) == 0
+    with open(target, 'rb') as file:
+        assert file.read(4) == FRAME[:4]
+    assert 15 * 3 * len(FRAME) <= size <= 17 * 3 * len(FRAME)
+
+    prune_segments(segments, 1012.0)
+    assert [segment.start for segment in load_segments(
+        str(test_folder.join('segments')))] == [1010.0, 1020.0]
+
+
+def test_next_occurrence(config):
+    show = config.shows['weather']
+    show.start, show.days = '06:30', 'sat'
+    # Friday, 2016-10-07 12:00 local time
+    now = time.mktime((2016, 10, 7, 12, 0, 0, 0, 0, -1))
+    start, end = next_occurrence(show, now)
+    assert time.localtime(start)[:5] == (2016, 10, 8, 6, 30)
+    assert end - start == show.duration
+    assert next_occurrence(show, start) == (start, end)
+    assert time.localtime(next_occurrence(show, start + 1)[0])[:3] == (2016, 10, 15)
+
+
+def test_station_recorder_hands_cuts_to_worker(config, test_folder):
+    from capturadio.continuous import StationRecorder
+
+    class Worker(object):
+        submitted = []
+
+        def submit(self, function, *args):
+            self.submitted.append((function, args))
+
+    folder = str(test_folder.join('segments'))
+    record(folder, 25)
+    show = config.shows['weather']
+    station = StationRecorder(config, show.station, recorder=None, folder=folder)
+    station.worker = Worker()
+    show.start = '06:30'
+    station.plan = {show: (1005.0, 1012.0)}
+    station.cut(1013.0)
+
+    # only the bytes were copied in the loop, processing is left to the worker
+    function, (episode, temp_filename, size) = station.worker.submitted[0]
+    assert function == station.store_episode
+    assert os.path.getsize(temp_filename) == size > 0
+    assert not os.path.exists(episode.filename)
+    # the show is planned for another day, no segment is needed anymore
+    assert show not in station.plan or station.plan[show][0] > 1025.0
+    assert len(load_segments(folder)) == 1
+
+
+def test_prune_on_rotation(config, test_folder):
+    from capturadio.continuous import StationRecorder
+
+    folder = str(test_folder.join('segments'))
+    record(folder, 25)
+    show = config.shows['weather']
+    station = StationRecorder(config, show.station, recorder=None, folder=folder)
+    station.plan = {show: (1015.0, 1100.0)}
+    station.prune(1030.0)
+    assert [segment.start for segment in load_segments(folder)] == [1010.0, 1020.0]
+
+
+def test_replan_after_reload(config, test_folder):
+    from capturadio.continuous import StationRecorder
+
+    rc = test_folder.join('capturadiorc')
+    rc.write(rc.read_text('utf-8').replace(
+        '[weather]\n', '[weather]\nstart = 06:30\n'), 'w')
+    config.reload()
+    station = StationRecorder(config, config.stations['dlf'], recorder=None,
+                              folder=str(test_folder.join('segments')))
+    # Friday, 2016-10-07 06:35 local time, the show is running
+    now = time.mktime((2016, 10, 7, 6, 35, 0, 0, 0, -1))
+    station.replan(now - 600)
+    running = station.plan[config.shows['weather']]
+    station.replan(now)
+    assert station.plan[config.shows['weather']] == running
+
+    rc.write(rc.read_text('utf-8').replace('start = 06:30', 'start = 07:00'), 'w')
+    config.reload()
+    station.replan(now)
+    assert [show.id for show in station.plan] == ['weather']
+    start, end = station.plan[config.shows['weather']]
+    assert time.localtime(start)[:5] == (2016, 10, 7, 7, 0)
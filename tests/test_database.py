@@ -0,0 +1,221 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.database module.
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+import pytest
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.entities import Episode
+from capturadio.database import EpisodeStore, DatabaseLocked
+
+
+def _episode(config, show_id, days_ago, folder):
+    episode = Episode(config, config.shows[show_id])
+    episode.starttime = time.localtime(time.time() - days_ago * 24 * 3600)
+    episode.slug = '{}/{}_{:d}.mp3'.format(episode.show.slug, show_id, days_ago)
+    episode.filename = str(folder.join('{}_{:d}.mp3'.format(show_id, days_ago)))
+    with open(episode.filename, 'wb') as file:
+        file.write(b'\0' * 100)
+    episode.filesize = '100'
+    return episode
+
+
+def test_store_behaves_like_shelve(config, test_folder):
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        episode = _episode(config, 'weather', 1, test_folder)
+        db[episode.slug] = episode
+        assert episode.slug in db
+        assert len(db) == 1
+        assert db[episode.slug].name == episode.name
+        assert [slug for slug, item in db.items()] == [episode.slug]
+        del db[episode.slug]
+        assert episode.slug not in db
+
+
+def test_cleanup_database(config, test_folder):
+    from capturadio.recorder_cli import _cleanup_database
+
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        fresh = _episode(config, 'weather', 1, test_folder)
+        old = _episode(config, 'news', 20, test_folder)
+        for episode in (fresh, old):
+            db[episode.slug] = episode
+
+        assert [row[0] for row in db.expired(time.time())] == [old.slug]
+
+        assert _cleanup_database(db, dry_run=True) == (1, 100)
+        assert old.slug in db
+        assert os.path.exists(old.filename)
+
+        assert _cleanup_database(db) == (1, 100)
+        assert old.slug not in db
+        assert not os.path.exists(old.filename)
+        assert fresh.slug in db
+        assert os.path.exists(fresh.filename)
+
+
+def _write_episodes(filename, episodes):
+    with EpisodeStore(filename) as db:
+        for episode in episodes:
+            db[episode.slug] = episode
+
+
+def _read_episodes(filename, rounds):
+    for _ in range(rounds):
+        with EpisodeStore(filename, 'r') as db:
+            for slug, episode in db.items():
+                assert slug == episode.slug
+
+
+def test_concurrent_readers_and_writers(config, test_folder):
+    filename = str(test_folder.join('episodes.sqlite'))
+    EpisodeStore(filename).close()
+
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for writer in range(8):
+        episodes = [_episode(config, 'weather', writer * 100 + i, test_folder)
+                    for i in range(50)]
+        processes.append(context.Process(
+            target=_write_episodes, args=(filename, episodes)))
+        processes.append(context.Process(
+            target=_read_episodes, args=(filename, 20)))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    with EpisodeStore(filename, 'r') as db:
+        assert len(db) == 8 * 50
+
+
+def test_non_blocking_writer(config, test_folder):
+    filename = str(test_folder.join('episodes.sqlite'))
+    episode = _episode(config, 'weather', 1, test_folder)
+    with EpisodeStore(filename) as writer:
+        with writer.transaction():
+            writer[episode.slug] = episode
+            with EpisodeStore(filename, timeout=0) as other:
+                with pytest.raises(DatabaseLocked):
+                    other[episode.slug] = episode
+            with EpisodeStore(filename, 'r') as reader:
+                assert len(reader) == 0
+        with EpisodeStore(filename, 'r') as reader:
+            assert len(reader) == 1
+
+
+def test_listing(config, test_folder):
+    from capturadio.database import _fill_listing
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        episodes = [_episode(config, show_id, days_ago, test_folder)
+                    for show_id, days_ago in (('weather', 3), ('news', 1),
+                                              ('weather', 2))]
+        for episode in episodes:
+            db[episode.slug] = episode
+        rows = list(db.listing())
+        assert [row[0] for row in rows] == \
+            [episodes[0].slug, episodes[2].slug, episodes[1].slug]
+        assert rows[0][2:] == ('dlf/weather', episodes[0].name, 100, 300.0,
+                              episodes[0].filename)
+
+        assert [row[0] for row in db.listing(limit=1, newest_first=True)] == \
+            [episodes[1].slug]
+        middle = time.time() - 2.5 * 24 * 3600
+        assert [row[0] for row in db.listing(start=middle)] == \
+            [episodes[2].slug, episodes[1].slug]
+        assert [row[0] for row in db.listing(end=middle)] == [episodes[0].slug]
+
+        # rows written before the columns existed are filled from the pickle
+        db.connection.execute('UPDATE episodes SET name = NULL, duration = NULL')
+        _fill_listing(db.connection)
+        assert list(db.listing()) == rows
+        assert [row[0] for row in db.listing(station='wdr2')] == \
+            [episodes[1].slug]
+        assert [row[0] for row in db.listing(show='dlf/weather', min_size=100)] == \
+            [episodes[0].slug, episodes[2].slug]
+        assert list(db.listing(min_size=101)) == []
+
+
+def test_feed_list_filters(config, test_folder, monkeypatch, capsys):
+    import json
+    from docopt import docopt
+    import capturadio.recorder_cli as cli
+
+    filename = str(test_folder.join('episodes.sqlite'))
+    episodes = [_episode(config, 'weather', 3, test_folder),
+                _episode(config, 'news', 1, test_folder)]
+    _write_episodes(filename, episodes)
+    os.remove(episodes[0].filename)
+    monkeypatch.setattr(cli.database, 'open',
+                        lambda *args: EpisodeStore(filename, 'r'))
+
+    def feed_list(argv):
+        cli.feed_list(docopt(cli.main.__doc__, argv=['feed', 'list'] + argv))
+        return capsys.readouterr().out.splitlines()
+
+    assert [line.split()[-1] for line in feed_list([])] == \
+        [episodes[0].slug, episodes[1].slug]
+    assert [line.split()[-1] for line in feed_list(['--station=wdr2'])] == \
+        [episodes[1].slug]
+    assert [line.split()[-1] for line in feed_list(['--missing'])] == \
+        [episodes[0].slug]
+    lines = feed_list(['--last=1', '--format=json'])
+    assert [json.loads(line)['slug'] for line in lines] == [episodes[1].slug]
+    day = time.strftime('%Y-%m-%d', episodes[1].starttime)
+    assert len(feed_list(['--from=' + day, '--to=' + day])) == 1
+
+
+def test_feed_list_without_current_store(config, test_folder, monkeypatch, capsys):
+    import pickle
+    from docopt import docopt
+    import capturadio.database as database
+    import capturadio.recorder_cli as cli
+
+    monkeypatch.setattr(database, 'app_folder', str(test_folder))
+    args = docopt(cli.main.__doc__, argv=['feed', 'list'])
+    cli.feed_list(args)
+    assert capsys.readouterr().out == ''
+    assert not os.path.exists(database.store_path('episodes_db'))
+
+    # A store of schema version 6, before the listing columns were added
+    episode = _episode(config, 'weather', 1, test_folder)
+    with monkeypatch.context() as patch:
+        patch.setattr(database, '_MIGRATIONS', database._MIGRATIONS[:6])
+        with database.open('episodes_db') as db:
+            db.connection.execute(
+                'INSERT INTO episodes (slug, starttime, expires, filename, '
+                'filesize, station, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (episode.slug, time.mktime(episode.starttime), time.time() + 60,
+                 episode.filename, 100, 'dlf', pickle.dumps(episode)))
+    cli.feed_list(args)
+    assert [line.split()[-1] for line in capsys.readouterr().out.splitlines()] == \
+        [episode.slug]
+
+
+def test_newest(config, test_folder):
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        episodes = [_episode(config, show_id, days_ago, test_folder)
+                    for show_id, days_ago in (('weather', 3), ('news', 0),
+                                              ('weather', 2), ('weather', 1))]
+        for episode in episodes:
+            db[episode.slug] = episode
+        db.save_fragments([(episodes[2].slug, 'key', 'feed', 'page')])
+
+        rows = list(db.newest('', 'key', batch_size=2))
+        assert [row[0] for row in rows] == \
+            [episodes[1].slug, episodes[3].slug, episodes[2].slug, episodes[0].slug]
+        assert rows[2][1:] == (episodes[2].filename, 100, ('feed', 'page'), None)
+        assert rows[0][3] is None and rows[0][4].name == episodes[1].name
+
+        assert [row[0] for row in db.newest('dlf/weather', 'key', batch_size=1)] == \
+            [episodes[3].slug, episodes[2].slug, episodes[0].slug]
+        assert [row[0] for row in db.newest('wdr2', 'other')] == [episodes[1].slug]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.dedup module.
+"""
+
+import os
+import sys
+import time
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.entities import Episode
+from capturadio.database import EpisodeStore
+from capturadio.dedup import audio_hash, deduplicate, link_duplicate
+from capturadio.storage import LocalStorage
+
+ID3V2 = b'ID3\x04\x00\x00\x00\x00\x00\x05' + b'tags!'
+ID3V1 = b'TAG' + b'\0' * 125
+
+
+def _episode(config, show_id, content, days_ago=0):
+    show = config.shows[show_id]
+    episode = Episode(config, show, time.localtime(time.time() - days_ago * 86400))
+    if not os.path.isdir(os.path.dirname(episode.filename)):
+        os.makedirs(os.path.dirname(episode.filename))
+    with open(episode.filename, 'wb') as file:
+        file.write(content)
+    episode.filesize = str(len(content))
+    return episode
+
+
+def test_audio_hash_ignores_id3_tags(test_folder):
+    audio = b'\xff\xfb' * 1000
+    filenames = []
+    for number, content in enumerate((audio, ID3V2 + audio + ID3V1)):
+        filenames.append(str(test_folder.join('{:d}.mp3'.format(number))))
+        with open(filenames[-1], 'wb') as file:
+            file.write(content)
+    assert audio_hash(filenames[0]) == audio_hash(filenames[1])
+
+
+def test_link_duplicates(config, test_folder):
+    audio = b'\xff\xfb' * 1000
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        original = _episode(config, 'weather', ID3V2 + audio, days_ago=2)
+        rebroadcast = _episode(config, 'news', audio + ID3V1, days_ago=1)
+        other = _episode(config, 'nachtradio', b'\xff\xfb' * 500)
+        for episode in (original, rebroadcast, other):
+            db[episode.slug] = episode
+
+        assert deduplicate(db, dry_run=True) == [
+            (original.slug, rebroadcast.slug, len(audio) + 128)]
+        assert not os.path.samefile(original.filename, rebroadcast.filename)
+
+        assert deduplicate(db) == [(original.slug, rebroadcast.slug, len(audio) + 128)]
+        assert os.path.samefile(original.filename, rebroadcast.filename)
+        assert db[rebroadcast.slug].duplicate_of == original.slug
+        assert LocalStorage().reclaimable(original.filename) == 0  # still linked
+        assert deduplicate(db) == [(original.slug, rebroadcast.slug, 0)]
+
+        capture = _episode(config, 'weather', audio)
+        capture.audio_hash = db[original.slug].audio_hash
+        assert link_duplicate(db, capture) == original.slug
+        assert os.path.samefile(original.filename, capture.filename)
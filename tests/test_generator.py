@@ -0,0 +1,193 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.generator module.
+"""
+
+import os
+import sys
+import time
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.entities import Station, Episode
+from capturadio.database import EpisodeStore
+from capturadio.generator import render_tasks, run_render_tasks
+
+
+def test_render_in_processes(config, test_folder):
+    root = Station(config, 'root', None, 'All recordings')
+    root.filename = config.destination
+    root.slug = ''
+    root.shows = config.stations.values()
+
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        for show_id in ('weather', 'news'):
+            episode = Episode(config, config.shows[show_id])
+            os.makedirs(os.path.dirname(episode.filename))
+            with open(episode.filename, 'wb') as file:
+                file.write(b'\0' * 10)
+            episode.mimetype = 'audio/mpeg'
+            db[episode.slug] = episode
+        tasks = render_tasks(config, db, root)
+        assert db[episode.slug].filesize == '10'
+
+    run_render_tasks(tasks, jobs=2)
+
+    weather = config.shows['weather']
+    with open(os.path.join(weather.filename, 'rss.xml')) as file:
+        feed = file.read()
+    assert 'Weather forecast' in feed
+    assert 'Latest news' not in feed
+    with open(os.path.join(config.destination, 'rss.xml')) as file:
+        feed = file.read()
+    assert 'Weather forecast' in feed
+    assert 'Latest news' in feed
+    assert os.path.exists(os.path.join(config.destination, 'index.html'))
+    assert os.path.exists(os.path.join(config.stations['dlf'].filename, 'index.html'))
+    assert not os.path.exists(os.path.join(config.stations['dkultur'].filename, 'rss.xml'))
+
+
+def test_fragments_are_stored_and_invalidated(config, test_folder):
+    from types import SimpleNamespace
+    from capturadio.generator import attach_fragments, fragment_key
+
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        episode = Episode(config, config.shows['weather'])
+        episode.filesize = '10'
+        db[episode.slug] = episode
+        key = fragment_key(config.feed)
+
+        item = SimpleNamespace(**episode.__dict__)
+        attach_fragments(db, config.feed, [item])
+        assert 'length="10"' in item.feed_fragment
+        assert 'class="item episode"' in item.page_fragment
+        assert db.fragments(key, [episode.slug]) == \
+            {episode.slug: (item.feed_fragment, item.page_fragment)}
+
+        # stored fragments are used as they are
+        db.save_fragments([(episode.slug, key, 'feed', 'page')])
+        attach_fragments(db, config.feed, [item])
+        assert (item.feed_fragment, item.page_fragment) == ('feed', 'page')
+
+        # other feed settings need other fragments
+        settings = dict(config.feed, base_url='http://other.example.org')
+        assert fragment_key(settings) != key
+        assert db.fragments(fragment_key(settings), [episode.slug]) == {}
+
+        # storing the episode again removes its fragments
+        db[episode.slug] = episode
+        assert db.fragments(key, [episode.slug]) == {}
+
+
+def test_failed_render_keeps_the_feed(config, test_folder, monkeypatch):
+    import pytest
+    import capturadio.generator as generator
+
+    weather = config.shows['weather']
+    os.makedirs(weather.filename)
+    feed = os.path.join(weather.filename, 'rss.xml')
+    with open(feed, 'w') as file:
+        file.write('previous feed')
+
+    def fragments(*args):
+        yield '    <item></item>'
+        raise IOError('database gone')
+    monkeypatch.setattr(generator, '_stream_fragments', fragments)
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        with pytest.raises(IOError):
+            generator.generate_feed(config, db, weather)
+
+    with open(feed) as file:
+        assert file.read() == 'previous feed'
+    assert os.listdir(weather.filename) == ['rss.xml']
+
+
+def _seed_weather(config, filename, count, interval):
+    """Store `count` weather episodes with media files, one every
+    `interval` seconds back from now. The fragments of all but the newest
+    three windows of episodes are stored, like after an earlier run."""
+    from capturadio.generator import FRAGMENT_BATCH, fragment_key, render_fragment
+
+    weather = config.shows['weather']
+    os.makedirs(weather.filename)
+    episode = Episode(config, weather)
+    episode.filesize = '10'
+    episode.mimetype = 'audio/mpeg'
+    key = fragment_key(config.feed)
+    fragments = [render_fragment(config.feed, kind, episode)
+                 for kind in ('feed', 'page')]
+    rendered = episode.slug
+    now = time.time()
+    with EpisodeStore(filename) as db:
+        with db.transaction():
+            for number in range(count):
+                episode.starttime = time.localtime(now - number * interval)
+                episode.slug = 'dlf/weather/weather_{:d}.mp3'.format(number)
+                episode.filename = os.path.join(config.destination, episode.slug)
+                with open(episode.filename, 'wb') as file:
+                    file.write(b'\0' * 10)
+                db[episode.slug] = episode
+        db.save_fragments(
+            ('dlf/weather/weather_{:d}.mp3'.format(number), key,
+             fragments[0].replace(rendered, 'dlf/weather/weather_{:d}.mp3'.format(number)),
+             fragments[1].replace(rendered, 'dlf/weather/weather_{:d}.mp3'.format(number)))
+            for number in range(3 * FRAGMENT_BATCH, count))
+
+
+def test_generate_feed_in_bounded_memory(config, test_folder):
+    import tracemalloc
+    from capturadio.generator import generate_feed, root_entity
+    from capturadio.util import FileStatCache
+
+    filename = str(test_folder.join('episodes.sqlite'))
+    _seed_weather(config, filename, 100000, 60)
+    root = root_entity(config)
+    stats = FileStatCache()
+    # The folder listing is cached before, it isn't part of the rendering
+    assert stats.getsize(os.path.join(config.shows['weather'].filename,
+                                      'weather_0.mp3')) == 10
+
+    with EpisodeStore(filename, 'r') as db:
+        tracemalloc.start()
+        try:
+            assert generate_feed(config, db, root, stats) == 100000
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    with open(os.path.join(root.filename, 'rss.xml')) as file:
+        items = [line for line in file if '<guid' in line]
+    assert len(items) == 100000
+    assert 'weather_0.mp3' in items[0] and 'weather_99999.mp3' in items[-1]
+    # a window of unpickled episodes and their fragments, the whole feed
+    # takes about 75 MB
+    assert peak < 8 * 1024 * 1024
+
+
+def test_feed_update_in_bounded_memory(config, test_folder, monkeypatch):
+    import tracemalloc
+    from docopt import docopt
+    import capturadio.recorder_cli as cli
+
+    filename = str(test_folder.join('episodes.sqlite'))
+    _seed_weather(config, filename, 20000, 30)
+    monkeypatch.setattr(cli.database, 'open',
+                        lambda dbname, flag='c': EpisodeStore(filename, flag))
+
+    tracemalloc.start()
+    try:
+        cli.feed_update(docopt(cli.main.__doc__, argv=['feed', 'update']))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    for entity in (config.shows['weather'], config.stations['dlf']):
+        with open(os.path.join(entity.filename, 'rss.xml')) as file:
+            assert sum(1 for line in file if '<guid' in line) == 20000
+    with open(os.path.join(config.shows['weather'].filename, 'index.html')) as file:
+        assert 'weather_19999.mp3' in file.read()
+    # the listing of the show folder and a window of episodes, holding all
+    # items like render_tasks() does takes about 100 MB
+    assert peak < 12 * 1024 * 1024
@@ -0,0 +1,42 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.journal module.
+"""
+
+import os
+import sys
+import time
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.entities import Episode
+from capturadio.database import EpisodeStore
+from capturadio.journal import Journal, recover
+
+
+def test_recover_interrupted_capture(config, test_folder):
+    journal = Journal(str(test_folder.join('journal')))
+    finished = Episode(config, config.shows['news'])
+    interrupted = Episode(config, config.shows['weather'])
+    for episode in (finished, interrupted):
+        os.makedirs(os.path.dirname(episode.filename))
+        with open(episode.filename, 'wb') as file:
+            file.write(b'\0' * 100)
+        journal.started(episode)
+    journal.finished(finished)
+
+    assert list(journal.pending().keys()) == [interrupted.slug]
+
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        assert recover(config, db, journal) == []  # capture still running
+        recovered = recover(config, db, journal, now=time.time() + 3600)
+        assert [episode.slug for episode in recovered] == [interrupted.slug]
+        episode = db[interrupted.slug]
+        assert episode.partial
+        assert episode.filesize == '100'
+        assert episode.show.id == 'weather'
+        assert finished.slug not in db
+
+    assert journal.pending() == {}
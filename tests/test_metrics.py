@@ -0,0 +1,113 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.metrics module.
+"""
+
+import io
+import logging
+import os
+import sys
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+import capturadio.recorder
+from capturadio import metrics, Episode
+from capturadio.recorder import Recorder
+
+
+def test_render_text_format():
+    registry = metrics.Registry()
+    captured = registry.counter('bytes_total', 'Bytes', ('show',))
+    latency = registry.histogram('read_seconds', 'Reads', buckets=(0.1, 1.0))
+    registry.gauge('unused', 'Never set')
+    captured.inc(10, show='news')
+    captured.labels(show='news').inc(5)
+    captured.inc(1, show='say "hi"')
+    for value in (0.05, 0.5, 3.0):
+        latency.observe(value)
+
+    assert registry.render() == '\n'.join([
+        '# HELP bytes_total Bytes',
+        '# TYPE bytes_total counter',
+        'bytes_total{show="news"} 15',
+        'bytes_total{show="say \\"hi\\""} 1',
+        '# HELP read_seconds Reads',
+        '# TYPE read_seconds histogram',
+        'read_seconds_bucket{le="0.1"} 1',
+        'read_seconds_bucket{le="1.0"} 2',
+        'read_seconds_bucket{le="+Inf"} 3',
+        'read_seconds_sum 3.55',
+        'read_seconds_count 3',
+    ]) + '\n'
+
+
+def test_collect_merges_textfiles(test_folder):
+    folder = str(test_folder.mkdir('metrics'))
+    for show in ('news', 'weather'):
+        registry = metrics.Registry()
+        registry.counter('bytes_total', 'Bytes', ('show',)).inc(1, show=show)
+        metrics.write_textfile('show_capture_' + show, registry, folder)
+    registry = metrics.Registry()
+    registry.gauge('cache_hits', 'Hits').set(3)
+
+    assert sorted(os.listdir(folder)) == \
+        ['show_capture_news.prom', 'show_capture_weather.prom']
+    assert metrics.collect(registry, folder) == '\n'.join([
+        '# HELP bytes_total Bytes',
+        '# TYPE bytes_total counter',
+        'bytes_total{show="news"} 1',
+        'bytes_total{show="weather"} 1',
+        '# HELP cache_hits Hits',
+        '# TYPE cache_hits gauge',
+        'cache_hits 3',
+    ]) + '\n'
+
+
+def test_capture_counts_reconnects(test_folder, config, monkeypatch):
+    streams = [io.BytesIO(b'a' * 30000), io.BytesIO(b'b' * 100)]
+    monkeypatch.setattr(capturadio.recorder, 'urlopen',
+                        lambda url: streams.pop(0) if streams else io.BytesIO())
+    monkeypatch.setattr(capturadio.recorder.time, 'sleep', lambda seconds: None)
+
+    show = config.shows['weather']
+    episode = Episode(config, show)
+    episode.filename = os.path.join(str(test_folder.mkdir('casts')), 'output.mp3')
+    episode.duration = 60
+    labels = {'station': show.station.id, 'show': show.id}
+    reconnects = capturadio.recorder.RECONNECTS.labels(**labels).value
+    reads = capturadio.recorder.READ_LATENCY.labels(**labels).counts[:]
+
+    Recorder()._write_stream_to_file(episode)
+
+    # Two streams ended and every later reconnect delivered nothing
+    assert episode.filesize == '30100'
+    assert capturadio.recorder.RECONNECTS.labels(**labels).value - reconnects == \
+        capturadio.recorder.MAX_RECONNECTS + 1
+    assert sum(capturadio.recorder.READ_LATENCY.labels(**labels).counts) - \
+        sum(reads) == 4
+
+
+def test_spans_are_logged_if_enabled(caplog):
+    with metrics.span('write', file='rss.xml'):
+        pass
+    assert len(caplog.records) == 0
+
+    caplog.set_level(logging.DEBUG, logger='capturadio.spans')
+    with metrics.span('write', file='rss.xml'):
+        pass
+    record, = caplog.records
+    assert record.span == 'write'
+    assert record.fields == {'file': 'rss.xml'}
+    assert record.getMessage().startswith('span=write seconds=')
+    assert record.getMessage().endswith(' file=rss.xml')
+
+
+def test_profile_option():
+    from capturadio.recorder_cli import _profile_option
+    assert _profile_option(['feed', 'update']) == (['feed', 'update'], None)
+    assert _profile_option(['--profile', 'feed', 'update']) == \
+        (['feed', 'update'], '')
+    assert _profile_option(['feed', 'update', '--profile=/tmp/feed.prof']) == \
+        (['feed', 'update'], '/tmp/feed.prof')
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.pipeline module.
+"""
+
+import os
+import sys
+import threading
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+import capturadio.pipeline as pipeline
+from capturadio.entities import Episode
+from capturadio.pipeline import Pipeline, encoder_command
+
+
+def test_encoder_command(monkeypatch):
+    installed = {'ffmpeg', 'lame'}
+    monkeypatch.setattr(pipeline.shutil, 'which',
+                        lambda name: '/usr/bin/' + name if name in installed else None)
+    command = encoder_command('in.mp3', 'out.mp3', 96, True)
+    assert command[0] == '/usr/bin/ffmpeg'
+    assert pipeline.LOUDNORM_FILTER in command
+    assert command[-5:] == ['-b:a', '96k', '-f', 'mp3', 'out.mp3']
+
+    installed.remove('ffmpeg')
+    assert encoder_command('in.mp3', 'out.mp3', 96)[0] == '/usr/bin/lame'
+    assert encoder_command('in.mp3', 'out.mp3', None, True) is None
+
+
+def test_keep_original_if_encoder_fails(config, test_folder, monkeypatch):
+    monkeypatch.setattr(pipeline, 'encoder_command', lambda *args: ['false'])
+    show = config.shows['weather']
+    show.transcode = 64
+    episode = Episode(config, show)
+    os.makedirs(os.path.dirname(episode.filename))
+    with open(episode.filename, 'wb') as file:
+        file.write(b'\0' * 100)
+
+    failed = pipeline.EPISODES.labels(result='failed').value
+    Pipeline(folder=str(test_folder.join('pipeline'))).process(episode)
+    assert os.path.getsize(episode.filename) == 100
+    assert pipeline.EPISODES.labels(result='failed').value == failed + 1
+    assert os.listdir(os.path.dirname(episode.filename)) == \
+        [os.path.basename(episode.filename)]
+
+
+def test_metrics_are_exported(config, test_folder, monkeypatch):
+    from types import SimpleNamespace
+    from capturadio import metrics
+
+    monkeypatch.setattr(pipeline, 'encoder_command',
+                        lambda source, target, *args: ['cp', source, target])
+    monkeypatch.setattr(pipeline, 'MP3', lambda filename: SimpleNamespace(
+        info=SimpleNamespace(length=60.0)))
+    show = config.shows['weather']
+    show.transcode = 64
+    episode = Episode(config, show)
+    os.makedirs(os.path.dirname(episode.filename))
+    with open(episode.filename, 'wb') as file:
+        file.write(b'\xff\xfb' * 50)
+    before = {name: metric.labels(**labels).value for name, metric, labels in (
+        ('processed', pipeline.EPISODES, {'result': 'processed'}),
+        ('input', pipeline.PROCESSED_BYTES, {'direction': 'input'}),
+        ('output', pipeline.PROCESSED_BYTES, {'direction': 'output'}),
+        ('audio', pipeline.AUDIO_SECONDS, {}))}
+
+    Pipeline(folder=str(test_folder.join('pipeline'))).process(episode)
+
+    assert pipeline.EPISODES.labels(result='processed').value - \
+        before['processed'] == 1
+    assert pipeline.PROCESSED_BYTES.labels(direction='input').value - \
+        before['input'] == 100
+    assert pipeline.PROCESSED_BYTES.labels(direction='output').value - \
+        before['output'] == 100
+    assert pipeline.AUDIO_SECONDS.labels().value - before['audio'] == 60.0
+    assert pipeline.QUEUE_DEPTH.labels().value == 0
+    exported = metrics.REGISTRY.render()
+    assert 'capturadio_pipeline_episodes_total{result="processed"}' in exported
+    assert 'capturadio_pipeline_bytes_total{direction="output"}' in exported
+    assert 'capturadio_pipeline_queue_depth 0' in exported
+    assert 'capturadio_pipeline_throughput ' in exported
+
+
+def test_trimmed_silence_is_not_reported(config, test_folder, monkeypatch):
+    from types import SimpleNamespace
+    from capturadio import silence
+
+    monkeypatch.setattr(silence, 'analyze', lambda filename: {
+        'duration': 60.0, 'leading': 5.0, 'trailing': 3.0,
+        'gaps': [(20.0, 2.5)], 'dead_air': False})
+    monkeypatch.setattr(silence, 'trim_command',
+                        lambda source, target, start, end: ['cp', source, target])
+    monkeypatch.setattr(pipeline, 'MP3', lambda filename: SimpleNamespace(
+        info=SimpleNamespace(length=52.0)))
+    show = config.shows['weather']
+    show.silence_detection = 'trim'
+    episode = Episode(config, show)
+    os.makedirs(os.path.dirname(episode.filename))
+    with open(episode.filename, 'wb') as file:
+        file.write(b'\xff\xfb' * 50)
+
+    Pipeline(folder=str(test_folder.join('pipeline'))).process(episode)
+
+    assert episode.silence == {'duration': 52.0, 'leading': 0.0, 'trailing': 0.0,
+                               'gaps': [(15.0, 2.5)], 'dead_air': False}
+    assert silence.summary(episode.silence) == '1 silent gaps (2s)'
+    assert episode.duration == 52.0
+
+
+def test_slots_limit_concurrent_encoders(test_folder):
+    worker = Pipeline(workers=1, folder=str(test_folder.join('pipeline')))
+    depths = []
+
+    def encode():
+        with worker.slot() as depth:
+            depths.append(depth)
+
+    with worker.slot() as depth:
+        depths.append(depth)
+        waiting = threading.Thread(target=encode)
+        waiting.start()
+        waiting.join(0.5)
+        assert waiting.is_alive()
+    waiting.join(5)
+    assert depths == [0, 1]
@@ -58,3 +58,64 @@ def test_add_metadata(config, test_folder):
     assert 'Me' == audio['TALB'].text[0]
     assert 'http://example.org/dlf' == audio['TCOM'].text[0]
     assert u'2000' == audio['TLEN'].text[0]
+
+
+def test_write_sequence_over_one_connection(test_folder, config, monkeypatch):
+    frame = b'\xff\xfb\x90\x64' + b'\0' * 413
+
+    class Stream(object):
+        sent = 0
+
+        def read(self, size):
+            time.sleep(0.05)
+            self.sent += len(frame) * 10
+            return frame * 10
+
+        def close(self):
+            pass
+
+    streams = []
+
+    def mockreturn(url):
+        streams.append(Stream())
+        return streams[-1]
+    import capturadio.recorder
+    monkeypatch.setattr(capturadio.recorder, 'urlopen', mockreturn)
+
+    start = time.time()
+    episodes = []
+    for id in ('weather', 'nachtradio'):
+        episode = Episode(config, config.shows[id], time.localtime(start))
+        episode.filename = str(test_folder.join(id + '.mp3'))
+        episode.duration = 1
+        episodes.append(episode)
+        start += 1
+
+    recorder = Recorder()
+    assert recorder._write_stream(episodes) == episodes
+    assert recorder.captured == episodes
+    assert len(streams) == 1
+    sizes = [os.path.getsize(episode.filename) for episode in episodes]
+    assert sum(sizes) == streams[0].sent
+    assert sizes[0] % len(frame) == 0
+    with open(episodes[1].filename, 'rb') as file:
+        assert file.read(len(frame)) == frame
+    assert [int(episode.filesize) for episode in episodes] == sizes
+
+
+def test_finished_episodes_are_processed_if_a_later_one_fails(config, test_folder):
+    class FailingRecorder(Recorder):
+        processed = []
+
+        def _write_stream(self, episodes):
+            self.captured = episodes[:1]
+            raise IOError('stream failed')
+
+        def process(self, episode):
+            self.processed.append(episode)
+
+    recorder = FailingRecorder()
+    shows = [config.shows['weather'], config.shows['nachtradio']]
+    with pytest.raises(IOError):
+        recorder.capture_sequence(config, shows)
+    assert [episode.show for episode in recorder.processed] == shows[:1]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.relay module.
+"""
+
+import os
+import sys
+import threading
+from urllib.request import urlopen
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.relay import Relay
+
+
+def test_relay_chunks_to_listeners():
+    with Relay(queue_size=8) as relay:
+        responses = [urlopen(relay.url) for _ in range(2)]
+        assert len(relay.listeners) == 2  # subscribed before the headers
+        bodies = [[] for _ in responses]
+        threads = [threading.Thread(target=lambda r=r, b=b: b.append(r.read()))
+                   for r, b in zip(responses, bodies)]
+        for thread in threads:
+            thread.start()
+        for number in range(5):
+            relay.publish(b'chunk%d' % number)
+    for thread in threads:
+        thread.join(5)
+    expected = b'chunk0chunk1chunk2chunk3chunk4'
+    assert [b[0] for b in bodies] == [expected, expected]
+    assert responses[0].getheader('Content-Type') == 'audio/mpeg'
+    assert relay.subscribe() is None
+
+
+def test_disconnect_slow_listener():
+    relay = Relay(queue_size=2)
+    try:
+        slow = relay.subscribe()
+        fast = relay.subscribe()
+        for number in range(3):
+            relay.publish(b'x')
+            fast.get_nowait()
+        assert not relay.is_subscribed(slow)
+        assert relay.is_subscribed(fast)
+        assert relay.dropped == 1
+    finally:
+        relay.server.server_close()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.retention module.
+"""
+
+import os
+import sys
+import time
+import pytest
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.entities import Episode
+from capturadio.database import EpisodeStore
+from capturadio.retention import plan_evictions, enforce_quotas, QuotaExceeded, \
+    reserve_recording
+
+
+def _add_episode(db, config, show_id, hours_ago, size, folder):
+    episode = Episode(config, config.shows[show_id])
+    episode.starttime = time.localtime(time.time() - hours_ago * 3600)
+    episode.slug = '{}/{}_{:d}.mp3'.format(episode.show.slug, show_id, hours_ago)
+    episode.filename = str(folder.join('{}_{:d}.mp3'.format(show_id, hours_ago)))
+    with open(episode.filename, 'wb') as file:
+        file.write(b'\0' * size)
+    episode.filesize = str(size)
+    db[episode.slug] = episode
+    return episode
+
+
+def test_station_quota(config, test_folder):
+    config.stations['dlf'].quota = 250
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        oldest = _add_episode(db, config, 'weather', 3, 100, test_folder)
+        _add_episode(db, config, 'news', 4, 100, test_folder)
+        _add_episode(db, config, 'weather', 2, 100, test_folder)
+        _add_episode(db, config, 'nachtradio', 1, 100, test_folder)
+
+        evictions = plan_evictions(config, db)
+        assert [row[0] for row in evictions] == [oldest.slug]
+
+        evictions, reclaimed = enforce_quotas(config, db)
+        assert reclaimed == 100
+        assert oldest.slug not in db
+        assert not os.path.exists(oldest.filename)
+        assert plan_evictions(config, db) == []
+
+
+def test_reservation(config, test_folder):
+    config.quota = 300
+    station = config.stations['dlf']
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        oldest = _add_episode(db, config, 'news', 4, 100, test_folder)
+        _add_episode(db, config, 'weather', 2, 100, test_folder)
+
+        assert plan_evictions(config, db, station, 100) == []
+        evictions = plan_evictions(config, db, station, 150)
+        assert [row[0] for row in evictions] == [oldest.slug]
+
+        reservation = db.reserve(station.slug, 150, time.time() + 60)
+        assert [row[0] for row in plan_evictions(config, db)] == [oldest.slug]
+        db.release(reservation)
+        assert plan_evictions(config, db) == []
+
+        with pytest.raises(QuotaExceeded):
+            plan_evictions(config, db, station, 301)
+
+
+def test_concurrent_reservations(config, test_folder, monkeypatch):
+    import threading
+    import capturadio.retention as retention
+
+    config.stations['dlf'].quota = 250
+    station = config.stations['dlf']
+    filename = str(test_folder.join('episodes.sqlite'))
+    with EpisodeStore(filename) as db:
+        oldest = _add_episode(db, config, 'weather', 2, 100, test_folder)
+        newest = _add_episode(db, config, 'weather', 1, 100, test_folder)
+
+    def slow_plan(*args, **kwargs):
+        # Give the other capture the chance to check the quota meanwhile
+        evictions = plan_evictions(*args, **kwargs)
+        time.sleep(0.2)
+        return evictions
+    monkeypatch.setattr(retention, 'plan_evictions', slow_plan)
+
+    def capture():
+        with EpisodeStore(filename) as db:
+            reserve_recording(config, db, station, 100, time.time() + 60)
+    threads = [threading.Thread(target=capture) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with EpisodeStore(filename) as db:
+        assert oldest.slug not in db and newest.slug not in db
+        assert db.usage(time.time()) == {'dlf': 200}
+
+
+def test_linked_episodes_count_once(config, test_folder):
+    config.stations['dlf'].quota = 300
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        original = _add_episode(db, config, 'weather', 4, 100, test_folder)
+        copy = _add_episode(db, config, 'nachtradio', 3, 100, test_folder)
+        os.remove(copy.filename)
+        os.link(original.filename, copy.filename)
+        copy.duplicate_of = original.slug
+        db[copy.slug] = copy
+        newest = _add_episode(db, config, 'weather', 2, 100, test_folder)
+        _add_episode(db, config, 'weather', 1, 100, test_folder)
+
+        assert db.usage(time.time()) == {'dlf': 300}
+        assert plan_evictions(config, db) == []
+
+        # the original frees nothing while the copy still links its file
+        config.stations['dlf'].quota = 150
+        assert [row[0] for row in plan_evictions(config, db)] == \
+            [original.slug, copy.slug, newest.slug]
+        config.stations['dlf'].quota = 250
+        rows = [(copy.slug, copy.filename, 100)]
+        assert [row[0] for row in plan_evictions(config, db, exclude=rows)] == \
+            [original.slug]
+
+        del db[original.slug]
+        assert db.usage(time.time()) == {'dlf': 300}
+
+
+def test_expired_episodes_are_not_planned_twice(config, test_folder):
+    config.stations['dlf'].quota = 250
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        expired = _add_episode(db, config, 'weather', 24 * 30, 100, test_folder)
+        oldest = _add_episode(db, config, 'weather', 3, 100, test_folder)
+        _add_episode(db, config, 'weather', 2, 100, test_folder)
+        _add_episode(db, config, 'nachtradio', 1, 100, test_folder)
+
+        assert [row[0] for row in plan_evictions(config, db)] == \
+            [expired.slug, oldest.slug]
+        rows = db.expired(time.time())
+        assert [row[0] for row in rows] == [expired.slug]
+        # the expired episode brings the station back to 300 bytes
+        assert [row[0] for row in plan_evictions(config, db, exclude=rows)] == \
+            [oldest.slug]
+
+
+def test_feed_cleanup_dry_run(config, test_folder, monkeypatch, capsys):
+    from docopt import docopt
+    import capturadio.recorder_cli as cli
+
+    config.stations['dlf'].quota = 250
+    filename = str(test_folder.join('episodes.sqlite'))
+    with EpisodeStore(filename) as db:
+        expired = _add_episode(db, config, 'weather', 24 * 30, 100, test_folder)
+        oldest = _add_episode(db, config, 'weather', 3, 100, test_folder)
+        _add_episode(db, config, 'weather', 2, 100, test_folder)
+        _add_episode(db, config, 'nachtradio', 1, 100, test_folder)
+    flags = []
+
+    def open_store(dbname, flag='c'):
+        flags.append(flag)
+        return EpisodeStore(filename, flag)
+    monkeypatch.setattr(cli.database, 'open', open_store)
+
+    cli.feed_cleanup(docopt(cli.main.__doc__, argv=['feed', 'cleanup', '--dry-run']))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:-1] == [expired.slug, oldest.slug]
+    assert lines[-1] == 'Found 2 expired episodes, would reclaim 200 bytes.'
+    assert flags == ['r']
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.scanner module.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio import scanner
+from capturadio.entities import Episode
+from capturadio.database import EpisodeStore
+
+
+def _create_file(config, relative_filename, size=100):
+    filename = os.path.join(config.destination, relative_filename)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as file:
+        file.write(b'\0' * size)
+    return filename
+
+
+def _show_mappings(config):
+    return {show.slug: show for show in config.shows.values()}
+
+
+def _fake_tags(filename):
+    if 'broken' in filename:
+        return None
+    return {'TLEN': '300000', 'TDRC': None, 'TIT2': os.path.basename(filename)}
+
+
+@pytest.fixture
+def fake_tags(monkeypatch):
+    # Threads share the patched tag reader, worker processes would not.
+    monkeypatch.setattr(scanner, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(scanner, '_read_media_tags', _fake_tags)
+
+
+def test_find_mediafiles(config, test_folder):
+    weather = config.shows['weather']
+    new = _create_file(config, 'dlf/weather/new.mp3')
+    _create_file(config, 'dlf/weather/known.mp3')
+    _create_file(config, 'dlf/weather/rss.xml')
+    _create_file(config, 'dlf/unknown/lost.mp3')
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        episode = Episode(config, weather)
+        episode.starttime = time.localtime()
+        episode.slug = 'dlf/weather/known.mp3'
+        episode.filename = os.path.join(config.destination, episode.slug)
+        episode.filesize = '100'
+        db[episode.slug] = episode
+
+        candidates = scanner.find_mediafiles(config, db, _show_mappings(config))
+
+        assert [(new, weather)] == candidates
+        assert ['dlf/unknown/lost.mp3'] == list(db.manifest())
+
+
+def test_find_mediafiles_skips_unchanged_files(config, test_folder):
+    failed = _create_file(config, 'dlf/weather/failed.mp3')
+    stat = os.stat(failed)
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        db.update_manifest([('dlf/weather/failed.mp3',
+                             stat.st_size, stat.st_mtime)])
+
+        assert [] == scanner.find_mediafiles(config, db, _show_mappings(config))
+
+        _create_file(config, 'dlf/weather/failed.mp3', size=200)
+        candidates = scanner.find_mediafiles(config, db, _show_mappings(config))
+        assert [(failed, config.shows['weather'])] == candidates
+
+
+def test_update_episodes(config, test_folder, fake_tags):
+    for index in range(5):
+        _create_file(config, 'dlf/weather/weather_{:d}.mp3'.format(index))
+    _create_file(config, 'dlf/weather/broken.mp3')
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        migrated = scanner.update_episodes(
+            config, db, _show_mappings(config), jobs=2)
+
+        assert 5 == migrated
+        assert 5 == len(db)
+        episode = db['dlf/weather/weather_0.mp3']
+        assert 'weather_0.mp3' == episode.name
+        assert 300 == episode.duration
+        assert ['dlf/weather/broken.mp3'] == list(db.manifest())
+        assert 0 == scanner.update_episodes(
+            config, db, _show_mappings(config), jobs=2)
+
+
+def test_update_episodes_commits_in_batches(config, test_folder, fake_tags,
+                                            monkeypatch):
+    for index in range(5):
+        _create_file(config, 'wdr2/news/news_{:d}.mp3'.format(index))
+    batches = []
+
+    def commit(db, episodes):
+        batches.append(len(episodes))
+        return _commit(db, episodes)
+    _commit = scanner._commit
+    monkeypatch.setattr(scanner, '_commit', commit)
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        migrated = scanner.update_episodes(
+            config, db, _show_mappings(config), jobs=2, batch_size=2)
+
+        assert 5 == migrated
+        assert [2, 2, 1] == batches
+        assert 5 == len(db)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.server module.
+"""
+
+import asyncio
+import os
+import sys
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.database import EpisodeStore
+from capturadio.entities import Episode
+from capturadio.generator import FeedCache
+from capturadio.server import FeedServer
+
+
+def _request(config, *requests, feeds=None, metrics_path=None):
+    """Send the raw requests over one connection, return the responses."""
+    async def run():
+        server = FeedServer(config, feeds, metrics_path)
+        listener = await server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        responses = []
+        for request in requests:
+            writer.write(request.encode('latin-1'))
+            status = (await reader.readline()).decode('latin-1').split()[1]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if line == '':
+                    break
+                key, _, value = line.partition(':')
+                headers[key.lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            responses.append((int(status), headers, body))
+        writer.close()
+        await writer.wait_closed()
+        listener.close()
+        await listener.wait_closed()
+        return responses
+    return asyncio.run(run())
+
+
+def test_conditional_and_range_requests(config, test_folder):
+    folder = os.path.join(config.destination, 'dlf', 'weather')
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'rss.xml'), 'w') as file:
+        file.write('<rss/>')
+    with open(os.path.join(folder, 'weather.mp3'), 'wb') as file:
+        file.write(bytes(range(100)))
+
+    (status, headers, body), = _request(
+        config, 'GET /dlf/weather/rss.xml HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert status == 200
+    assert body == b'<rss/>'
+    assert headers['content-type'].startswith('application/rss+xml')
+    etag = headers['etag']
+
+    responses = _request(
+        config,
+        'GET /dlf/weather/rss.xml HTTP/1.1\r\nIf-None-Match: {}\r\n\r\n'.format(etag),
+        'GET /dlf/weather/weather.mp3 HTTP/1.1\r\nRange: bytes=10-19\r\n\r\n',
+        'GET /dlf/weather/weather.mp3 HTTP/1.1\r\nRange: bytes=-5\r\n\r\n',
+        'GET /dlf/weather/weather.mp3 HTTP/1.1\r\nRange: bytes=200-\r\n\r\n',
+        'GET /../capturadiorc HTTP/1.1\r\n\r\n',
+    )
+    assert [status for status, headers, body in responses] == [304, 206, 206, 416, 404]
+    assert responses[1][1]['content-range'] == 'bytes 10-19/100'
+    assert responses[1][2] == bytes(range(10, 20))
+    assert responses[2][2] == bytes(range(95, 100))
+
+
+def test_render_feeds_on_request(config, test_folder):
+    filename = str(test_folder.join('episodes.sqlite'))
+    feeds = FeedCache(config, filename, size=2)
+    weather = config.shows['weather']
+    with EpisodeStore(filename) as db:
+        episode = Episode(config, weather)
+        os.makedirs(os.path.dirname(episode.filename))
+        with open(episode.filename, 'wb') as file:
+            file.write(b'\0' * 10)
+        episode.mimetype = 'audio/mpeg'
+        db[episode.slug] = episode
+
+    (status, headers, body), (not_modified, _, _) = _request(
+        config,
+        'GET /dlf/weather/rss.xml HTTP/1.1\r\n\r\n',
+        'GET /dlf/weather/rss.xml HTTP/1.1\r\nIf-None-Match: W/"feed-1-0"\r\n\r\n',
+        feeds=feeds)
+    assert status == 200
+    assert b'Weather forecast' in body
+    assert headers['etag'] == 'W/"feed-1-0"'
+    assert not_modified == 304
+    assert not os.path.exists(os.path.join(weather.filename, 'rss.xml'))
+    assert (feeds.hits, feeds.misses) == (1, 1)
+
+    # A committed capture invalidates the feed of its show
+    with EpisodeStore(filename) as db:
+        assert db.version('dlf/weather') == 1
+        episode.name = 'Changed'
+        db[episode.slug] = episode
+        assert db.version('dlf/weather') == 2
+        assert db.version('dlf') == 2
+        assert db.version('dlf/news') == 0
+    (status, headers, body), = _request(
+        config, 'GET /dlf/weather/ HTTP/1.1\r\n\r\n', feeds=feeds)
+    assert status == 200
+    assert headers['content-type'].startswith('text/html')
+    assert feeds.misses == 2
+    assert len(feeds.entries) == 2
+
+
+def test_feed_of_changed_media_file(config, test_folder):
+    from types import SimpleNamespace
+    from capturadio.generator import attach_fragments
+
+    filename = str(test_folder.join('episodes.sqlite'))
+    with EpisodeStore(filename) as db:
+        episode = Episode(config, config.shows['weather'])
+        os.makedirs(os.path.dirname(episode.filename))
+        with open(episode.filename, 'wb') as file:
+            file.write(b'\0' * 10)
+        episode.filesize = '10'
+        episode.mimetype = 'audio/mpeg'
+        db[episode.slug] = episode
+        attach_fragments(db, config.feed, [SimpleNamespace(**episode.__dict__)])
+    with open(episode.filename, 'ab') as file:
+        file.write(b'\0' * 10)
+
+    # The read-only store keeps the outdated fragment, it isn't served
+    version, body = FeedCache(config, filename).get('feed', 'dlf/weather')
+    assert b'length="20"' in body
+    assert b'length="10"' not in body
+
+
+def test_export_metrics(config, test_folder):
+    request = 'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n'
+    assert _request(config, request)[0][0] == 404
+
+    status, headers, body = _request(config, request, feeds=FeedCache(config),
+                                     metrics_path='/metrics')[0]
+    assert status == 200
+    assert headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert b'# TYPE capturadio_feed_cache_requests gauge' in body
+    assert b'capturadio_feed_cache_requests{result="miss"} 0' in body
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.silence module.
+"""
+
+import array
+import os
+import sys
+sys.path.insert(0, os.path.abspath('.'))
+
+import capturadio.silence as silence
+from capturadio.silence import SilenceDetector, summary
+
+
+def _pcm(*parts):
+    """Return 8 kHz PCM samples: parts are (seconds, amplitude)."""
+    samples = array.array('h')
+    for seconds, amplitude in parts:
+        samples.extend([amplitude, -amplitude] * int(seconds * 4000))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def _detect(data):
+    detector = SilenceDetector(min_gap=5)
+    for start in range(0, len(data), 9999):  # chunks do not match frames
+        detector.feed(data[start:start + 9999])
+    return detector.finish()
+
+
+def test_detect_silence():
+    data = _pcm((3, 0), (20, 8000), (2, 0), (20, 8000), (6, 5), (20, 8000), (4, 0))
+    result = _detect(data)
+    assert result == {
+        'duration': 75.0,
+        'leading': 3.0,
+        'trailing': 4.0,
+        'gaps': [(45.0, 6.0)],
+        'dead_air': False,
+    }
+    assert summary(result) == \
+        '3s silence at the start, 4s silence at the end, 1 silent gaps (6s)'
+
+
+def test_detect_silence_without_numpy(monkeypatch):
+    data = _pcm((3, 0), (20, 8000), (6, 0), (20, 8000))
+    expected = _detect(data)
+    monkeypatch.setattr(silence, 'numpy', None)
+    assert _detect(data) == expected
+    assert expected['gaps'] == [(23.0, 6.0)]
+
+
+def test_detect_dead_air():
+    result = _detect(_pcm((10, 8000), (50, 10), (10, 8000)))
+    assert result['dead_air']
+    assert summary(result) == 'Mostly silent (dead air)'
@@ -0,0 +1,82 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.storage module.
+"""
+
+import os
+import sys
+from fixtures import test_folder, config
+from s3_server import S3Server
+sys.path.insert(0, os.path.abspath('.'))
+
+from capturadio.storage import S3Storage, LocalStorage
+
+
+def _storage(config, s3, **options):
+    return S3Storage(config.destination, s3.endpoint, s3.bucket,
+                     'access', 'secret', prefix='podcasts', **options)
+
+
+def test_multipart_upload(config, test_folder):
+    with S3Server() as s3:
+        storage = _storage(config, s3, part_size=10)
+        filename = os.path.join(config.destination, 'dlf', 'weather', 'weather.mp3')
+        with storage.create(filename) as file:
+            for number in range(5):
+                file.write(b'chunk%d' % number)
+        assert file.size == 30
+        assert s3.objects == {'podcasts/dlf/weather/weather.mp3':
+                              b'chunk0chunk1chunk2chunk3chunk4'}
+        assert [r for r in s3.requests if r[0] == 'PUT'] == \
+            [('PUT', 'podcasts/dlf/weather/weather.mp3', ['partNumber', 'uploadId'])] * 3
+        assert not os.path.exists(filename)
+
+        assert storage.getsize(filename) == 30
+        assert storage.remove(filename) == 30
+        assert storage.getsize(filename) is None
+
+
+def test_aborted_upload(config, test_folder):
+    with S3Server() as s3:
+        storage = _storage(config, s3)
+        try:
+            with storage.create(os.path.join(config.destination, 'x.mp3')) as file:
+                file.write(b'partial')
+                raise KeyError('connection lost')
+        except KeyError:
+            pass
+        assert s3.objects == {}
+        assert s3.uploads == {}
+
+
+def test_object_listing(config, test_folder):
+    with S3Server() as s3:
+        storage = _storage(config, s3)
+        for name in ('dlf/weather/a.mp3', 'dlf/weather/b.mp3',
+                     'dlf/weather/c.mp3', 'dlf/news/d.mp3'):
+            with storage.create(os.path.join(config.destination, name)) as file:
+                file.write(name.encode('utf-8'))
+        stats = storage.stat_cache()
+        weather = os.path.join(config.destination, 'dlf', 'weather')
+        assert stats.getsize(os.path.join(weather, 'c.mp3')) == 17
+        assert stats.getsize(os.path.join(weather, 'e.mp3')) is None
+        del s3.requests[:]
+        assert stats.exists(weather)
+        assert stats.exists(os.path.join(config.destination, 'dlf'))
+        assert not stats.exists(os.path.join(config.destination, 'wdr2'))
+        # folders are common prefixes, the objects below them aren't listed
+        assert s3.requests == [
+            ('GET', '', ['delimiter', 'list-type', 'prefix'])] * 2
+
+
+def test_local_writer_removes_failed_capture(test_folder):
+    filename = str(test_folder.join('station', 'show', 'episode.mp3'))
+    try:
+        with LocalStorage().create(filename) as file:
+            file.write(b'partial')
+            raise IOError('connection lost')
+    except IOError:
+        pass
+    assert not os.path.exists(filename)
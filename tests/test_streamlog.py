@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capturadio.streamlog module.
+"""
+
+import io
+import os
+import sys
+import time
+from fixtures import test_folder, config
+sys.path.insert(0, os.path.abspath('.'))
+
+import capturadio.recorder
+from capturadio.database import EpisodeStore
+from capturadio.entities import Episode
+from capturadio.recorder import Recorder
+from capturadio.streamlog import StreamLog, summary, health
+
+
+def test_summary():
+    log = StreamLog('http://example.org/stream', started=100.0)
+    for second in range(10):
+        if second not in (4, 5):
+            log.received(100.2 + second, 16000)
+    log.received(105.9, 2000)
+    log.stalled(105.9, 1.7)
+    log.reconnected(107.0)
+
+    entry = summary(log.to_dict())
+    assert entry['duration'] == 10
+    assert entry['min_rate'] == 0
+    assert entry['starved'] == 2
+    assert entry['stalls'] == 1
+    assert entry['stall_seconds'] == 1.7
+    assert entry['reconnects'] == 1
+    assert round(entry['first_byte'], 1) == 0.2
+
+    total = health([entry, entry])
+    assert total['episodes'] == 2
+    assert total['stalls_per_hour'] == 360.0
+    assert total['mean_rate'] == entry['mean_rate']
+
+
+def test_capture_records_stream_log(test_folder, config, monkeypatch):
+    streams = [io.BytesIO(b'a' * 25000), io.BytesIO(b'b' * 5000)]
+    monkeypatch.setattr(capturadio.recorder, 'urlopen',
+                        lambda url: streams.pop(0) if streams else io.BytesIO())
+    monkeypatch.setattr(capturadio.recorder.time, 'sleep', lambda seconds: None)
+
+    episode = Episode(config, config.shows['weather'])
+    episode.filename = os.path.join(str(test_folder.mkdir('casts')), 'output.mp3')
+    episode.duration = 60
+    recorder = Recorder()
+    recorder._write_stream_to_file(episode)
+
+    log = recorder.stream_logs[episode.slug].to_dict()
+    assert log['url'] == episode.stream_url
+    assert summary(log)['mean_rate'] * summary(log)['duration'] == 30000
+    assert len(log['reconnects']) == capturadio.recorder.MAX_RECONNECTS + 1
+
+
+def test_store_stream_logs(test_folder, config):
+    show = config.shows['weather']
+    now = time.time()
+    with EpisodeStore(str(test_folder.join('episodes.sqlite'))) as db:
+        slugs = []
+        for number in range(3):
+            episode = Episode(config, show, time.localtime(now - number * 3600))
+            db[episode.slug] = episode
+            db.save_stream_log(episode.slug, StreamLog(str(number)).to_dict())
+            slugs.append(episode.slug)
+
+        assert [log['url'] for _, _, log in db.stream_logs(show.slug)] == \
+            ['0', '1', '2']
+        assert [slug for slug, _, _ in db.stream_logs(show.slug, 2)] == slugs[:2]
+        assert db.stream_logs(show.station.slug + '/other') == []
+
+        del db[slugs[0]]
+        assert [slug for slug, _, _ in db.stream_logs(show.slug)] == slugs[1:]